@@ -15,10 +15,12 @@
     'description': """Payhere Payment Acquirer""",
     'depends': ['payment'],
     'data': [
+        'security/ir.model.access.csv',
         'views/payment_views.xml',
         'views/payment_payhere_templates.xml',
         'data/payment_acquirer_data.xml',
         'data/payment_payhere_email_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'installable': True,
     'post_init_hook': 'create_missing_journal_for_acquirers',
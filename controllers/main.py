@@ -1,18 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import hmac
 import json
 import logging
-import pprint
 
-import requests
 import werkzeug
 from werkzeug import urls
 
-from odoo import http
-from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo import SUPERUSER_ID, api, http
+from odoo.addons.payment.controllers.portal import PaymentProcessing
+from odoo.addons.payment_payhere.models import payhere_metrics
+from odoo.addons.payment_payhere.models.payhere_dispatch import payhere_dispatcher
+from odoo.addons.payment_payhere.models.payhere_logging import SampledLogger, redacted
+from odoo.addons.payment_payhere.models.payhere_request import payhere_client
 from odoo.http import request
 
 _logger = logging.getLogger(__name__)
+_sampled_logger = SampledLogger(_logger)
 
 
 class PayhereController(http.Controller):
@@ -30,7 +34,7 @@ class PayhereController(http.Controller):
                     :return: tuple containing the STATUS str and the key/value pairs
                              parsed as a dict
                 """
-        _logger.info('Beginning Payhere DPN form_feedback with post data %s', pprint.pformat(response))  # debug
+        _logger.debug('Beginning Payhere DPN form_feedback with post data %s', redacted(response))
 
         status = None
         pdt = bool(response.get('status_code'))
@@ -39,84 +43,150 @@ class PayhereController(http.Controller):
         return status, response
 
     def payhere_validate_data(self, **post):
-        """ Payhere IPN: three steps validation to ensure data correctness
-
-         - step 1: return an empty HTTP 200 response -> will be done at the end
-           by returning ''
-         - step 2: POST the complete, unaltered message back to Payhere (preceded
-           by cmd=_notify-validate or _notify-synch for PDT), with same encoding
-         - step 3: payhere send either VERIFIED or INVALID (single word) for IPN
-                   or SUCCESS or FAIL (+ data) for PDT
-
-        Once data is validated, process it. """
-        res = False
-        post['cmd'] = '_notify-validate'
-        reference = post.get('order_id')
-        tx = None
-        if reference:
-            tx = request.env['payment.transaction'].sudo().search([('reference', '=', reference)])
-        if not tx:
-            # we have seemingly received a notification for a payment that did not come from
-            # odoo, acknowledge it otherwise Payhere will keep trying
-            _logger.warning('received notification for unknown payment reference')
-            return False
-        payhere_url = tx.acquirer_id.payhere_get_form_action_url()
-        pdt_request = bool(post.get('payment_id'))  # check for specific pdt param
-        if pdt_request:
-            # this means we are in PDT instead of DPN like before
-            # fetch the PDT token
-            post['at'] = tx and tx.acquirer_id.payhere_pdt_token or ''
-            post['cmd'] = '_notify-synch'  # command is different in PDT than IPN/DPN
-        requests.post(payhere_url, post)
-        resp = bool(post.get('status_code'))
-        _logger.info('Beginning Payhere IPN form_feedback with post data %s', pprint.pformat(post))
-        if resp:
-            resp = int(post.get('status_code'))
-        if resp == 2:
-            res = request.env['payment.transaction'].sudo().form_feedback(post, 'payhere')
-            if not res and tx:
-                tx._set_transaction_error('Validation error occured. Please contact your administrator.')
-        elif resp in [-1, -2]:
-            _logger.warning('Payhere: answered INVALID/FAIL on data verification')
-            if tx:
-                tx._set_transaction_error('Invalid response from Payhere. Please contact your administrator.')
-        elif resp == 0:
-            _logger.warning('Payhere: answered pending data verification')
-            if tx:
-                tx._set_transaction_error('Verification is pending from Payhere. Please contact your administrator.')
-        else:
-            _logger.warning(
-                'Payhere: unrecognized Payhere answer, received %s instead of VERIFIED/SUCCESS or INVALID/FAIL (validation: %s)' % (
-                resp, 'PDT' if pdt_request else 'IPN/DPN'))
-            if tx:
-                tx._set_transaction_error('Unrecognized error from Payhere. Please contact your administrator.')
-        return res
+        """ Payhere IPN: validate the notification and apply it to its
+        transaction. The processing itself lives on ``payment.transaction``
+        so that it can also be run by the notification queue. """
+        return request.env['payment.transaction'].sudo()._payhere_validate_data(post)
 
     @http.route('/payment/payhere/ipn/', type='http', auth='public', methods=['POST'], csrf=False)
     def payhere_ipn(self, **post):
-        """ Payhere IPN. """
-        _logger.info('Beginning Payhere IPN form_feedback with post data %s', pprint.pformat(post))  # debug
-        try:
-            self.payhere_validate_data(**post)
-        except ValidationError:
-            _logger.exception('Unable to validate the Payhere payment')
+        """ Payhere IPN: store the notification in the inbox and acknowledge it
+        right away, the queue cron validates and applies it later. When the
+        inbox is saturated, answer 503 so that Payhere retries later. The
+        notifications of unknown merchants are dropped, and so are the
+        unsigned or forged ones: the merchant_id is public, only the md5sig
+        (checked without any query) tells a notification of Payhere. Every
+        other notification received is appended to the journal, as posted. """
+        _logger.debug('Beginning Payhere IPN form_feedback with post data %s', redacted(post))
+        Journal = request.env['payment.payhere.journal'].sudo()
+        acquirer = request.env['payment.acquirer'].sudo()._payhere_get_merchant(post.get('merchant_id'))
+        if not acquirer:
+            # not one of our merchants: acknowledge it without queuing it
+            _sampled_logger.warning('unknown_merchant', 'Payhere: notification for unknown merchant %s, ignoring it', post.get('merchant_id'))
+            payhere_metrics.inbox.inc(result='unknown_merchant')
+            Journal._append([('ipn', post, None, 'unknown_merchant')])
+            return ''
+        if not acquirer._payhere_check_md5sig(post):
+            # acknowledged without storing anything, so that forged posts can
+            # neither fill the inbox nor claim the fingerprint of a payment
+            _sampled_logger.warning('invalid_md5sig', 'Payhere: invalid md5sig on notification for %s, ignoring it', post.get('order_id'))
+            payhere_metrics.inbox.inc(result='invalid_signature')
+            return ''
+        Notification = request.env['payment.payhere.notification'].sudo()
+        if Notification._is_inbox_full():
+            _sampled_logger.warning('inbox_full', 'Payhere: notification inbox is full, deferring notification for %s', post.get('order_id'))
+            payhere_metrics.inbox.inc(result='deferred')
+            Journal._append([('ipn', post, None, 'deferred')])
+            return werkzeug.wrappers.Response(status=503, headers=[('Retry-After', '60')])
+        payhere_metrics.inbox.inc(result='queued' if Notification._enqueue(post, source='ipn') else 'duplicate')
         return ''
 
     @http.route('/payment/payhere/dpn', type='http', auth="public", methods=['POST', 'GET'], csrf=False)
     def payhere_dpn(self, **post):
-        """ Payhere DPN """
-        data = {
-            'order_id': post.get('order_id').split('-')[0]
-        }
-        _logger.info('Beginning Payhere DPN form_feedback with post data %s', pprint.pformat(post))  # debug
-        try:
-            res = self.payhere_validate_data(**data)
-        except ValidationError:
-            _logger.exception('Unable to validate the Payhere payment')
+        """ Payhere DPN: redirect the customer right away. The state of the
+        transaction is only read locally; if it is not settled yet, a status
+        check is queued instead of calling Payhere during the redirection. """
+        _logger.debug('Beginning Payhere DPN form_feedback with post data %s', redacted(post))
+        if post.get('order_id'):
+            request.env['payment.transaction'].sudo()._payhere_handle_return(post['order_id'])
         return werkzeug.utils.redirect('/payment/process')
 
     @http.route('/payment/payhere/cancel', type='http', auth="public", csrf=False)
     def payhere_cancel(self, **post):
         """ When the user cancels its Payhere payment: GET on this route """
-        _logger.info('Beginning Payhere cancel with post data %s', pprint.pformat(post))  # debug
+        _logger.debug('Beginning Payhere cancel with post data %s', redacted(post))
         return werkzeug.utils.redirect('/payment/process')
+
+    @http.route('/payment/payhere/onsite', type='json', auth='public')
+    def payhere_onsite(self, reference):
+        """ Signed payload of the onsite checkout, for the popup of the
+        Payhere JavaScript SDK. Only the draft transactions of the session are
+        served. """
+        tx_ids = PaymentProcessing.get_payment_transaction_ids()
+        tx = request.env['payment.transaction'].sudo().search([
+            ('id', 'in', tx_ids), ('reference', '=', reference),
+            ('provider', '=', 'payhere'), ('state', '=', 'draft')], limit=1)
+        if not tx:
+            raise werkzeug.exceptions.NotFound()
+        return tx._payhere_get_onsite_payload(tx.acquirer_id.get_base_url())
+
+    @http.route(['/payment/payhere/status', '/longpolling/payhere/status'], type='http', auth='public', methods=['GET'], csrf=False)
+    def payhere_status(self, wait=0, **kw):
+        """ Compact state of the transactions of the session, for the payment
+        status page to poll.
+
+            Unchanged states answer 304 to an ``If-None-Match`` matching the
+            ETag of the previous answer. Long-polling is opt-in: when the
+            ``payment_payhere.status_max_wait`` system parameter is set (0 by
+            default), a request sent with ``wait`` is held until one of the
+            transactions changes or the delay elapses, bounded by the
+            parameter. A waiting request releases its cursor, like the bus
+            does; route ``/longpolling/payhere/status`` to the longpolling
+            worker so that it does not hold an HTTP worker either.
+        """
+        tx_ids = PaymentProcessing.get_payment_transaction_ids()
+        Transaction = request.env['payment.transaction'].sudo()
+        if_none_match = request.httprequest.headers.get('If-None-Match')
+        max_wait = int(request.env['ir.config_parameter'].sudo().get_param('payment_payhere.status_max_wait', 0))
+        try:
+            wait = max(0, min(int(wait), max_wait))
+        except ValueError:
+            wait = 0
+        if wait and tx_ids and if_none_match:
+            dbname = request.env.cr.dbname
+            with payhere_dispatcher.subscribe(dbname, tx_ids) as event:
+                status, etag = Transaction._payhere_get_status(tx_ids)
+                if etag == if_none_match:
+                    # hold no database connection while waiting
+                    request.cr.close()
+                    request._cr = None
+                    if event.wait(wait):
+                        with request.registry.cursor() as cr:
+                            env = api.Environment(cr, SUPERUSER_ID, {})
+                            status, etag = env['payment.transaction']._payhere_get_status(tx_ids)
+        else:
+            status, etag = Transaction._payhere_get_status(tx_ids)
+        headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+        if etag == if_none_match:
+            return werkzeug.wrappers.Response(status=304, headers=headers)
+        return request.make_response(
+            json.dumps({'transactions': status}), headers=headers + [('Content-Type', 'application/json')])
+
+    @http.route('/payment/payhere/client/stats', type='json', auth='user')
+    def payhere_client_stats(self):
+        """ Counters, connection pool usage and circuit breaker states of the
+        Payhere client of this worker. """
+        if not request.env.user.has_group('base.group_system'):
+            raise werkzeug.exceptions.Forbidden()
+        return payhere_client.get_stats()
+
+    @http.route('/payment/payhere/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def payhere_metrics(self, **kw):
+        """ Metrics of the Payhere integration of this worker, in the Prometheus
+        text format. Scrapers authenticate with the bearer token configured in
+        the ``payment_payhere.metrics_token`` system parameter; without it,
+        only administrators can read them. """
+        token = request.env['ir.config_parameter'].sudo().get_param('payment_payhere.metrics_token')
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if token:
+            if not hmac.compare_digest(authorization, 'Bearer %s' % token):
+                raise werkzeug.exceptions.Forbidden()
+        elif not request.env.user.has_group('base.group_system'):
+            raise werkzeug.exceptions.Forbidden()
+        body = payhere_metrics.registry.render(self._payhere_client_samples())
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+    def _payhere_client_samples(self):
+        stats = payhere_client.get_stats()
+        samples = [
+            ('payhere_client_%s_total' % counter, 'counter', 'Payhere client %s.' % counter.replace('_', ' '), [], stats[counter])
+            for counter in ('requests', 'responses', 'failures', 'retries', 'short_circuits')
+        ]
+        samples.append(('payhere_client_in_flight', 'gauge', 'Payhere client requests in flight.', [], stats['in_flight']))
+        for host, breaker in stats['breakers'].items():
+            samples.append(('payhere_client_circuit_open', 'gauge', 'Whether the circuit breaker of a Payhere host is open.',
+                            [('host', host)], int(breaker['state'] != 'closed')))
+        for host, pool in stats['pools'].items():
+            samples.append(('payhere_client_pool_connections', 'gauge', 'Connections opened by the Payhere client pool.',
+                            [('host', host)], pool['connections']))
+        return samples
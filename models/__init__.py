@@ -1,3 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from . import payhere_batch
 from . import payment
+from . import payhere_notification
+from . import payhere_settlement
+from . import payhere_charge
+from . import payhere_refund
+from . import payhere_journal
@@ -0,0 +1,50 @@
+# coding: utf-8
+
+import threading
+
+from odoo import api, models
+
+
+class PayhereBatchMixin(models.AbstractModel):
+    """ Helpers shared by the Payhere records processed in batches by a cron:
+    the configuration parameters, the commits between batches, the claim of
+    the rows to process and their grouping per acquirer.
+
+        A model claiming its rows with ``_payhere_claim`` sets
+        ``_payhere_claim_where`` to the SQL condition of the rows ready to be
+        processed.
+    """
+    _name = 'payment.payhere.batch.mixin'
+    _description = 'Payhere Batch Processing Mixin'
+
+    _payhere_claim_where = None
+
+    @api.model
+    def _payhere_get_param(self, key, default):
+        return float(self.env['ir.config_parameter'].sudo().get_param('payment_payhere.%s' % key, default))
+
+    @api.model
+    def _payhere_auto_commit(self):
+        """ Tell whether a cron may commit between its batches; never in tests,
+        which roll back the transaction of the test. """
+        return not getattr(threading.currentThread(), 'testing', False)
+
+    @api.model
+    def _payhere_claim(self, limit):
+        """ Lock up to ``limit`` rows ready to be processed, in the order of the
+        model, skipping those claimed by a concurrent run. """
+        self.env.cr.execute("""
+            SELECT id FROM {table}
+             WHERE {where}
+             ORDER BY {order}
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        """.format(table=self._table, where=self._payhere_claim_where, order=self._order), (limit,))
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _payhere_group_by_acquirer(self):
+        groups = {}
+        for record in self:
+            groups.setdefault(record.acquirer_id, self.browse())
+            groups[record.acquirer_id] |= record
+        return groups.items()
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+import logging
+import time
+import uuid
+
+from odoo import api, fields, models, _
+from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable, TokenBucket
+
+_logger = logging.getLogger(__name__)
+
+
+class PayhereCharge(models.Model):
+    """ Charge of a Payhere customer token scheduled for a due date, e.g. by a
+    subscription.
+
+        The ``_cron_process_charges`` cron charges the due charges in batches,
+        with a bounded number of concurrent, rate-limited calls to Payhere.
+        The idempotency key of a charge is the order_id sent to Payhere: it is
+        stored with the transaction before the call, so that a run interrupted
+        after the call checks the order on Payhere instead of charging the
+        customer twice.
+    """
+    _name = 'payment.payhere.charge'
+    _inherit = 'payment.payhere.batch.mixin'
+    _description = 'Payhere Scheduled Charge'
+    _order = 'date_due, id'
+    _payhere_claim_where = """
+        (state = 'scheduled' AND date_due <= now() at time zone 'UTC')
+        OR (state = 'processing' AND write_date < now() at time zone 'UTC' - interval '5 minutes')
+    """
+
+    name = fields.Char('Description', required=True)
+    idempotency_key = fields.Char(
+        'Idempotency Key', required=True, readonly=True, copy=False, default=lambda self: uuid.uuid4().hex,
+        help='Order reference sent to Payhere, unique per charge.')
+    token_id = fields.Many2one(
+        'payment.token', 'Payment Token', required=True, ondelete='restrict',
+        domain=[('acquirer_id.provider', '=', 'payhere')])
+    acquirer_id = fields.Many2one(related='token_id.acquirer_id', store=True)
+    partner_id = fields.Many2one(related='token_id.partner_id', store=True)
+    amount = fields.Monetary('Amount', required=True)
+    currency_id = fields.Many2one('res.currency', 'Currency', required=True)
+    date_due = fields.Datetime('Due Date', required=True, default=fields.Datetime.now, index=True)
+    state = fields.Selection([
+        ('scheduled', 'Scheduled'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed')], string='Status', default='scheduled', required=True, readonly=True, index=True)
+    state_message = fields.Text('Message', readonly=True)
+    transaction_id = fields.Many2one('payment.transaction', 'Transaction', readonly=True, copy=False)
+
+    _sql_constraints = [
+        ('idempotency_key_uniq', 'unique(idempotency_key)', 'The idempotency key of a charge must be unique.'),
+    ]
+
+    @api.model
+    def _cron_process_charges(self):
+        """ Charge the due charges in batches of
+        ``payment_payhere.charge_batch_size``, with at most
+        ``payment_payhere.charge_workers`` concurrent calls and
+        ``payment_payhere.charge_rate`` calls per second, until none is due
+        or the run exceeds ``payment_payhere.charge_time_budget`` seconds. """
+        batch_size = int(self._payhere_get_param('charge_batch_size', 50))
+        workers = int(self._payhere_get_param('charge_workers', 4))
+        limiter = TokenBucket(self._payhere_get_param('charge_rate', 5))
+        deadline = time.monotonic() + self._payhere_get_param('charge_time_budget', 240)
+        auto_commit = self._payhere_auto_commit()
+
+        processed = 0
+        while time.monotonic() < deadline:
+            charges = self._payhere_claim(batch_size)
+            if not charges:
+                break
+            charges._process(workers, limiter, auto_commit)
+            processed += len(charges)
+            if auto_commit:
+                self.env.cr.commit()
+        _logger.info('Payhere: processed %s scheduled charges', processed)
+        return processed
+
+    def _process(self, workers, limiter, auto_commit=True):
+        """ Charge a batch of charges: check the charges of an interrupted run
+        on Payhere, create the transactions of the new ones and commit them
+        before any call, then charge the tokens and apply the results in
+        bulk. """
+        Transaction = self.env['payment.transaction'].sudo()
+        interrupted = self.filtered(lambda charge: charge.state == 'processing')
+        to_charge = self - interrupted
+
+        for acquirer, charges in interrupted._payhere_group_by_acquirer():
+            txs = charges.mapped('transaction_id')
+            try:
+                payments = acquirer._payhere_retrieve_payments_batch(txs.mapped('reference'), workers)
+            except (PayhereUnavailable, ValidationError) as e:
+                _logger.warning('Payhere: unable to check the charges of acquirer %s: %s', acquirer.id, e)
+                continue
+            txs._payhere_apply_payments(payments)
+            # not charged by the interrupted run: charge again, same order_id
+            to_charge |= charges.filtered(
+                lambda charge: payments.get(charge.transaction_id.reference) == [])
+
+        new = to_charge.filtered(lambda charge: not charge.transaction_id)
+        txs = Transaction.create([{
+            'reference': charge.idempotency_key,
+            'amount': charge.amount,
+            'currency_id': charge.currency_id.id,
+            'acquirer_id': charge.acquirer_id.id,
+            'partner_id': charge.partner_id.id,
+            'payment_token_id': charge.token_id.id,
+            'type': 'server2server',
+        } for charge in new])
+        for charge, tx in zip(new, txs):
+            charge.transaction_id = tx
+        to_charge.write({'state': 'processing'})
+        if auto_commit:
+            self.env.cr.commit()
+
+        for acquirer, charges in to_charge._payhere_group_by_acquirer():
+            charge_txs = charges.mapped('transaction_id')
+            try:
+                results = acquirer._payhere_charge_batch(
+                    [tx._payhere_get_charge_payload() for tx in charge_txs], workers, limiter)
+            except (PayhereUnavailable, ValidationError) as e:
+                _logger.warning('Payhere: charges skipped for acquirer %s: %s', acquirer.id, e)
+                continue
+            charge_txs._payhere_apply_charges(results)
+        self._sync_state()
+
+    def _sync_state(self):
+        """ Set the state of the charges from their transactions, with one
+        write per state. """
+        done = self.filtered(lambda charge: charge.transaction_id.state == 'done')
+        done.write({'state': 'done', 'state_message': False})
+        failed = {}
+        for charge in self.filtered(lambda charge: charge.transaction_id.state in ('cancel', 'error')):
+            message = charge.transaction_id.state_message or _('The charge was declined.')
+            failed.setdefault(message, self.browse())
+            failed[message] |= charge
+        for message, charges in failed.items():
+            charges.write({'state': 'failed', 'state_message': message})
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+import contextlib
+import json
+import logging
+import select
+import threading
+import time
+
+from odoo import sql_db
+
+_logger = logging.getLogger(__name__)
+
+# channel of the NOTIFY sent when Payhere changes the state of transactions
+PAYHERE_STATE_CHANNEL = 'payhere_tx_state'
+
+
+class StateDispatcher(object):
+    """ Wake the requests long-polling the state of transactions.
+
+        One thread per database and per process LISTENs on
+        ``PAYHERE_STATE_CHANNEL`` and sets the events of the requests waiting
+        for the transactions listed in the notifications, so that waiting
+        requests hold no database connection of their own.
+    """
+
+    def __init__(self, channel=PAYHERE_STATE_CHANNEL, ready_timeout=5):
+        self.channel = channel
+        self.ready_timeout = ready_timeout
+        self._waiters = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def subscribe(self, dbname, tx_ids):
+        """ Register an event set when one of the transactions changes. Read
+        the state of the transactions after subscribing, so that no change is
+        missed between the read and the wait. """
+        event = threading.Event()
+        keys = [(dbname, tx_id) for tx_id in tx_ids]
+        with self._lock:
+            for key in keys:
+                self._waiters.setdefault(key, set()).add(event)
+            ready = self._threads.get(dbname)
+            if ready is None:
+                ready = self._threads[dbname] = threading.Event()
+                thread = threading.Thread(
+                    target=self._loop, args=(dbname, ready), name='payhere.dispatch.%s' % dbname, daemon=True)
+                thread.start()
+        ready.wait(self.ready_timeout)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                for key in keys:
+                    events = self._waiters.get(key)
+                    if events is not None:
+                        events.discard(event)
+                        if not events:
+                            del self._waiters[key]
+
+    def _wake(self, dbname, tx_ids):
+        with self._lock:
+            events = set()
+            for tx_id in tx_ids:
+                events.update(self._waiters.get((dbname, tx_id), ()))
+        for event in events:
+            event.set()
+
+    def _loop(self, dbname, ready):
+        while True:
+            try:
+                with sql_db.db_connect(dbname).cursor() as cr:
+                    conn = cr._cnx
+                    cr.execute('LISTEN %s' % self.channel)
+                    cr.commit()
+                    ready.set()
+                    while True:
+                        if select.select([conn], [], [], 50) == ([], [], []):
+                            continue
+                        conn.poll()
+                        tx_ids = set()
+                        while conn.notifies:
+                            tx_ids.update(json.loads(conn.notifies.pop().payload))
+                        self._wake(dbname, tx_ids)
+            except Exception:
+                _logger.exception('Payhere: state dispatcher of %s failed, restarting it', dbname)
+                time.sleep(5)
+
+
+# one dispatcher per process, shared by the status requests
+payhere_dispatcher = StateDispatcher()
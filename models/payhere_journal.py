@@ -0,0 +1,223 @@
+# coding: utf-8
+
+import gzip
+import json
+import logging
+import os
+import re
+import zlib
+from datetime import date
+
+import psycopg2
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+PARTITION_PATTERN = re.compile(r'^payment_payhere_journal_y(\d{4})m(\d{2})$')
+
+
+class PayhereJournal(models.Model):
+    """ Append-only journal of the Payhere notifications, kept as evidence
+    for disputes and replayable through ``_payhere_validate_data``.
+
+        The IPN route appends every notification it receives as posted,
+        duplicates, unknown merchants and deferred ones included, before any
+        processing; the outcome of an entry is the one of its reception.
+
+        The table is partitioned by month and managed outside of the ORM:
+        entries are appended with a single raw INSERT, their payload
+        normalized and compressed, and the retention cron drops (and
+        optionally exports) whole partitions instead of deleting rows. It
+        requires PostgreSQL 11 or later.
+    """
+    _name = 'payment.payhere.journal'
+    _description = 'Payhere Notification Journal'
+    _auto = False
+    _log_access = False
+    _order = 'date desc, id desc'
+
+    date = fields.Datetime('Received On', readonly=True)
+    transaction_id = fields.Many2one('payment.transaction', 'Transaction', readonly=True)
+    reference = fields.Char('Order Reference', readonly=True)
+    payment_id = fields.Char('Payment ID', readonly=True)
+    status_code = fields.Char('Status Code', readonly=True)
+    source = fields.Selection([
+        ('ipn', 'IPN'),
+        ('batch', 'Batch Feedback')], string='Source', readonly=True)
+    outcome = fields.Char('Outcome', readonly=True)
+    payload_text = fields.Text('Payload', compute='_compute_payload_text')
+
+    def init(self):
+        self.env.cr.execute("SELECT to_regclass('payment_payhere_journal')")
+        if not self.env.cr.fetchone()[0]:
+            self.env.cr.execute("""
+                CREATE TABLE payment_payhere_journal (
+                    id serial NOT NULL,
+                    date timestamp NOT NULL DEFAULT (now() at time zone 'UTC'),
+                    transaction_id integer,
+                    reference varchar,
+                    payment_id varchar,
+                    status_code varchar,
+                    source varchar,
+                    outcome varchar,
+                    payload bytea NOT NULL,
+                    PRIMARY KEY (id, date)
+                ) PARTITION BY RANGE (date)
+            """)
+            self.env.cr.execute("CREATE INDEX ON payment_payhere_journal (transaction_id)")
+            self.env.cr.execute("CREATE INDEX ON payment_payhere_journal (reference)")
+            # catches the entries of a month whose partition is missing
+            self.env.cr.execute("CREATE TABLE payment_payhere_journal_default PARTITION OF payment_payhere_journal DEFAULT")
+        self._ensure_partitions()
+
+    # --------------------------------------------------
+    # APPEND
+    # --------------------------------------------------
+
+    @api.model
+    def _compress(self, data):
+        """ Normalize a payload (lowercase keys, stripped values, no empty
+        value, sorted keys) and compress it. """
+        normalized = {
+            str(key).strip().lower(): str(value).strip()
+            for key, value in (data or {}).items() if value not in (None, '', False)
+        }
+        return zlib.compress(json.dumps(normalized, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+    @api.model
+    def _decompress(self, payload):
+        return json.loads(zlib.decompress(bytes(payload)).decode('utf-8'))
+
+    @api.model
+    def _append(self, entries):
+        """ Append entries to the journal with a single INSERT, without any ORM
+        work.
+
+            :param list entries: (source, payload, transaction id, outcome)
+                                 tuples; without a transaction id, the
+                                 transaction is looked up by the order_id of
+                                 the payload in the same statement
+        """
+        rows = [
+            (tx_id or None, data.get('order_id'), data.get('payment_id'), data.get('status_code'),
+             source, outcome, psycopg2.Binary(self._compress(data)))
+            for source, data, tx_id, outcome in entries
+        ]
+        if not rows:
+            return
+        self.env.cr.execute("""
+            INSERT INTO payment_payhere_journal
+                (transaction_id, reference, payment_id, status_code, source, outcome, payload)
+            SELECT COALESCE(entry.transaction_id::integer,
+                            (SELECT id FROM payment_transaction WHERE reference = entry.reference)),
+                   entry.reference, entry.payment_id, entry.status_code, entry.source, entry.outcome, entry.payload
+              FROM (VALUES %s) AS entry (transaction_id, reference, payment_id, status_code, source, outcome, payload)
+        """ % ', '.join(['%s'] * len(rows)), rows)
+
+    def _compute_payload_text(self):
+        payloads = {}
+        if self.ids:
+            self.env.cr.execute("SELECT id, payload FROM payment_payhere_journal WHERE id IN %s", (tuple(self.ids),))
+            payloads = dict(self.env.cr.fetchall())
+        for entry in self:
+            payload = payloads.get(entry.id)
+            entry.payload_text = payload and json.dumps(self._decompress(payload), indent=2, sort_keys=True)
+
+    # --------------------------------------------------
+    # REPLAY
+    # --------------------------------------------------
+
+    def action_replay(self):
+        """ Run the entries through ``_payhere_validate_data`` again, oldest
+        first, with the checks of the notifications: signature, merchant and
+        lock of the transaction. An entry failing does not prevent the others
+        from being replayed, and the replay is not journaled again.
+
+            :return int: the number of entries applied
+        """
+        self.env.cr.execute(
+            "SELECT id, payload FROM payment_payhere_journal WHERE id IN %s ORDER BY date, id", (tuple(self.ids),))
+        replayed = 0
+        for entry_id, payload in self.env.cr.fetchall():
+            try:
+                with self.env.cr.savepoint():
+                    if self.env['payment.transaction'].sudo()._payhere_validate_data(self._decompress(payload)):
+                        replayed += 1
+            except Exception as e:
+                _logger.warning('Payhere: unable to replay journal entry %s: %s', entry_id, e)
+        _logger.info('Payhere: replayed %s of %s journal entries', replayed, len(self))
+        return replayed
+
+    # --------------------------------------------------
+    # PARTITIONS AND RETENTION
+    # --------------------------------------------------
+
+    @api.model
+    def _ensure_partitions(self, months=2):
+        """ Create the partitions of the current month and of the following
+        ones, so that the entries never land in the default partition. """
+        start = date.today().replace(day=1)
+        for index in range(months):
+            month = start + relativedelta(months=index)
+            name = 'payment_payhere_journal_y%04dm%02d' % (month.year, month.month)
+            self.env.cr.execute("SELECT to_regclass(%s)", (name,))
+            if self.env.cr.fetchone()[0]:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute(
+                        'CREATE TABLE "%s" PARTITION OF payment_payhere_journal FOR VALUES FROM (%%s) TO (%%s)' % name,
+                        (month, month + relativedelta(months=1)))
+            except psycopg2.Error as e:
+                _logger.warning('Payhere: unable to create the journal partition %s: %s', name, e)
+
+    @api.model
+    def _get_partitions(self):
+        """ :return list: (name, first day of the month) of the monthly
+                          partitions """
+        self.env.cr.execute("""
+            SELECT child.relname FROM pg_inherits
+              JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+              JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+             WHERE parent.relname = 'payment_payhere_journal'
+        """)
+        partitions = []
+        for name, in self.env.cr.fetchall():
+            match = PARTITION_PATTERN.match(name)
+            if match:
+                partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    @api.model
+    def _cron_retention(self):
+        """ Create the partitions of the coming month, and drop the partitions
+        older than ``payment_payhere.journal_retention_months`` months. When
+        ``payment_payhere.journal_archive_dir`` is set, every partition is
+        exported there as a gzipped CSV file before being dropped. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        retention = int(ICP.get_param('payment_payhere.journal_retention_months', 24))
+        archive_dir = ICP.get_param('payment_payhere.journal_archive_dir')
+        self._ensure_partitions()
+        cutoff = date.today().replace(day=1) - relativedelta(months=retention)
+        for name, month in self._get_partitions():
+            if month >= cutoff:
+                continue
+            if archive_dir:
+                self._export_partition(name, archive_dir)
+            self.env.cr.execute('DROP TABLE "%s"' % name)
+            _logger.info('Payhere: dropped the journal partition %s', name)
+        self.env.cr.execute(
+            "DELETE FROM payment_payhere_journal_default WHERE date < %s", (cutoff,))
+
+    @api.model
+    def _export_partition(self, name, archive_dir):
+        path = os.path.join(archive_dir, self.env.cr.dbname)
+        os.makedirs(path, exist_ok=True)
+        with gzip.open(os.path.join(path, '%s.csv.gz' % name), 'wb') as archive:
+            self.env.cr.copy_expert("""
+                COPY (SELECT id, date, transaction_id, reference, payment_id, status_code, source, outcome,
+                             encode(payload, 'base64') AS payload
+                        FROM "%s" ORDER BY id) TO STDOUT WITH CSV HEADER
+            """ % name, archive)
@@ -0,0 +1,148 @@
+# coding: utf-8
+
+import contextlib
+import logging
+import pprint
+import threading
+import time
+import uuid
+
+# fields of the Payhere payloads holding customer data, never logged in clear
+PAYHERE_PII_FIELDS = frozenset([
+    'first_name', 'last_name', 'email', 'phone', 'address', 'city', 'state',
+    'country', 'zip', 'zip_code', 'delivery_address', 'delivery_city',
+    'delivery_country', 'custom_1', 'custom_2', 'card_holder_name', 'card_no',
+    'card_expiry', 'customer_token', 'md5sig', 'partner_address', 'partner_phone',
+    'partner_city', 'partner_email', 'partner_zip', 'partner_first_name',
+    'partner_last_name', 'partner_name', 'partner_country', 'partner_state',
+    'partner_lang', 'partner', 'billing_partner', 'billing_partner_address',
+    'billing_partner_phone', 'billing_partner_city', 'billing_partner_email',
+    'billing_partner_zip', 'billing_partner_first_name', 'billing_partner_last_name',
+    'billing_partner_name', 'billing_partner_country', 'billing_partner_state',
+])
+
+_local = threading.local()
+
+
+def redact(data):
+    """ Return a copy of a payload with the customer data masked. """
+    return {
+        key: '***' if key in PAYHERE_PII_FIELDS and value else value
+        for key, value in (data or {}).items()
+    }
+
+
+class redacted(object):
+    """ Lazy, redacted representation of a payload: it is only redacted and
+    pretty-printed if the logger actually emits the record, e.g.::
+
+        _logger.debug('Payhere IPN data %s', redacted(post))
+    """
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pprint.pformat(redact(self.data))
+
+
+class SampledLogger(object):
+    """ Logger wrapper letting through at most ``burst`` records per key and
+    per ``interval`` seconds; the number of records dropped is reported with
+    the first record of the next interval. """
+
+    def __init__(self, logger, burst=10, interval=60):
+        self.logger = logger
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def log(self, level, key, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            start, count, dropped = self._windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.burst:
+                self._windows[key] = (start, count, dropped + 1)
+                return
+            self._windows[key] = (start, count + 1, 0)
+        if dropped:
+            msg += ' (%s similar messages suppressed)'
+            args += (dropped,)
+        self.logger.log(level, msg, *args)
+
+    def info(self, key, msg, *args):
+        self.log(logging.INFO, key, msg, *args)
+
+    def warning(self, key, msg, *args):
+        self.log(logging.WARNING, key, msg, *args)
+
+
+class NotificationTrace(object):
+    """ Stage timings of the processing of one notification, reported as a
+    single compact record by ``emit``.
+
+        The trace being processed is available to the code it calls through
+        ``NotificationTrace.current()``, so that nested steps (e.g. the state
+        transition run by ``form_feedback``) can be timed with ``stage``.
+    """
+
+    def __init__(self, data, correlation_id=None):
+        self.correlation_id = correlation_id or data.get('payment_id') or uuid.uuid4().hex[:12]
+        self.reference = data.get('order_id')
+        self.status_code = data.get('status_code')
+        self.acquirer_id = None
+        self.transaction_id = None
+        self.timings = {}
+        self.outcome = None
+        self._start = time.monotonic()
+        self._previous = None
+
+    @staticmethod
+    def current():
+        return getattr(_local, 'trace', None)
+
+    def __enter__(self):
+        self._previous = NotificationTrace.current()
+        _local.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.trace = self._previous
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.monotonic() - start
+
+    @property
+    def duration(self):
+        return time.monotonic() - self._start
+
+    def emit(self, logger, outcome, level=logging.INFO):
+        self.outcome = outcome
+        if not logger.isEnabledFor(level):
+            return
+        logger.log(
+            level, 'Payhere notification cid=%s reference=%s status=%s outcome=%s total=%.1fms %s',
+            self.correlation_id, self.reference, self.status_code, outcome, self.duration * 1000,
+            ' '.join('%s=%.1fms' % (name, timing * 1000) for name, timing in self.timings.items()))
+
+
+@contextlib.contextmanager
+def trace_stage(name):
+    """ Time a stage of the notification being processed, if any. """
+    trace = NotificationTrace.current()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
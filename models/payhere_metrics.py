@@ -0,0 +1,131 @@
+# coding: utf-8
+
+import os
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+class Counter(object):
+    """ Monotonic counter, per set of label values. """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram(object):
+    """ Cumulative histogram with fixed buckets, per set of label values. """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labelnames)
+        with self._lock:
+            counts, count, total = self._values.get(key, ([0] * len(self.buckets), 0, 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, count + 1, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), count, total) for key, (counts, count, total) in self._values.items()}
+        for key, (counts, count, total) in sorted(values.items()):
+            labels = list(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield self.name + '_bucket', labels + [('le', repr(bound))], bucket_count
+            yield self.name + '_bucket', labels + [('le', '+Inf')], count
+            yield self.name + '_count', labels, count
+            yield self.name + '_sum', labels, total
+
+
+class Registry(object):
+    """ In-process registry of the Payhere metrics. Odoo workers are separate
+    processes: each one exposes its own metrics, labelled with its pid. """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, extra_samples=()):
+        """ Render the metrics in the Prometheus text exposition format.
+
+            :param extra_samples: (name, type, help, labels, value) tuples of
+                                  values sampled at render time, e.g. gauges;
+                                  the samples of a name must be consecutive
+        """
+        pid = ('pid', str(os.getpid()))
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels([pid] + labels), value))
+        described = set()
+        for name, kind, documentation, labels, value in extra_samples:
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, documentation))
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, _format_labels([pid] + list(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+notifications = registry.register(Counter(
+    'payhere_notifications_total', 'Payhere notifications processed, by status code and outcome.',
+    ('acquirer', 'status', 'outcome')))
+notification_duration = registry.register(Histogram(
+    'payhere_notification_duration_seconds', 'Time spent processing a Payhere notification, by status code and outcome.',
+    ('acquirer', 'status', 'outcome')))
+stage_duration = registry.register(Histogram(
+    'payhere_notification_stage_duration_seconds', 'Time spent in each stage of the processing of a Payhere notification.',
+    ('acquirer', 'stage')))
+inbox = registry.register(Counter(
+    'payhere_inbox_total', 'Payhere notifications received on the IPN route, by result.',
+    ('result',)))
+
+
+def observe_notification(trace):
+    """ Aggregate the timings and outcome of a ``NotificationTrace``. """
+    acquirer = trace.acquirer_id or ''
+    status = trace.status_code or ''
+    notifications.inc(acquirer=acquirer, status=status, outcome=trace.outcome)
+    notification_duration.observe(trace.duration, acquirer=acquirer, status=status, outcome=trace.outcome)
+    for stage, timing in trace.timings.items():
+        stage_duration.observe(timing, acquirer=acquirer, stage=stage)
@@ -0,0 +1,246 @@
+# coding: utf-8
+
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import api, fields, models
+from odoo.addons.payment_payhere.models.payment import PayhereTransactionLocked
+from odoo.addons.payment_payhere.models.payhere_logging import NotificationTrace, SampledLogger
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable
+
+_logger = logging.getLogger(__name__)
+_sampled_logger = SampledLogger(_logger)
+
+
+class PayhereNotification(models.Model):
+    """ Durable inbox of the notifications posted by Payhere on the IPN route.
+
+        The route only stores the raw payload and acknowledges it; the
+        ``_cron_process_queue`` cron validates and applies the queued
+        notifications in batches, outside of the HTTP workers.
+    """
+    _name = 'payment.payhere.notification'
+    _inherit = 'payment.payhere.batch.mixin'
+    _description = 'Payhere Notification'
+    _order = 'id'
+    _payhere_claim_where = """
+        state = 'queued'
+        AND (date_next_attempt IS NULL OR date_next_attempt <= now() at time zone 'UTC')
+    """
+
+    reference = fields.Char('Order Reference', readonly=True, index=True)
+    payload = fields.Text('Payload', required=True, readonly=True)
+    fingerprint = fields.Char(
+        'Fingerprint', readonly=True,
+        help='payment_id, status_code and amount of the notification, used to discard the duplicates.')
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('done', 'Done'),
+        ('error', 'Error')], string='Status', default='queued', required=True, readonly=True, index=True)
+    state_message = fields.Text('Message', readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    date_next_attempt = fields.Datetime('Next Attempt', readonly=True)
+    date_processed = fields.Datetime('Processed On', readonly=True)
+
+    _sql_constraints = [
+        ('fingerprint_uniq', 'unique(fingerprint)', 'A notification with the same fingerprint was already received.'),
+    ]
+
+    # --------------------------------------------------
+    # INBOX
+    # --------------------------------------------------
+
+    @api.model
+    def _is_inbox_full(self):
+        """ Backpressure: tell whether the number of queued notifications
+        reached ``payment_payhere.queue_max_size``. The count is bounded so
+        that it stays cheap on a large backlog. """
+        max_size = int(self._payhere_get_param('queue_max_size', 50000))
+        if max_size <= 0:
+            return False
+        self.env.cr.execute("""
+            SELECT count(*) FROM (
+                SELECT 1 FROM payment_payhere_notification WHERE state = 'queued' LIMIT %s
+            ) AS queued
+        """, (max_size,))
+        return self.env.cr.fetchone()[0] >= max_size
+
+    @api.model
+    def _get_fingerprint(self, data):
+        """ Identify a notification by its payment_id, status_code and amount;
+        Payhere retries send the exact same values. Only the notifications
+        signed by their merchant are identified: an unsigned one must not
+        claim the fingerprint of the genuine notification, which would then
+        be discarded as its duplicate. """
+        if not data.get('payment_id') or not data.get('status_code'):
+            return None
+        acquirer = self.env['payment.acquirer'].sudo()._payhere_get_merchant(data.get('merchant_id'))
+        if not acquirer or not acquirer._payhere_check_md5sig(data):
+            return None
+        return '%s:%s:%s' % (data['payment_id'], data['status_code'], data.get('payhere_amount', ''))
+
+    @api.model
+    def _enqueue(self, data, fingerprint=None, delay=0, source=None):
+        """ Store a raw Payhere notification in the inbox.
+
+            Exact duplicates of a queued or processed notification are
+            discarded by the unique index on the fingerprint, without any ORM
+            work; a duplicate of a notification that failed is queued again.
+
+            :param dict data: the notification payload as posted by Payhere
+            :param str fingerprint: overrides the fingerprint computed from
+                                    the payload
+            :param int delay: seconds before the notification may be processed
+            :param str source: also append the notification, duplicates
+                               included, to ``payment.payhere.journal`` under
+                               this source, with its transaction, in the same
+                               statement
+            :return int: the id of the queued notification, or None if it was
+                         a duplicate
+        """
+        params = [data.get('order_id'), json.dumps(data), fingerprint or self._get_fingerprint(data),
+                  delay, delay, self.env.uid, self.env.uid]
+        journal = ''
+        if source:
+            journal = """,
+            journaled AS (
+                INSERT INTO payment_payhere_journal
+                    (transaction_id, reference, payment_id, status_code, source, outcome, payload)
+                SELECT (SELECT id FROM payment_transaction WHERE reference = %s), %s, %s, %s, %s,
+                       CASE WHEN EXISTS (SELECT 1 FROM queued) THEN 'queued' ELSE 'duplicate' END, %s
+            )"""
+            params += [data.get('order_id'), data.get('order_id'), data.get('payment_id'), data.get('status_code'), source,
+                       psycopg2.Binary(self.env['payment.payhere.journal']._compress(data))]
+        self.env.cr.execute("""
+            WITH queued AS (
+                INSERT INTO payment_payhere_notification
+                    (reference, payload, fingerprint, state, attempts, date_next_attempt,
+                     create_uid, create_date, write_uid, write_date)
+                VALUES (%s, %s, %s, 'queued', 0,
+                        CASE WHEN %s > 0 THEN now() at time zone 'UTC' + interval '1 second' * %s END,
+                        %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (fingerprint) DO UPDATE
+                    SET state = 'queued', attempts = 0, date_next_attempt = EXCLUDED.date_next_attempt,
+                        payload = EXCLUDED.payload, write_date = EXCLUDED.write_date
+                  WHERE payment_payhere_notification.state = 'error'
+                RETURNING id
+            ){journal}
+            SELECT id FROM queued
+        """.format(journal=journal), params)
+        row = self.env.cr.fetchone()
+        if not row:
+            _sampled_logger.info('duplicate', 'Payhere: discarding duplicate notification for %s', data.get('order_id'))
+        return row and row[0]
+
+    @api.model
+    def _enqueue_status_check(self, reference):
+        """ Queue a check of the status of a transaction on Payhere, e.g. when
+        the customer is back from Payhere before the IPN. The check waits
+        ``payment_payhere.status_check_delay`` seconds so that the IPN usually
+        settles the transaction first, and is queued once per reference.
+
+            :return int: the id of the queued check, or None if one was
+                         already queued for the reference
+        """
+        return self._enqueue(
+            {'order_id': reference, 'status_check': True},
+            fingerprint='check:%s' % reference,
+            delay=int(self._payhere_get_param('status_check_delay', 60)))
+
+    # --------------------------------------------------
+    # QUEUE PROCESSING
+    # --------------------------------------------------
+
+    @api.model
+    def _cron_process_queue(self):
+        """ Drain the inbox in batches of ``payment_payhere.queue_batch_size``
+        notifications, with ``payment_payhere.queue_workers`` batches processed
+        concurrently, until the queue is empty or the run exceeds
+        ``payment_payhere.queue_time_budget`` seconds. """
+        batch_size = int(self._payhere_get_param('queue_batch_size', 100))
+        workers = max(1, int(self._payhere_get_param('queue_workers', 1)))
+        deadline = time.monotonic() + int(self._payhere_get_param('queue_time_budget', 240))
+        auto_commit = self._payhere_auto_commit()
+
+        processed = 0
+        while time.monotonic() < deadline:
+            if workers == 1 or not auto_commit:
+                count = self._process_batch(batch_size, auto_commit=auto_commit)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    count = sum(executor.map(self._process_batch_in_new_cursor, [batch_size] * workers))
+            processed += count
+            if not count:
+                break
+        _logger.info('Payhere: processed %s queued notifications', processed)
+        return processed
+
+    def _process_batch_in_new_cursor(self, limit):
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            return env[self._name]._process_batch(limit)
+
+    @api.model
+    def _process_batch(self, limit, auto_commit=False):
+        """ Claim and process up to ``limit`` queued notifications. Rows are
+        claimed with ``SKIP LOCKED`` so that concurrent workers never process
+        the same notification.
+
+            :return int: the number of notifications processed
+        """
+        notifications = self._payhere_claim(limit)
+        if notifications:
+            notifications._process()
+            if auto_commit:
+                self.env.cr.commit()
+        return len(notifications)
+
+    def _process(self):
+        max_attempts = int(self._payhere_get_param('queue_max_attempts', 5))
+        now = fields.Datetime.now()
+        done = self.browse()
+        for notification in self:
+            try:
+                with self.env.cr.savepoint():
+                    data = json.loads(notification.payload)
+                    if data.get('status_check'):
+                        self.env['payment.transaction'].sudo()._payhere_check_status(data['order_id'])
+                    else:
+                        trace = NotificationTrace(data, correlation_id='n%s' % notification.id)
+                        self.env['payment.transaction'].sudo()._payhere_validate_data(data, trace=trace)
+            except (PayhereUnavailable, PayhereTransactionLocked) as e:
+                # Payhere is unhealthy, or another handler is updating the
+                # transaction: defer the notification without consuming one
+                # of its attempts
+                _logger.info('Payhere: deferring notification %s: %s', notification.id, e)
+                notification.write({
+                    'state_message': str(e),
+                    'date_next_attempt': now + timedelta(minutes=1),
+                })
+            except Exception as e:
+                _logger.exception('Payhere: unable to process notification %s', notification.id)
+                attempts = notification.attempts + 1
+                notification.write({
+                    'state': 'queued' if attempts < max_attempts else 'error',
+                    'state_message': str(e),
+                    'attempts': attempts,
+                    'date_next_attempt': now + timedelta(minutes=attempts ** 2),
+                })
+            else:
+                done |= notification
+        done.write({'state': 'done', 'date_processed': now, 'state_message': False})
+
+    @api.model
+    def _cron_garbage_collect(self):
+        """ Remove the processed notifications older than
+        ``payment_payhere.queue_retention_days`` days. """
+        days = int(self._payhere_get_param('queue_retention_days', 30))
+        self.env.cr.execute("""
+            DELETE FROM payment_payhere_notification
+             WHERE state = 'done' AND date_processed < now() at time zone 'UTC' - interval '1 day' * %s
+        """, (days,))
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+import logging
+import time
+
+from odoo import api, fields, models, _
+from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable, TokenBucket
+
+_logger = logging.getLogger(__name__)
+
+
+class PayhereRefund(models.Model):
+    """ Refund of a Payhere payment, queued by
+    ``payment.transaction.payhere_refund``.
+
+        The ``_cron_process_refunds`` cron sends the queued refunds in
+        batches, with a bounded number of concurrent, rate-limited calls on
+        one authenticated session, and writes the results back with one write
+        per outcome. The state of each refund is committed before its call: a
+        run interrupted after the call checks the payment on Payhere instead
+        of refunding it twice.
+    """
+    _name = 'payment.payhere.refund'
+    _inherit = 'payment.payhere.batch.mixin'
+    _description = 'Payhere Refund'
+    _order = 'id'
+    _payhere_claim_where = """
+        state = 'queued'
+        OR (state = 'processing' AND write_date < now() at time zone 'UTC' - interval '5 minutes')
+    """
+
+    transaction_id = fields.Many2one(
+        'payment.transaction', 'Transaction', required=True, readonly=True, index=True, ondelete='cascade')
+    acquirer_id = fields.Many2one(related='transaction_id.acquirer_id', store=True)
+    currency_id = fields.Many2one(related='transaction_id.currency_id')
+    amount = fields.Monetary('Amount', readonly=True, help='Amount of a partial refund; the whole payment if empty.')
+    reason = fields.Char('Reason', required=True, readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('done', 'Refunded'),
+        ('failed', 'Failed')], string='Status', default='queued', required=True, readonly=True, index=True)
+    state_message = fields.Text('Message', readonly=True)
+    payhere_refund_id = fields.Char('Payhere Refund ID', readonly=True)
+    date_processed = fields.Datetime('Processed On', readonly=True)
+
+    @api.model
+    def _cron_process_refunds(self):
+        """ Send the queued refunds in batches of
+        ``payment_payhere.refund_batch_size``, with at most
+        ``payment_payhere.refund_workers`` concurrent calls and
+        ``payment_payhere.refund_rate`` calls per second, until none is left
+        or the run exceeds ``payment_payhere.refund_time_budget`` seconds. """
+        batch_size = int(self._payhere_get_param('refund_batch_size', 100))
+        workers = int(self._payhere_get_param('refund_workers', 4))
+        limiter = TokenBucket(self._payhere_get_param('refund_rate', 5))
+        deadline = time.monotonic() + self._payhere_get_param('refund_time_budget', 240)
+        auto_commit = self._payhere_auto_commit()
+
+        processed = 0
+        while time.monotonic() < deadline:
+            refunds = self._payhere_claim(batch_size)
+            if not refunds:
+                break
+            refunds._process(workers, limiter, auto_commit)
+            processed += len(refunds)
+            if auto_commit:
+                self.env.cr.commit()
+        _logger.info('Payhere: processed %s refunds', processed)
+        return processed
+
+    def _get_payload(self):
+        self.ensure_one()
+        payload = {
+            'payment_id': self.transaction_id.acquirer_reference,
+            'description': self.reason,
+        }
+        if self.amount:
+            payload['amount'] = self.amount
+        return payload
+
+    def _process(self, workers, limiter, auto_commit=True):
+        """ Send a batch of refunds: check the refunds of an interrupted run on
+        Payhere, commit the processing state, then call the Refund API and
+        write the results in bulk. """
+        results = {}
+        interrupted = self.filtered(lambda refund: refund.state == 'processing')
+        to_refund = self - interrupted
+        for acquirer, refunds in interrupted._payhere_group_by_acquirer():
+            try:
+                payments = acquirer._payhere_retrieve_payments_batch(
+                    refunds.mapped('transaction_id.reference'), workers)
+            except (PayhereUnavailable, ValidationError) as e:
+                _logger.warning('Payhere: unable to check the refunds of acquirer %s: %s', acquirer.id, e)
+                continue
+            for refund in refunds:
+                tx_payments = payments.get(refund.transaction_id.reference)
+                if tx_payments is None:
+                    continue
+                if not any(payment.get('status', '').startswith('REFUND') for payment in tx_payments):
+                    # not refunded by the interrupted run
+                    to_refund |= refund
+                elif not (refund.transaction_id.payhere_refund_ids - refund).filtered(
+                        lambda other: other.state in ('processing', 'done')):
+                    results[refund.id] = {'accepted': True, 'refund_id': None, 'message': ''}
+                else:
+                    # Payhere tells that the payment was refunded, not by which
+                    # of its refunds: never send this one again
+                    results[refund.id] = {'accepted': False, 'refund_id': None, 'message': _(
+                        'The refund was interrupted and the payment has other refunds: '
+                        'check on Payhere whether it went through.')}
+
+        to_refund.write({'state': 'processing'})
+        if auto_commit:
+            self.env.cr.commit()
+
+        for acquirer, refunds in to_refund._payhere_group_by_acquirer():
+            try:
+                by_refund = acquirer._payhere_refund_batch(
+                    {refund.id: refund._get_payload() for refund in refunds}, workers, limiter)
+            except (PayhereUnavailable, ValidationError) as e:
+                _logger.warning('Payhere: refunds skipped for acquirer %s: %s', acquirer.id, e)
+                continue
+            for refund_id, result in by_refund.items():
+                if result is not None:
+                    results[refund_id] = result
+        self._write_results(results)
+
+    def _write_results(self, results):
+        """ Write the results of the refunds with one write per outcome, and
+        the refund ids of Payhere with a single UPDATE; the refunds without
+        result stay processing and are checked next run. """
+        now = fields.Datetime.now()
+        done, refund_ids, failed = self.browse(), {}, {}
+        for refund_id, result in results.items():
+            if result['accepted']:
+                done |= self.browse(refund_id)
+                if result['refund_id']:
+                    refund_ids[refund_id] = str(result['refund_id'])
+            else:
+                message = result['message'] or _('Payhere refused the refund.')
+                failed.setdefault(message, self.browse())
+                failed[message] |= self.browse(refund_id)
+        done.write({'state': 'done', 'state_message': False, 'date_processed': now})
+        for message, refunds in failed.items():
+            refunds.write({'state': 'failed', 'state_message': message, 'date_processed': now})
+        if refund_ids:
+            self.env.cr.execute("""
+                UPDATE payment_payhere_refund AS refund
+                   SET payhere_refund_id = value.refund_id
+                  FROM (SELECT unnest(%s::int[]) AS id, unnest(%s::varchar[]) AS refund_id) AS value
+                 WHERE refund.id = value.id
+            """, (list(refund_ids), list(refund_ids.values())))
+            self.browse(list(refund_ids)).invalidate_cache(['payhere_refund_id'])
@@ -0,0 +1,269 @@
+# coding: utf-8
+
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug import urls
+
+_logger = logging.getLogger(__name__)
+
+
+class PayhereUnavailable(Exception):
+    """ Raised when Payhere could not be reached, or when the circuit breaker
+    of its host is open. The work should be deferred and retried later. """
+
+
+class CircuitBreaker(object):
+    """ Per-host circuit breaker.
+
+        After ``failure_threshold`` consecutive failures the circuit opens and
+        every call fails fast for ``reset_timeout`` seconds; then a single
+        probe call is let through (half-open) and closes the circuit if it
+        succeeds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    _logger.warning('Payhere: opening circuit breaker after %s failures', self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket: at most ``rate`` calls per second on
+    average, in bursts of at most ``capacity`` calls. A rate of 0 disables
+    the limit. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a call is allowed. """
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class PayhereClient(object):
+    """ Shared HTTP client for every outbound call to Payhere.
+
+        One pooled ``requests.Session`` is kept per process (the Odoo workers
+        are forked, sessions must not be shared across processes), every call
+        has connect and read timeouts, failures are retried a bounded number
+        of times with jittered exponential backoff, and a circuit breaker per
+        host fails fast while Payhere is unhealthy.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=10, timeout=(3.05, 10), max_retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._pid = None
+        self._session = None
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ('requests', 'responses', 'failures', 'retries', 'short_circuits', 'in_flight'), 0)
+
+    # --------------------------------------------------
+    # SESSION
+    # --------------------------------------------------
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def _get_breaker(self, url):
+        host = urls.url_parse(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[host]
+
+    def _incr(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] += value
+
+    # --------------------------------------------------
+    # REQUESTS
+    # --------------------------------------------------
+
+    def request(self, method, url, timeout=None, retry=True, **kwargs):
+        """ Perform an HTTP request to Payhere.
+
+            :param str method: the HTTP method
+            :param str url: the absolute url to call
+            :param timeout: a (connect, read) tuple overriding the default
+            :param bool retry: whether the call may be retried; only set it
+                               for idempotent calls
+            :return: the ``requests.Response``, whatever its status
+            :raise PayhereUnavailable: if the circuit is open or Payhere could
+                                       not be reached after the retries
+        """
+        breaker = self._get_breaker(url)
+        attempts = 1 + (self.max_retries if retry else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self._incr('short_circuits')
+                raise PayhereUnavailable('Payhere circuit is open for %s' % url)
+            if attempt:
+                self._incr('retries')
+                # full jitter: sleep a random time up to the exponential backoff
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            self._incr('requests')
+            self._incr('in_flight')
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                _logger.warning('Payhere: %s %s failed: %s', method, url, e)
+                self._incr('failures')
+                breaker.record_failure()
+                error = e
+                continue
+            finally:
+                self._incr('in_flight', -1)
+            self._incr('responses')
+            if response.status_code in self.RETRY_STATUSES:
+                self._incr('failures')
+                breaker.record_failure()
+                error = None
+                if attempt + 1 < attempts:
+                    continue
+                return response
+            breaker.record_success()
+            return response
+        raise PayhereUnavailable('Payhere could not be reached at %s: %s' % (url, error))
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    # --------------------------------------------------
+    # MONITORING
+    # --------------------------------------------------
+
+    def get_stats(self):
+        """ Return the counters of the client, the usage of its connection
+        pools and the state of its circuit breakers. """
+        with self._lock:
+            stats = dict(self._counters)
+            breakers = dict(self._breakers)
+            session = self._session if self._pid == os.getpid() else None
+        stats['breakers'] = {
+            host: {'state': breaker.state, 'failures': breaker.failures}
+            for host, breaker in breakers.items()
+        }
+        pools = {}
+        if session is not None:
+            for adapter in set(session.adapters.values()):
+                poolmanager = getattr(adapter, 'poolmanager', None)
+                if poolmanager is None:
+                    # not pooled, e.g. a transport mounted by the tests
+                    continue
+                for key in poolmanager.pools.keys():
+                    pool = poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    pools[pool.host] = {
+                        'connections': pool.num_connections,
+                        'requests': pool.num_requests,
+                        'idle': pool.pool.qsize() if pool.pool else 0,
+                        'maxsize': self.pool_size,
+                    }
+        stats['pools'] = pools
+        return stats
+
+
+# one client per process, shared by the controllers and the models
+payhere_client = PayhereClient()
+
+
+class TokenCache(object):
+    """ Thread-safe, per-process cache of OAuth access tokens.
+
+        Entries are keyed on (database, acquirer, environment) and considered
+        stale ``margin`` seconds before they actually expire, so that tokens
+        are refreshed before Payhere starts rejecting them. A lock per key
+        makes concurrent threads wait for a single refresh.
+    """
+
+    def __init__(self, margin=60):
+        self.margin = margin
+        self._tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        token, expiry = self._tokens.get(key, (None, 0))
+        if token and expiry - self.margin > time.time():
+            return token
+        return None
+
+    def set(self, key, token, expiry):
+        self._tokens[key] = (token, expiry)
+
+    def invalidate(self, key):
+        self._tokens.pop(key, None)
+
+    def lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+payhere_token_cache = TokenCache()
@@ -0,0 +1,228 @@
+# coding: utf-8
+
+import base64
+import csv
+import io
+import itertools
+import logging
+import time
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.addons.payment_payhere.models.payment import PAYHERE_RETRIEVAL_STATUS
+
+_logger = logging.getLogger(__name__)
+
+# accepted headers of the settlement exports, normalized (lowercase, spaces as
+# underscores), per column of the settlement rows
+PAYHERE_SETTLEMENT_COLUMNS = {
+    'order_id': ('order_id', 'order_no', 'reference'),
+    'payment_id': ('payment_id', 'payment_no', 'transaction_id'),
+    'amount': ('amount', 'gross_amount', 'payhere_amount'),
+    'currency': ('currency', 'payhere_currency'),
+    'handling_amount': ('handling_amount', 'handling'),
+    'status': ('status', 'payment_status'),
+}
+
+
+# states of a transaction consistent with the status of its payment
+PAYHERE_SETTLEMENT_STATES = {
+    2: ('done',),
+    0: ('draft', 'pending'),
+    -1: ('cancel', 'error'),
+    -2: ('cancel', 'error'),
+    -3: ('cancel', 'error'),
+}
+
+
+class PayhereSettlement(models.Model):
+    """ Import of a Payhere settlement export, reconciled with the
+    transactions.
+
+        The file is streamed row by row by the ``_cron_process_settlements``
+        cron, in chunks matched with one indexed search each. Every row is
+        checked with the rules of ``_payhere_form_get_invalid_parameters``;
+        mismatches, and states disagreeing with the status of the payment,
+        are recorded as discrepancy lines and, if requested, the states of
+        the received payments are corrected in bulk; the other states are
+        left to be reviewed. An import interrupted by the time budget resumes
+        where it stopped.
+    """
+    _name = 'payment.payhere.settlement'
+    _inherit = 'payment.payhere.batch.mixin'
+    _description = 'Payhere Settlement Import'
+    _order = 'id desc'
+
+    name = fields.Char('Name', required=True, default=lambda self: _('Settlement of %s') % fields.Date.today())
+    acquirer_id = fields.Many2one(
+        'payment.acquirer', 'Acquirer', required=True, domain=[('provider', '=', 'payhere')])
+    settlement_file = fields.Binary('Settlement File', attachment=True, required=True)
+    settlement_filename = fields.Char('File Name')
+    apply_corrections = fields.Boolean(
+        'Apply Corrections', help='Confirm the transactions of the payments received by Payhere.')
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('queued', 'Queued'),
+        ('done', 'Done')], string='Status', default='draft', required=True, readonly=True)
+    rows_processed = fields.Integer('Rows Processed', readonly=True)
+    rows_matched = fields.Integer('Rows Matched', readonly=True)
+    rows_corrected = fields.Integer('Transactions Corrected', readonly=True)
+    line_ids = fields.One2many('payment.payhere.settlement.line', 'settlement_id', 'Discrepancies', readonly=True)
+    discrepancy_count = fields.Integer('Discrepancies', compute='_compute_discrepancy_count')
+
+    def _compute_discrepancy_count(self):
+        data = self.env['payment.payhere.settlement.line'].read_group(
+            [('settlement_id', 'in', self.ids)], ['settlement_id'], ['settlement_id'])
+        counts = {item['settlement_id'][0]: item['settlement_id_count'] for item in data}
+        for settlement in self:
+            settlement.discrepancy_count = counts.get(settlement.id, 0)
+
+    def action_queue(self):
+        self.filtered(lambda settlement: settlement.state == 'draft').write({'state': 'queued'})
+
+    # --------------------------------------------------
+    # IMPORT
+    # --------------------------------------------------
+
+    @api.model
+    def _cron_process_settlements(self):
+        """ Process the queued imports for at most
+        ``payment_payhere.settlement_time_budget`` seconds. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        deadline = time.monotonic() + int(ICP.get_param('payment_payhere.settlement_time_budget', 240))
+        chunk_size = int(ICP.get_param('payment_payhere.settlement_chunk_size', 1000))
+        for settlement in self.search([('state', '=', 'queued')], order='id'):
+            if not settlement._process(deadline, chunk_size):
+                break
+
+    def _open_file(self):
+        """ Open the settlement file as a binary stream, from the filestore when
+        possible so that it is never loaded in memory at once. """
+        self.ensure_one()
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_field', '=', 'settlement_file'),
+            ('res_id', '=', self.id),
+        ], limit=1)
+        if not attachment:
+            raise UserError(_('The settlement file of %s is missing.') % self.name)
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), 'rb')
+        return io.BytesIO(base64.b64decode(attachment.datas))
+
+    @api.model
+    def _normalize_row(self, row):
+        normalized = {(key or '').strip().lower().replace(' ', '_'): (value or '').strip() for key, value in row.items()}
+        return {
+            column: next((normalized[header] for header in headers if normalized.get(header)), '')
+            for column, headers in PAYHERE_SETTLEMENT_COLUMNS.items()
+        }
+
+    def _process(self, deadline, chunk_size=1000):
+        """ Stream the file from the first row not processed yet.
+
+            :return bool: whether the import completed within the deadline
+        """
+        self.ensure_one()
+        auto_commit = self._payhere_auto_commit()
+        with self._open_file() as binary:
+            reader = csv.DictReader(io.TextIOWrapper(binary, encoding='utf-8-sig', newline=''))
+            rows = itertools.islice(reader, self.rows_processed, None)
+            while True:
+                if time.monotonic() >= deadline:
+                    return False
+                chunk = [self._normalize_row(row) for row in itertools.islice(rows, chunk_size)]
+                if not chunk:
+                    break
+                self._process_chunk(chunk)
+                if auto_commit:
+                    self.env.cr.commit()
+        self.state = 'done'
+        _logger.info('Payhere: settlement %s imported, %s rows, %s discrepancies',
+                     self.id, self.rows_processed, self.discrepancy_count)
+        return True
+
+    def _process_chunk(self, rows):
+        """ Match a chunk of rows with their transactions in one search, on the
+        indexed reference and acquirer_reference, and record the
+        discrepancies. """
+        Transaction = self.env['payment.transaction'].sudo()
+        references = [row['order_id'] for row in rows if row['order_id']]
+        payment_ids = [row['payment_id'] for row in rows if row['payment_id']]
+        txs = Transaction.search([
+            ('acquirer_id', '=', self.acquirer_id.id),
+            '|', ('reference', 'in', references), ('acquirer_reference', 'in', payment_ids),
+        ])
+        by_reference = {tx.reference: tx for tx in txs}
+        by_payment_id = {tx.acquirer_reference: tx for tx in txs if tx.acquirer_reference}
+
+        lines, to_confirm, payment_values, matched = [], Transaction, {}, 0
+        for row in rows:
+            tx = by_reference.get(row['order_id']) or by_payment_id.get(row['payment_id'])
+            line = {'settlement_id': self.id, 'reference': row['order_id'], 'payment_id': row['payment_id']}
+            if not tx:
+                lines.append(dict(line, kind='missing', received=row['amount']))
+                continue
+            matched += 1
+            line['transaction_id'] = tx.id
+            data = {
+                'payment_id': row['payment_id'],
+                'payhere_amount': row['amount'] or '0.0',
+                'payhere_currency': row['currency'],
+            }
+            if row['handling_amount']:
+                data['handling_amount'] = row['handling_amount']
+            # the rows carry no payer_id: the token check of the
+            # notifications does not apply to them
+            invalid_parameters = [
+                parameter for parameter in tx._payhere_form_get_invalid_parameters(data) if parameter[0] != 'payer_id']
+            for parameter, received, expected in invalid_parameters:
+                lines.append(dict(line, kind=parameter, received=str(received), expected=str(expected)))
+            status_code = PAYHERE_RETRIEVAL_STATUS.get((row['status'] or '').strip().upper())
+            if status_code is None:
+                # never confirm a payment on a status we do not know
+                lines.append(dict(line, kind='status', received=row['status'] or '', expected=tx.state))
+                continue
+            if tx.state not in PAYHERE_SETTLEMENT_STATES[status_code]:
+                # e.g. a payment received but not confirmed, or a confirmed
+                # payment canceled or charged back since
+                lines.append(dict(line, kind='state', received=row['status'], expected=tx.state))
+                if status_code != 2 or invalid_parameters:
+                    # never confirm a payment that does not match its transaction
+                    continue
+                to_confirm |= tx
+                if not tx.acquirer_reference and row['payment_id']:
+                    payment_values[tx.id] = (row['payment_id'], 'inbound')
+
+        corrected = 0
+        if self.apply_corrections and to_confirm:
+            # leave the transactions being handled concurrently to their handler
+            to_confirm = to_confirm._payhere_lock()
+            payment_values = {tx_id: values for tx_id, values in payment_values.items() if tx_id in to_confirm.ids}
+            Transaction._payhere_write_payment_ids(payment_values)
+            to_confirm._set_transaction_done()
+            confirmed = to_confirm.filtered(lambda tx: tx.state == 'done')
+            confirmed._payhere_notify_state()
+            corrected = len(confirmed)
+        self.env['payment.payhere.settlement.line'].create(lines)
+        self.write({
+            'rows_processed': self.rows_processed + len(rows),
+            'rows_matched': self.rows_matched + matched,
+            'rows_corrected': self.rows_corrected + corrected,
+        })
+
+
+class PayhereSettlementLine(models.Model):
+    _name = 'payment.payhere.settlement.line'
+    _description = 'Payhere Settlement Discrepancy'
+    _order = 'id'
+
+    settlement_id = fields.Many2one(
+        'payment.payhere.settlement', 'Settlement', required=True, ondelete='cascade', index=True)
+    transaction_id = fields.Many2one('payment.transaction', 'Transaction', ondelete='set null')
+    reference = fields.Char('Order Reference')
+    payment_id = fields.Char('Payment ID')
+    kind = fields.Char('Discrepancy', help='The parameter that does not match, missing when no transaction matches the row, '
+             'or status when the status of the row is unknown.')
+    received = fields.Char('In Settlement')
+    expected = fields.Char('In Odoo')
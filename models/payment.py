@@ -1,21 +1,51 @@
 # coding: utf-8
 
+import base64
+import hashlib
+import hmac
 import json
 import logging
-import pprint
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dateutil.parser
 import pytz
 from werkzeug import urls
 
-from odoo import api, fields, models, _
-from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError
+from odoo.addons.payment.models.payment_acquirer import ValidationError, _partner_split_name
 from odoo.addons.payment_payhere.controllers.main import PayhereController
-from odoo.tools.float_utils import float_compare
-from datetime import datetime
+from odoo.addons.payment_payhere.models import payhere_metrics
+from odoo.addons.payment_payhere.models.payhere_dispatch import PAYHERE_STATE_CHANNEL
+from odoo.addons.payment_payhere.models.payhere_logging import NotificationTrace, SampledLogger, redacted, trace_stage
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable, payhere_client, payhere_token_cache
+from odoo.tools.float_utils import float_compare, float_round
+from datetime import datetime, timedelta
 
 
 _logger = logging.getLogger(__name__)
+_sampled_logger = SampledLogger(_logger)
+
+# namespace of the advisory locks taken on the Payhere transactions
+PAYHERE_LOCK_NAMESPACE = 0x70617968  # 'payh'
+
+# status of the payments returned by the Retrieval API, as notification status codes
+PAYHERE_RETRIEVAL_STATUS = {
+    'RECEIVED': 2,
+    'REFUND REQUESTED': 2,
+    'REFUND PROCESSING': 2,
+    'REFUNDED': 2,
+    'PENDING': 0,
+    'CANCELED': -1,
+    'FAILED': -2,
+    'CHARGEBACKED': -3,
+}
+
+
+class PayhereTransactionLocked(Exception):
+    """ Raised when another handler is already applying a notification to
+    the same transaction; the notification should be applied later. """
 
 
 class AcquirerPayhere(models.Model):
@@ -27,7 +57,22 @@ class AcquirerPayhere(models.Model):
         'Merchant Account ID', groups='base.group_user',
         help='The Merchant ID is used to ensure communications coming from Payhere are valid and secured.')
     payhere_use_ipn = fields.Boolean('Use IPN', default=True, help='Payhere Instant Payment Notification', groups='base.group_user')
+    payhere_onsite = fields.Boolean(
+        'Onsite Checkout', groups='base.group_user',
+        help='Open the Payhere checkout in a popup of the website, with the JavaScript SDK, instead of redirecting the customer.')
     payhere_pdt_token = fields.Char(string='PDT Identity Token', help='Payment Data Transfer allows you to receive notification of successful payments as they are made.', groups='base.group_user')
+    payhere_merchant_secret = fields.Char(
+        'Merchant Secret', groups='base.group_user',
+        help='The Merchant Secret is used to verify the md5sig signature of the notifications sent by Payhere.')
+    payhere_app_id = fields.Char(
+        'App ID', groups='base.group_user',
+        help='Business App ID used to authenticate on the Payhere merchant APIs.')
+    payhere_app_secret = fields.Char('App Secret', groups='base.group_user')
+    payhere_invite_mail_date = fields.Datetime(
+        'Configuration Reminder Sent On', readonly=True, copy=False, groups='base.group_system',
+        help='Last time the merchant was invited to complete its Payhere credentials.')
+    payhere_access_token = fields.Char(groups='base.group_system', copy=False)
+    payhere_access_token_expiry = fields.Datetime(groups='base.group_system', copy=False)
     # Default payhere fees
     fees_dom_fixed = fields.Float(default=0.35)
     fees_dom_var = fields.Float(default=3.4)
@@ -47,6 +92,7 @@ class AcquirerPayhere(models.Model):
         """
         res = super(AcquirerPayhere, self)._get_feature_support()
         res['fees'].append('payhere')
+        res['tokenize'].append('payhere')
         return res
 
     @api.model
@@ -55,14 +101,209 @@ class AcquirerPayhere(models.Model):
         if environment == 'prod':
             return {
                 'payhere_form_url': 'https://www.payhere.lk/pay/checkout',
+                'payhere_preapprove_url': 'https://www.payhere.lk/pay/preapprove',
                 'payhere_rest_url': 'https://api.payhere.lk/v1/oauth2/token',
+                'payhere_retrieval_url': 'https://www.payhere.lk/merchant/v1/payment/search',
+                'payhere_charge_url': 'https://www.payhere.lk/merchant/v1/payment/charge',
+                'payhere_refund_url': 'https://www.payhere.lk/merchant/v1/payment/refund',
             }
         else:
             return {
                 'payhere_form_url': 'https://sandbox.payhere.lk/pay/checkout',
+                'payhere_preapprove_url': 'https://sandbox.payhere.lk/pay/preapprove',
                 'payhere_rest_url': 'https://api.sandbox.payhere.lk/v1/oauth2/token',
+                'payhere_retrieval_url': 'https://sandbox.payhere.lk/merchant/v1/payment/search',
+                'payhere_charge_url': 'https://sandbox.payhere.lk/merchant/v1/payment/charge',
+                'payhere_refund_url': 'https://sandbox.payhere.lk/merchant/v1/payment/refund',
             }
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        acquirers = super(AcquirerPayhere, self).create(vals_list)
+        if any(acquirer.provider == 'payhere' for acquirer in acquirers):
+            # a new merchant for the merchant index
+            self.clear_caches()
+        return acquirers
+
+    def unlink(self):
+        payhere = any(acquirer.provider == 'payhere' for acquirer in self)
+        res = super(AcquirerPayhere, self).unlink()
+        if payhere:
+            self.clear_caches()
+        return res
+
+    def write(self, vals):
+        if {'state', 'payhere_app_id', 'payhere_app_secret'} & set(vals):
+            # the access token belongs to the former environment/credentials
+            vals = dict(vals, payhere_access_token=False, payhere_access_token_expiry=False)
+            for acquirer in self:
+                for environment in ('prod', 'test'):
+                    payhere_token_cache.invalidate((self.env.cr.dbname, acquirer.id, environment))
+        res = super(AcquirerPayhere, self).write(vals)
+        if any(acquirer.provider == 'payhere' for acquirer in self) or vals.get('provider') == 'payhere':
+            # drop the merchant index, hashed secrets and checkout configurations
+            self.clear_caches()
+        return res
+
+    @tools.ormcache('self.id', 'base_url')
+    def _payhere_get_checkout_config(self, base_url):
+        """ Snapshot of everything the checkout payload needs from the
+        acquirer: merchant identity, company name, fee parameters and resolved
+        urls. It is shared by the requests of the worker and dropped when an
+        acquirer or a system parameter (e.g. ``web.base.url``) is written.
+
+            :param str base_url: the base url of the current request
+            :return dict: the configuration, made of plain values only
+        """
+        self.ensure_one()
+        acquirer = self.sudo()
+        payhere_urls = self._get_payhere_urls(acquirer._payhere_get_environment())
+        return {
+            'merchant_id': acquirer.payhere_email_account,
+            'company_name': acquirer.company_id.name,
+            'fees_active': acquirer.fees_active,
+            'form_url': payhere_urls['payhere_form_url'],
+            'preapprove_url': payhere_urls['payhere_preapprove_url'],
+            'return_url': urls.url_join(base_url, PayhereController._return_url),
+            'notify_url': urls.url_join(base_url, PayhereController._notify_url),
+            'cancel_url': urls.url_join(base_url, PayhereController._cancel_url),
+        }
+
+    @api.model
+    @tools.ormcache()
+    def _payhere_get_merchant_index(self):
+        """ Index of the active Payhere acquirers per merchant_id, shared by
+        the requests of the worker and dropped when an acquirer is written.
+        When the same merchant_id is used by several acquirers, the enabled
+        one wins over the one in test mode.
+
+            :return dict: (acquirer id, company id) per merchant_id
+        """
+        index = {}
+        acquirers = self.sudo().search([('provider', '=', 'payhere'), ('state', '!=', 'disabled')], order='state, id')
+        for acquirer in acquirers:
+            if acquirer.payhere_email_account:
+                index.setdefault(acquirer.payhere_email_account, (acquirer.id, acquirer.company_id.id))
+        return index
+
+    @api.model
+    def _payhere_get_merchant(self, merchant_id):
+        """ Resolve the acquirer of a notification from its merchant_id, in the
+        context of the company of the acquirer.
+
+            :return: the acquirer, or an empty recordset for an unknown
+                     merchant
+        """
+        entry = self._payhere_get_merchant_index().get(merchant_id or '')
+        if not entry:
+            return self.browse()
+        acquirer_id, company_id = entry
+        return self.with_context(force_company=company_id, allowed_company_ids=[company_id]).browse(acquirer_id)
+
+    @tools.ormcache('self.id')
+    def _payhere_get_accounts(self):
+        """ (seller account, email account) of the acquirer, as checked on
+        every notification. """
+        acquirer = self.sudo()
+        return acquirer.payhere_seller_account, acquirer.payhere_email_account
+
+    @tools.ormcache('self.id')
+    def _payhere_get_hashed_secret(self):
+        """ Return the uppercased md5 digest of the merchant secret, as it
+        enters in the md5sig computation, or None if no secret is set. """
+        secret = self.sudo().payhere_merchant_secret
+        if not secret:
+            return None
+        return hashlib.md5(secret.encode('utf-8')).hexdigest().upper()
+
+    def _payhere_compute_md5sig(self, data):
+        """ Compute the md5sig Payhere signs its notifications with:
+        upper(md5(merchant_id + order_id + payhere_amount + payhere_currency
+        + status_code + upper(md5(merchant_secret)))). """
+        self.ensure_one()
+        hashed_secret = self._payhere_get_hashed_secret()
+        if not hashed_secret:
+            return None
+        payload = ''.join(data.get(key) or '' for key in (
+            'merchant_id', 'order_id', 'payhere_amount', 'payhere_currency', 'status_code'))
+        return hashlib.md5((payload + hashed_secret).encode('utf-8')).hexdigest().upper()
+
+    def _payhere_check_md5sig(self, data):
+        """ Verify the md5sig of a notification, in constant time. """
+        self.ensure_one()
+        expected = self._payhere_compute_md5sig(data)
+        if not expected:
+            _logger.warning('Payhere: no merchant secret configured on acquirer %s, notification cannot be verified', self.id)
+            return False
+        return hmac.compare_digest(expected, (data.get('md5sig') or '').upper())
+
+    def _payhere_compute_checkout_hash(self, order_id, amount, currency):
+        """ Compute the hash the onsite checkout is signed with:
+        upper(md5(merchant_id + order_id + amount + currency
+        + upper(md5(merchant_secret)))), the amount with 2 decimals. """
+        self.ensure_one()
+        hashed_secret = self._payhere_get_hashed_secret()
+        if not hashed_secret:
+            return None
+        merchant_id = self._payhere_get_accounts()[1] or ''
+        payload = '%s%s%.2f%s' % (merchant_id, order_id, amount, currency)
+        return hashlib.md5((payload + hashed_secret).encode('utf-8')).hexdigest().upper()
+
+    @tools.ormcache('self.id')
+    def _payhere_get_invite_mail_body(self):
+        template = self.env.ref('payment_payhere.mail_template_payhere_invite_user_to_configure', False)
+        if not template:
+            return None
+        render_template = template.render({
+            'acquirer': self,
+        }, engine='ir.qweb')
+        return self.env['mail.thread']._replace_local_links(render_template)
+
+    def _payhere_queue_invite_mail(self):
+        """ Queue the mail inviting the merchant to complete its Payhere
+        credentials, at most once per ``payment_payhere.invite_mail_cooldown``
+        hours per acquirer. The mail is sent by the mail queue cron, and the
+        cooldown is claimed with ``SKIP LOCKED``, so that the notification
+        being processed never waits for SMTP nor for a concurrent one.
+
+            :return bool: whether a mail was queued
+        """
+        self.ensure_one()
+        cooldown = int(self.env['ir.config_parameter'].sudo().get_param('payment_payhere.invite_mail_cooldown', 24))
+        self.env.cr.execute("""
+            UPDATE payment_acquirer SET payhere_invite_mail_date = now() at time zone 'UTC'
+             WHERE id IN (
+                SELECT id FROM payment_acquirer
+                 WHERE id = %s
+                   AND (payhere_invite_mail_date IS NULL
+                        OR payhere_invite_mail_date < now() at time zone 'UTC' - interval '1 hour' * %s)
+                   FOR UPDATE SKIP LOCKED)
+            RETURNING id
+        """, (self.id, cooldown))
+        if not self.env.cr.fetchone():
+            return False
+        self.invalidate_cache(['payhere_invite_mail_date'], self.ids)
+        mail_body = self._payhere_get_invite_mail_body()
+        if not mail_body:
+            return False
+        acquirer = self.sudo()
+        self.env['mail.mail'].sudo().create({
+            'body_html': mail_body,
+            'subject': _('Add your Payhere account to Odoo'),
+            'email_to': acquirer.payhere_email_account,
+            'email_from': acquirer.create_uid.email,
+        })
+        return True
+
+    def _payhere_get_fees_coefficients(self):
+        """ Return the (variable, fixed) coefficients of the domestic and of the
+        international fees, such that fees = variable * amount + fixed. """
+        self.ensure_one()
+        return {
+            'domestic': (self.fees_dom_var / 100.0, self.fees_dom_fixed / (1 - self.fees_dom_var / 100.0)),
+            'international': (self.fees_int_var / 100.0, self.fees_int_fixed / (1 - self.fees_int_var / 100.0)),
+        }
+
     def payhere_compute_fees(self, amount, currency_id, country_id):
         """ Compute payhere fees.
 
@@ -75,25 +316,47 @@ class AcquirerPayhere(models.Model):
         if not self.fees_active:
             return 0.0
         country = self.env['res.country'].browse(country_id)
+        coefficients = self._payhere_get_fees_coefficients()
         if country and self.company_id.country_id.id == country.id:
-            percentage = self.fees_dom_var
-            fixed = self.fees_dom_fixed
+            percentage, fixed = coefficients['domestic']
         else:
-            percentage = self.fees_int_var
-            fixed = self.fees_int_fixed
-        fees = (percentage / 100.0 * amount) + fixed / (1 - percentage / 100.0)
+            percentage, fixed = coefficients['international']
+        fees = (percentage * amount) + fixed
+        return fees
+
+    def payhere_compute_fees_batch(self, items):
+        """ Compute payhere fees of many amounts in one pass, e.g. for a cart or
+        a price list. The results are identical to ``payhere_compute_fees``.
+
+            :param list items: (amount, currency_id, country_id) tuples, with
+                               the same meaning as the parameters of
+                               ``payhere_compute_fees``
+            :return list: the fees, in the order of ``items``
+        """
+        self.ensure_one()
+        if not self.fees_active:
+            return [0.0] * len(items)
+        company_country_id = self.company_id.country_id.id
+        coefficients = self._payhere_get_fees_coefficients()
+        domestic, international = coefficients['domestic'], coefficients['international']
+        fees = []
+        for amount, currency_id, country_id in items:
+            # as browse(country_id) is truthy for any id, the customer country
+            # only has to be compared with the company one
+            percentage, fixed = domestic if country_id and country_id == company_country_id else international
+            fees.append((percentage * amount) + fixed)
         return fees
 
     def payhere_form_generate_values(self, values):
-        base_url = self.get_base_url()
+        config = self._payhere_get_checkout_config(self.get_base_url())
 
         payhere_tx_values = dict(values)
-        _logger.info(' Values before pass  %s', pprint.pformat(values))
+        _logger.debug('Payhere form values %s', redacted(values))
         reference = values.get('reference')
         payhere_tx_values.update({
             'cmd': '_xclick',
-            'merchant_id': self.payhere_email_account,
-            'items': '%s: %s' % (self.company_id.name, reference),
+            'merchant_id': config['merchant_id'],
+            'items': '%s: %s' % (config['company_name'], reference),
             'order_id': reference,
             'amount': values['amount'],
             'currency': values['currency'] and values['currency'].name or '',
@@ -106,24 +369,884 @@ class AcquirerPayhere(models.Model):
             'zip_code': values.get('partner_zip'),
             'first_name': values.get('partner_first_name'),
             'last_name': values.get('partner_last_name'),
-            'return_url': urls.url_join(base_url, PayhereController._return_url),
-            'notify_url': urls.url_join(base_url, PayhereController._notify_url),
-            'cancel_url': urls.url_join(base_url, PayhereController._cancel_url),
-            'handling': '%.2f' % payhere_tx_values.pop('fees', 0.0) if self.fees_active else False,
+            'return_url': config['return_url'],
+            'notify_url': config['notify_url'],
+            'cancel_url': config['cancel_url'],
+            'handling': '%.2f' % payhere_tx_values.pop('fees', 0.0) if config['fees_active'] else False,
             'custom': json.dumps({'return_url': '%s' % payhere_tx_values.pop('return_url')}) if payhere_tx_values.get('return_url') else False,
         })
         return payhere_tx_values
 
+    def _payhere_get_timeout(self):
+        """ (connect, read) timeouts of the calls to Payhere, configured by the
+        ``payment_payhere.connect_timeout`` and ``payment_payhere.read_timeout``
+        system parameters. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        return (
+            float(ICP.get_param('payment_payhere.connect_timeout', 3.05)),
+            float(ICP.get_param('payment_payhere.read_timeout', 10)),
+        )
+
+    def _payhere_request(self, method, url, **kwargs):
+        """ Call Payhere through the shared, pooled client.
+
+            :raise PayhereUnavailable: if Payhere is unhealthy; the caller
+                                       should defer its work
+        """
+        return payhere_client.request(method, url, timeout=self._payhere_get_timeout(), **kwargs)
+
+    def _payhere_get_environment(self):
+        self.ensure_one()
+        return 'prod' if self.state == 'enabled' else 'test'
+
+    def _payhere_get_access_token(self, force_refresh=False):
+        """ Return an OAuth access token for the merchant APIs of Payhere.
+
+            Tokens are cached per database, acquirer and environment in the
+            process, and stored on the acquirer so that the other workers reuse
+            them instead of requesting their own. They are refreshed a minute
+            before they expire.
+
+            :param bool force_refresh: discard the cached token, e.g. after
+                                       Payhere rejected it
+            :raise PayhereUnavailable: if no token could be obtained
+        """
+        self.ensure_one()
+        environment = self._payhere_get_environment()
+        key = (self.env.cr.dbname, self.id, environment)
+        if force_refresh:
+            payhere_token_cache.invalidate(key)
+        token = payhere_token_cache.get(key)
+        if token:
+            return token
+        with payhere_token_cache.lock(key):
+            # another thread may have refreshed it while we were waiting
+            token = payhere_token_cache.get(key)
+            if token:
+                return token
+            if not force_refresh:
+                # another worker may have refreshed it
+                self.flush(['payhere_access_token', 'payhere_access_token_expiry'])
+                self.env.cr.execute("""
+                    SELECT payhere_access_token, payhere_access_token_expiry
+                      FROM payment_acquirer WHERE id = %s
+                """, (self.id,))
+                token, expiry = self.env.cr.fetchone()
+                if token and expiry:
+                    payhere_token_cache.set(key, token, expiry.replace(tzinfo=pytz.utc).timestamp())
+                    token = payhere_token_cache.get(key)
+                    if token:
+                        return token
+            token, expiry = self._payhere_fetch_access_token(environment)
+            payhere_token_cache.set(key, token, expiry)
+            self._payhere_store_access_token(token, expiry)
+            return token
+
+    def _payhere_fetch_access_token(self, environment):
+        """ Request a new access token with the client credentials grant.
+
+            :return tuple: the token and its expiry as a timestamp
+        """
+        sudo_self = self.sudo()
+        if not sudo_self.payhere_app_id or not sudo_self.payhere_app_secret:
+            raise ValidationError(_('Payhere: the App ID and App Secret are required to use the Payhere APIs.'))
+        credentials = base64.b64encode(('%s:%s' % (sudo_self.payhere_app_id, sudo_self.payhere_app_secret)).encode('utf-8'))
+        response = self._payhere_request(
+            'POST', self._get_payhere_urls(environment)['payhere_rest_url'],
+            headers={'Authorization': 'Basic %s' % credentials.decode('ascii')},
+            data={'grant_type': 'client_credentials'})
+        if response.status_code != 200:
+            raise PayhereUnavailable('Payhere: unable to get an access token (HTTP %s)' % response.status_code)
+        result = response.json()
+        return result['access_token'], time.time() + int(result.get('expires_in', 0))
+
+    def _payhere_store_access_token(self, token, expiry):
+        """ Share the token with the other workers. It is committed in its own
+        transaction, so that it does not wait for the caller's. """
+        query = """
+            UPDATE payment_acquirer
+               SET payhere_access_token = %s, payhere_access_token_expiry = %s
+             WHERE id = %s
+        """
+        params = (token, datetime.utcfromtimestamp(expiry), self.id)
+        # a pending write of the ORM must not overwrite the stored token later
+        self.flush(['payhere_access_token', 'payhere_access_token_expiry'])
+        if not self.env['payment.payhere.batch.mixin']._payhere_auto_commit():
+            # tests run in a single transaction
+            self.env.cr.execute(query, params)
+        else:
+            try:
+                with self.pool.cursor() as cr:
+                    cr.execute("SET LOCAL lock_timeout = '2s'")
+                    cr.execute(query, params)
+            except Exception:
+                # e.g. the acquirer is locked by the caller's transaction:
+                # share it when the caller commits
+                _logger.info('Payhere: unable to share the access token of acquirer %s right away', self.id)
+                self.env.cr.execute(query, params)
+        self.invalidate_cache(['payhere_access_token', 'payhere_access_token_expiry'], self.ids)
+
+    def _payhere_api_request(self, method, url, **kwargs):
+        """ Call a merchant API of Payhere with the access token, refreshing
+        the token once if Payhere rejects it. """
+        headers = dict(kwargs.pop('headers', None) or {})
+        for force_refresh in (False, True):
+            headers['Authorization'] = 'Bearer %s' % self._payhere_get_access_token(force_refresh=force_refresh)
+            response = self._payhere_request(method, url, headers=headers, **kwargs)
+            if response.status_code != 401:
+                break
+        return response
+
+    @api.model
+    def _payhere_parse_retrieval(self, response, reference):
+        if response.status_code >= 500 or response.status_code == 401:
+            raise PayhereUnavailable('Payhere: retrieval of %s failed (HTTP %s)' % (reference, response.status_code))
+        result = response.json()
+        if result.get('status') != 1:
+            return []
+        return result.get('data') or []
+
+    def payhere_retrieve_payments(self, reference):
+        """ Ask the Payhere Retrieval API for the payments of an order.
+
+            :param str reference: the order_id sent to Payhere
+            :return list: the payments of the order, as returned by Payhere;
+                          empty if Payhere knows no payment for it
+            :raise PayhereUnavailable: if Payhere could not answer
+        """
+        self.ensure_one()
+        url = self._get_payhere_urls(self._payhere_get_environment())['payhere_retrieval_url']
+        response = self._payhere_api_request('GET', url, params={'order_id': reference})
+        return self._payhere_parse_retrieval(response, reference)
+
+    def _payhere_retrieve_payments_batch(self, references, max_workers=4):
+        """ Retrieve the payments of several orders, with at most
+        ``max_workers`` concurrent calls to Payhere. The threads only do HTTP:
+        the token, url and timeouts are resolved beforehand.
+
+            :return dict: the payments per reference, or None for the
+                          references Payhere could not answer for
+        """
+        self.ensure_one()
+        url = self._get_payhere_urls(self._payhere_get_environment())['payhere_retrieval_url']
+        headers = {'Authorization': 'Bearer %s' % self._payhere_get_access_token()}
+        timeout = self._payhere_get_timeout()
+
+        def retrieve(reference):
+            try:
+                response = payhere_client.request(
+                    'GET', url, timeout=timeout, headers=headers, params={'order_id': reference})
+                return reference, self._payhere_parse_retrieval(response, reference)
+            except (PayhereUnavailable, ValueError) as e:
+                _logger.info('Payhere: unable to retrieve the payments of %s: %s', reference, e)
+                return reference, None
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            return dict(executor.map(retrieve, references))
+
+    @api.model
+    def _payhere_parse_charge(self, response, reference):
+        """ Parse the answer of the Charging API.
+
+            :return dict: the ``status_code`` of the payment, as in the
+                          notifications, its ``payment_id`` and a ``message``
+            :raise PayhereUnavailable: if Payhere could not answer; the charge
+                                       may have gone through
+        """
+        if response.status_code >= 500 or response.status_code in (401, 429):
+            raise PayhereUnavailable('Payhere: charge of %s failed (HTTP %s)' % (reference, response.status_code))
+        result = response.json()
+        data = result.get('data') or {}
+        status_code = int(data.get('status_code', -2)) if result.get('status') == 1 else -2
+        return {
+            'status_code': status_code,
+            'payment_id': data.get('payment_id'),
+            'message': data.get('status_message') or result.get('msg') or '',
+        }
+
+    def _payhere_post_batch(self, url_key, payloads, parse, max_workers=4, limiter=None):
+        """ POST payloads to a merchant API of Payhere, with at most
+        ``max_workers`` concurrent calls and ``limiter`` throttling them. The
+        threads only do HTTP, on the pooled session of the client, with the
+        token resolved once beforehand; the calls are never retried, as they
+        are not idempotent.
+
+            :param str url_key: the key of the API in ``_get_payhere_urls``
+            :param dict payloads: the payloads per identifier
+            :param parse: function parsing a response, given the response and
+                          the identifier of its payload
+            :param limiter: a ``TokenBucket`` shared by the calls
+            :return dict: the parsed result per identifier, or None for the
+                          payloads Payhere could not answer for
+        """
+        self.ensure_one()
+        url = self._get_payhere_urls(self._payhere_get_environment())[url_key]
+        headers = {'Authorization': 'Bearer %s' % self._payhere_get_access_token()}
+        timeout = self._payhere_get_timeout()
+
+        def post(item):
+            key, payload = item
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                response = payhere_client.request(
+                    'POST', url, timeout=timeout, retry=False, headers=headers, json=payload)
+                return key, parse(response, key)
+            except (PayhereUnavailable, ValueError) as e:
+                _logger.info('Payhere: call to %s failed for %s: %s', url_key, key, e)
+                return key, None
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            return dict(executor.map(post, payloads.items()))
+
+    def _payhere_charge_batch(self, payloads, max_workers=4, limiter=None):
+        """ Charge customer tokens in parallel, see ``_payhere_post_batch``.
+
+            :param list payloads: payloads of the Charging API, see
+                                  ``_payhere_get_charge_payload``
+            :return dict: the result of each charge per order_id, see
+                          ``_payhere_parse_charge``, or None for the charges
+                          Payhere could not answer for
+        """
+        return self._payhere_post_batch(
+            'payhere_charge_url', {payload['order_id']: payload for payload in payloads},
+            self._payhere_parse_charge, max_workers, limiter)
+
+    @api.model
+    def _payhere_parse_refund(self, response, refund_id):
+        """ Parse the answer of the Refund API.
+
+            :return dict: whether the refund was ``accepted``, the
+                          ``refund_id`` of Payhere and a ``message``
+            :raise PayhereUnavailable: if Payhere could not answer; the refund
+                                       may have gone through
+        """
+        if response.status_code >= 500 or response.status_code in (401, 429):
+            raise PayhereUnavailable('Payhere: refund %s failed (HTTP %s)' % (refund_id, response.status_code))
+        result = response.json()
+        return {
+            'accepted': result.get('status') == 1,
+            'refund_id': result.get('data') if result.get('status') == 1 else None,
+            'message': result.get('msg') or '',
+        }
+
+    def _payhere_refund_batch(self, payloads, max_workers=4, limiter=None):
+        """ Refund payments in parallel, see ``_payhere_post_batch``.
+
+            :param dict payloads: payloads of the Refund API per id of
+                                  ``payment.payhere.refund``, see
+                                  ``payment.payhere.refund._get_payload``; a
+                                  payment may have several partial refunds
+            :return dict: the result of each refund per id, see
+                          ``_payhere_parse_refund``, or None for the refunds
+                          Payhere could not answer for
+        """
+        return self._payhere_post_batch(
+            'payhere_refund_url', payloads, self._payhere_parse_refund, max_workers, limiter)
+
     def payhere_get_form_action_url(self):
         self.ensure_one()
-        environment = 'prod' if self.state == 'enabled' else 'test'
-        return self._get_payhere_urls(environment)['payhere_form_url']
+        return self._payhere_get_checkout_config(self.get_base_url())['form_url']
+
+    def _payhere_is_preapproval(self, tx_type):
+        """ Tell whether a checkout saves the card of the customer: it is then
+        a preapproval, whose notification carries the customer token. """
+        self.ensure_one()
+        return tx_type == 'form_save' or self.save_token == 'always'
+
+    def render(self, reference, amount, currency_id, partner_id=False, values=None):
+        if self.provider == 'payhere' and 'tx_url' not in self.env.context \
+                and self._payhere_is_preapproval((values or {}).get('type')):
+            # post the form to the preapproval endpoint rather than the checkout
+            config = self._payhere_get_checkout_config(self.get_base_url())
+            self = self.with_context(tx_url=config['preapprove_url'])
+        return super(AcquirerPayhere, self).render(reference, amount, currency_id, partner_id=partner_id, values=values)
 
 
 class TxPayhere(models.Model):
-    _inherit = 'payment.transaction'
+    _name = 'payment.transaction'
+    _inherit = ['payment.transaction', 'payment.payhere.batch.mixin']
 
     payhere_txn_type = fields.Char('Transaction type')
+    # Payhere payment_id, looked up by the repeated notifications of a payment
+    acquirer_reference = fields.Char(index=True)
+    payhere_refund_ids = fields.One2many('payment.payhere.refund', 'transaction_id', 'Payhere Refunds', readonly=True)
+
+    # --------------------------------------------------
+    # NOTIFICATION PROCESSING
+    # --------------------------------------------------
+
+    @api.model
+    def _payhere_validate_data(self, data, trace=None):
+        """ Validate a Payhere notification and apply it to its transaction.
+
+            Notifications are authenticated locally by checking their md5sig
+            against the merchant secret of the acquirer; unsigned or forged
+            notifications are ignored. This is the body of the IPN processing;
+            it is called by the notification queue (see
+            ``payment.payhere.notification``) and by the replay of the
+            journal (see ``payment.payhere.journal``), so it must not depend
+            on an HTTP request.
+
+            :param dict data: the notification payload as posted by Payhere
+            :param trace: the ``NotificationTrace`` timing the processing; one
+                          compact record is logged per notification
+            :return: the result of ``form_feedback``, or False
+        """
+        trace = trace or NotificationTrace(data)
+        res, outcome = False, 'error'
+        try:
+            with trace:
+                res, outcome = self._payhere_apply_notification(dict(data), trace)
+        except PayhereTransactionLocked:
+            outcome = 'locked'
+            raise
+        finally:
+            trace.emit(_logger, outcome)
+            payhere_metrics.observe_notification(trace)
+        return res
+
+    @api.model
+    def _payhere_apply_notification(self, post, trace):
+        res = False
+        reference = post.get('order_id')
+        with trace.stage('route'):
+            acquirer = self.env['payment.acquirer']._payhere_get_merchant(post.get('merchant_id'))
+        if not acquirer:
+            _sampled_logger.warning('unknown_merchant', 'Payhere: notification for unknown merchant %s, ignoring it', post.get('merchant_id'))
+            return False, 'unknown_merchant'
+        trace.acquirer_id = acquirer.id
+        with trace.stage('verify'):
+            verified = acquirer._payhere_check_md5sig(post)
+        if not verified:
+            _sampled_logger.warning('invalid_md5sig', 'Payhere: invalid md5sig on notification for %s, ignoring it', reference)
+            return False, 'invalid_signature'
+        # dispatch the notification in the company of the merchant
+        self = self.with_context(acquirer.env.context)
+        with trace.stage('lookup'):
+            tx = self._payhere_find_tx(post, acquirer)
+        if not tx:
+            # we have seemingly received a notification for a payment that did not come from
+            # odoo, acknowledge it otherwise Payhere will keep trying
+            _sampled_logger.warning('unknown_reference', 'received notification for unknown payment reference %s', reference)
+            return False, 'unknown_reference'
+        trace.transaction_id = tx[:1].id
+        with trace.stage('lock'):
+            if not tx._payhere_lock():
+                raise PayhereTransactionLocked('Payhere: transaction %s is being updated by another handler' % reference)
+        _logger.debug('Beginning Payhere IPN form_feedback with post data %s', redacted(post))
+        resp = bool(post.get('status_code'))
+        if resp:
+            resp = int(post.get('status_code'))
+        if resp == 2:
+            with trace.stage('feedback'):
+                res = tx.form_feedback(post, 'payhere')
+            if not res and tx:
+                tx._set_transaction_error('Validation error occured. Please contact your administrator.')
+                tx._payhere_notify_state()
+            return res, 'done' if res else 'rejected'
+        elif resp in [-1, -2]:
+            _sampled_logger.warning('failed', 'Payhere: answered INVALID/FAIL on data verification')
+            if tx:
+                tx._set_transaction_error('Invalid response from Payhere. Please contact your administrator.')
+                tx._payhere_notify_state()
+            return res, 'failed'
+        elif resp == 0:
+            _sampled_logger.warning('pending', 'Payhere: answered pending data verification')
+            if tx:
+                tx._set_transaction_error('Verification is pending from Payhere. Please contact your administrator.')
+                tx._payhere_notify_state()
+            return res, 'pending'
+        else:
+            _sampled_logger.warning(
+                'unrecognized', 'Payhere: unrecognized Payhere answer, received %s instead of VERIFIED/SUCCESS or INVALID/FAIL', resp)
+            if tx:
+                tx._set_transaction_error('Unrecognized error from Payhere. Please contact your administrator.')
+                tx._payhere_notify_state()
+            return res, 'unrecognized'
+
+    def _payhere_lock(self):
+        """ Serialize the handlers of the transactions (IPN, return route,
+        reconciliation...) with transaction-level advisory locks, taken without
+        waiting: as the handlers run in repeatable read, waiting for a
+        concurrent handler to commit would only end in a serialization failure
+        and a retry of the whole request.
+
+            :return recordset: the transactions locked by the current
+                               transaction; those being handled concurrently
+                               are left out
+        """
+        if not self:
+            return self
+        self.env.cr.execute("""
+            SELECT id FROM unnest(%s::int[]) AS id
+             WHERE pg_try_advisory_xact_lock(%s, id)
+        """, (self.ids, PAYHERE_LOCK_NAMESPACE))
+        locked_ids = {row[0] for row in self.env.cr.fetchall()}
+        return self.filtered(lambda tx: tx.id in locked_ids)
+
+    @api.model
+    def _payhere_find_tx(self, data, acquirer=None):
+        """ Resolve the transaction of a notification with a single query, on
+        its unique reference. The payment_id stored in ``acquirer_reference``
+        by a first notification of the payment is only looked up for the
+        notifications without order_id.
+
+            :param acquirer: the acquirer of the merchant of the notification;
+                             the transactions of other acquirers are ignored
+            :return: the transaction, or an empty recordset
+        """
+        if data.get('order_id'):
+            column, value = 'reference', data['order_id']
+        elif data.get('payment_id'):
+            column, value = 'acquirer_reference', data['payment_id']
+        else:
+            return self.browse()
+        self.flush([column, 'acquirer_id'])
+        query = "SELECT id FROM payment_transaction WHERE %s = %%s" % column
+        params = [value]
+        if acquirer:
+            query += " AND acquirer_id = %s"
+            params.append(acquirer.id)
+        self.env.cr.execute(query + " ORDER BY id LIMIT 1", params)
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    # --------------------------------------------------
+    # RECONCILIATION
+    # --------------------------------------------------
+
+    @api.model
+    def _cron_payhere_reconcile(self):
+        """ Reconcile the Payhere transactions left in draft or pending with
+        their status on Payhere.
+
+            Transactions older than ``payment_payhere.reconcile_min_age``
+            minutes and younger than ``payment_payhere.reconcile_max_age`` days
+            are walked by id (keyset pagination) in chunks of
+            ``payment_payhere.reconcile_batch_size``; their payments are
+            retrieved with ``payment_payhere.reconcile_workers`` concurrent
+            calls and the state changes are applied per chunk. The run stops
+            after ``payment_payhere.reconcile_time_budget`` seconds.
+
+            :return dict: the number of transactions processed and updated,
+                          and the duration of the run in seconds
+        """
+        batch_size = int(self._payhere_get_param('reconcile_batch_size', 200))
+        workers = int(self._payhere_get_param('reconcile_workers', 4))
+        min_age = int(self._payhere_get_param('reconcile_min_age', 15))
+        max_age = int(self._payhere_get_param('reconcile_max_age', 3))
+        start = time.monotonic()
+        deadline = start + int(self._payhere_get_param('reconcile_time_budget', 240))
+        auto_commit = self._payhere_auto_commit()
+
+        now = fields.Datetime.now()
+        domain = [
+            ('acquirer_id.provider', '=', 'payhere'),
+            ('state', 'in', ('draft', 'pending')),
+            ('create_date', '<=', now - timedelta(minutes=min_age)),
+            ('create_date', '>=', now - timedelta(days=max_age)),
+        ]
+        last_id, processed, updated = 0, 0, 0
+        while time.monotonic() < deadline:
+            txs = self.search(domain + [('id', '>', last_id)], order='id', limit=batch_size)
+            if not txs:
+                break
+            last_id = txs[-1].id
+            for acquirer, acquirer_txs in txs._payhere_group_by_acquirer():
+                try:
+                    payments = acquirer._payhere_retrieve_payments_batch(acquirer_txs.mapped('reference'), workers)
+                except (PayhereUnavailable, ValidationError) as e:
+                    _logger.warning('Payhere: reconciliation skipped for acquirer %s: %s', acquirer.id, e)
+                    continue
+                updated += acquirer_txs._payhere_apply_payments(payments)
+            processed += len(txs)
+            if auto_commit:
+                self.env.cr.commit()
+
+        report = {'processed': processed, 'updated': updated, 'duration': time.monotonic() - start}
+        _logger.info('Payhere: reconciled %(processed)s transactions (%(updated)s updated) in %(duration).2fs', report)
+        return report
+
+    def _payhere_apply_payments(self, payments):
+        """ Apply the payments retrieved from Payhere to the transactions, with
+        one state transition per target state rather than one per record. A
+        payment is only confirmed when its amount and currency match the
+        transaction, as for the notifications.
+
+            :param dict payments: the payments per reference, as returned by
+                                  ``_payhere_retrieve_payments_batch``
+            :return int: the number of transactions updated
+        """
+        by_status = {}
+        payment_ids = {}
+        # the transactions being handled concurrently are reconciled next run
+        for tx in self._payhere_lock():
+            tx_payments = payments.get(tx.reference)
+            if not tx_payments:
+                continue
+            payment = tx_payments[-1]
+            status = PAYHERE_RETRIEVAL_STATUS.get(payment.get('status'))
+            if status is None:
+                _logger.warning('Payhere: unknown status %s retrieved for %s', payment.get('status'), tx.reference)
+                continue
+            if status == 2:
+                mismatches = tx._payhere_get_amount_mismatches(payment.get('amount'), payment.get('currency'))
+                if mismatches:
+                    _logger.warning('Payhere: payment retrieved for %s not confirmed, %s', tx.reference, ', '.join(
+                        '%s: received %s instead of %s' % mismatch for mismatch in mismatches))
+                    continue
+            by_status.setdefault(status, self.browse())
+            by_status[status] |= tx
+            if payment.get('payment_id'):
+                payment_ids[tx.id] = str(payment['payment_id'])
+
+        self._payhere_write_payment_ids({tx_id: (payment_id, 'inbound') for tx_id, payment_id in payment_ids.items()})
+
+        updated = self.browse()
+        for status, txs in by_status.items():
+            if status == 2:
+                txs._set_transaction_done()
+                updated |= txs
+            elif status == 0:
+                txs = txs.filtered(lambda tx: tx.state == 'draft')
+                txs._set_transaction_pending()
+                updated |= txs
+            else:
+                txs._set_transaction_cancel()
+                updated |= txs
+        updated._payhere_notify_state()
+        return len(updated)
+
+    def _payhere_notify_state(self):
+        """ Wake the requests long-polling the state of the transactions, once
+        the current transaction commits. """
+        if self:
+            self.env.cr.execute("SELECT pg_notify(%s, %s)", (PAYHERE_STATE_CHANNEL, json.dumps(self.ids)))
+
+    @api.model
+    def _payhere_get_status(self, tx_ids):
+        """ Compact state of transactions, read with a single query, and its
+        ETag.
+
+            :return tuple: (list of dicts with the reference and state of
+                           each transaction, ETag)
+        """
+        if not tx_ids:
+            return [], '"empty"'
+        self.env.cr.execute("""
+            SELECT id, reference, state, write_date FROM payment_transaction
+             WHERE id IN %s ORDER BY id
+        """, (tuple(tx_ids),))
+        rows = self.env.cr.fetchall()
+        status = [{'id': tx_id, 'reference': reference, 'state': state} for tx_id, reference, state, _date in rows]
+        digest = hashlib.sha1(repr([(tx_id, state, str(date)) for tx_id, _ref, state, date in rows]).encode()).hexdigest()
+        return status, '"%s"' % digest[:20]
+
+    @tools.ormcache('self.id', 'self.write_date', 'base_url')
+    def _payhere_get_onsite_payload(self, base_url):
+        """ Signed payload of the onsite checkout of the transaction, for
+        ``payhere.startPayment`` of the Payhere JavaScript SDK. It is built
+        from ``payhere_form_generate_values`` once per version of the
+        transaction and served again to the retries of the customer.
+
+            :param str base_url: the base url of the current request
+            :return dict: the payload, made of plain values only
+        """
+        self.ensure_one()
+        acquirer = self.acquirer_id.sudo()
+        first_name, last_name = _partner_split_name(self.partner_name or '')
+        values = acquirer.payhere_form_generate_values({
+            'reference': self.reference,
+            'amount': self.amount,
+            'currency': self.currency_id,
+            'partner_address': self.partner_address,
+            'partner_phone': self.partner_phone,
+            'partner_city': self.partner_city,
+            'partner_country': self.partner_country_id,
+            'partner_email': self.partner_email,
+            'partner_zip': self.partner_zip,
+            'partner_first_name': first_name,
+            'partner_last_name': last_name,
+        })
+        # the SDK has no handling amount: payhere_amount is amount + fees
+        amount = float_round(self.amount + self.fees, 2)
+        payload = {
+            key: values.get(key) or '' for key in (
+                'merchant_id', 'order_id', 'items', 'currency', 'first_name', 'last_name',
+                'email', 'phone', 'address', 'city', 'country', 'return_url', 'cancel_url')
+        }
+        payload.update({
+            'sandbox': acquirer._payhere_get_environment() != 'prod',
+            'amount': '%.2f' % amount,
+            'hash': acquirer._payhere_compute_checkout_hash(self.reference, amount, payload['currency']),
+        })
+        if acquirer.payhere_use_ipn:
+            payload['notify_url'] = values['notify_url']
+        if acquirer._payhere_is_preapproval(self.type):
+            payload['preapprove'] = True
+        return payload
+
+    @api.model
+    def _payhere_handle_return(self, reference):
+        """ Customer back from Payhere: only read the local state of the
+        transaction, and queue a status check if it is not settled yet. Payhere
+        is never called while the customer waits for the redirection.
+
+            :return bool: whether a status check was queued
+        """
+        tx = self.search([('reference', '=', reference), ('state', 'in', ('draft', 'pending'))], limit=1)
+        acquirer = tx.acquirer_id
+        if not tx or acquirer.provider != 'payhere' or not (acquirer.payhere_app_id and acquirer.payhere_app_secret):
+            # settled, unknown or without Retrieval API: the IPN and the
+            # reconciliation cron take care of it
+            return False
+        return bool(self.env['payment.payhere.notification'].sudo()._enqueue_status_check(reference))
+
+    @api.model
+    def _payhere_check_status(self, reference):
+        """ Status check queued by ``_payhere_handle_return``: retrieve the
+        payments of the transaction unless a notification settled it
+        meanwhile.
+
+            :return bool: whether the transaction was updated
+            :raise PayhereUnavailable: if Payhere could not answer
+        """
+        tx = self.search([('reference', '=', reference), ('state', 'in', ('draft', 'pending'))], limit=1)
+        if not tx:
+            return False
+        payments = {reference: tx.acquirer_id.payhere_retrieve_payments(reference)}
+        return bool(tx._payhere_apply_payments(payments))
+
+    def payhere_refund(self, reason, amount=None):
+        """ Queue the refund of confirmed Payhere transactions, processed by
+        the ``_cron_process_refunds`` cron of ``payment.payhere.refund``.
+
+            :param str reason: the reason of the refund, sent to Payhere
+            :param float amount: the amount to refund, for a partial refund of
+                                 a single transaction; the whole payment by
+                                 default
+            :return recordset: the queued ``payment.payhere.refund``
+        """
+        invalid = self.filtered(
+            lambda tx: tx.provider != 'payhere' or tx.state != 'done' or not tx.acquirer_reference)
+        if invalid:
+            raise UserError(_('Only confirmed Payhere payments can be refunded: %s') % ', '.join(invalid.mapped('reference')))
+        if amount and len(self) > 1:
+            raise UserError(_('A partial refund applies to a single transaction.'))
+        return self.env['payment.payhere.refund'].sudo().create([{
+            'transaction_id': tx.id,
+            'amount': amount or 0.0,
+            'reason': reason,
+        } for tx in self])
+
+    def _payhere_get_charge_payload(self):
+        """ Payload of the Charging API for a transaction paid with a token. """
+        self.ensure_one()
+        return {
+            'type': 'PAYMENT',
+            'order_id': self.reference,
+            'items': self.reference,
+            'currency': self.currency_id.name,
+            'amount': float_round(self.amount, 2),
+            'customer_token': self.payment_token_id.acquirer_ref,
+        }
+
+    def payhere_s2s_do_transaction(self, **kwargs):
+        """ Charge the customer token of the transaction. If Payhere does not
+        answer, the charge may have gone through: the transaction is left
+        pending for the reconciliation to settle it, never charged again. """
+        self.ensure_one()
+        acquirer = self.acquirer_id
+        url = acquirer._get_payhere_urls(acquirer._payhere_get_environment())['payhere_charge_url']
+        try:
+            response = acquirer._payhere_api_request('POST', url, retry=False, json=self._payhere_get_charge_payload())
+            result = acquirer._payhere_parse_charge(response, self.reference)
+        except PayhereUnavailable as e:
+            _logger.warning('Payhere: charge of %s left pending: %s', self.reference, e)
+            self._set_transaction_pending()
+            self._payhere_notify_state()
+            return False
+        self._payhere_apply_charges({self.reference: result})
+        return self.state == 'done'
+
+    def _payhere_apply_charges(self, results):
+        """ Apply the results of charges to the transactions, with one state
+        transition per target state rather than one per record.
+
+            :param dict results: the result of the charge per reference, see
+                                 ``_payhere_parse_charge``; None when Payhere
+                                 could not answer
+            :return recordset: the transactions updated
+        """
+        payment_values = {}
+        by_status = {2: self.browse(), 0: self.browse()}
+        errors = {}
+        for tx in self._payhere_lock():
+            result = results.get(tx.reference)
+            if not result:
+                continue
+            if result.get('payment_id'):
+                payment_values[tx.id] = (str(result['payment_id']), 'inbound')
+            if result['status_code'] in by_status:
+                by_status[result['status_code']] |= tx
+            else:
+                message = result['message'] or _('Payhere declined the charge.')
+                errors.setdefault(message, self.browse())
+                errors[message] |= tx
+
+        self._payhere_write_payment_ids(payment_values)
+        by_status[2]._set_transaction_done()
+        by_status[0]._set_transaction_pending()
+        updated = by_status[2] | by_status[0]
+        for message, txs in errors.items():
+            txs._set_transaction_error(message)
+            updated |= txs
+        updated._payhere_notify_state()
+        return updated
+
+    @api.model
+    def _payhere_write_payment_ids(self, values):
+        """ Store the Payhere payment_id and transaction type of many
+        transactions with a single UPDATE.
+
+            :param dict values: (payment_id, payhere_txn_type) per transaction id
+        """
+        if not values:
+            return
+        self.env.cr.execute("""
+            UPDATE payment_transaction tx
+               SET acquirer_reference = payment.ref, payhere_txn_type = payment.txn_type
+              FROM (SELECT unnest(%s::int[]) AS id, unnest(%s::varchar[]) AS ref, unnest(%s::varchar[]) AS txn_type) AS payment
+             WHERE tx.id = payment.id
+        """, (list(values), [str(value[0]) for value in values.values()], [value[1] for value in values.values()]))
+        self.invalidate_cache(['acquirer_reference', 'payhere_txn_type'], list(values))
+
+    # --------------------------------------------------
+    # BATCH FEEDBACK
+    # --------------------------------------------------
+
+    @api.model
+    def _payhere_form_feedback_batch(self, payloads):
+        """ Apply many Payhere notifications in one transaction, e.g. to
+        backfill the notifications missed during an outage.
+
+            The transactions are resolved with a single search. Each payload
+            is routed to the acquirer of its merchant and authenticated by its
+            md5sig, like the notifications, then checked with
+            ``_payhere_form_get_invalid_parameters``; the state transitions
+            are applied per target state. A payload failing
+            its checks or its transition does not affect the others. When a
+            transaction receives several payloads, the last one wins.
+
+            :param list payloads: notification payloads, as posted by Payhere
+            :return list: one dict per payload, with its ``reference``, its
+                          ``result`` (done, pending, cancel, unchanged,
+                          invalid, not_found, locked or error) and a
+                          ``message``
+        """
+        references = list({payload.get('order_id') for payload in payloads if payload.get('order_id')})
+        txs_by_reference = {tx.reference: tx for tx in self.search([('reference', 'in', references)])}
+        Acquirer = self.env['payment.acquirer'].sudo()
+        report = []
+        entries = {}
+        for payload in payloads:
+            reference = payload.get('order_id')
+            item = {'reference': reference, 'result': False, 'message': ''}
+            report.append(item)
+            # the payloads are raw posts: authenticated as the notifications
+            acquirer = Acquirer._payhere_get_merchant(payload.get('merchant_id'))
+            if not acquirer:
+                item.update(result='invalid', message=_('Payhere: unknown merchant %s') % payload.get('merchant_id'))
+                continue
+            if not acquirer._payhere_check_md5sig(payload):
+                item.update(result='invalid', message=_('Payhere: invalid md5sig'))
+                continue
+            tx = txs_by_reference.get(reference)
+            if not tx or tx.acquirer_id != acquirer or not payload.get('payment_id'):
+                item.update(result='not_found', message=_('Payhere: no transaction found for reference %s') % reference)
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    invalid_parameters = tx._payhere_form_get_invalid_parameters(payload)
+                    status = int(payload.get('status_code'))
+            except Exception as e:
+                item.update(result='error', message=str(e))
+                continue
+            if invalid_parameters:
+                item.update(result='invalid', message=', '.join(
+                    '%s: received %s instead of %s' % parameter for parameter in invalid_parameters))
+                continue
+            if tx.id in entries:
+                entries[tx.id][0].update(result='unchanged', message=_('Superseded by a later notification'))
+            entries[tx.id] = (item, tx, status, payload)
+
+        try:
+            with self.env.cr.savepoint():
+                self._payhere_apply_feedback_batch(list(entries.values()))
+        except Exception:
+            _logger.exception('Payhere: batch feedback failed, applying the notifications one by one')
+            for entry in entries.values():
+                try:
+                    with self.env.cr.savepoint():
+                        self._payhere_apply_feedback_batch([entry])
+                except Exception as e:
+                    entry[0].update(result='error', message=str(e))
+        self.env['payment.payhere.journal'].sudo()._append([
+            ('batch', payload, txs_by_reference.get(item['reference'], self.browse()).id, item['result'])
+            for payload, item in zip(payloads, report)
+        ])
+        return report
+
+    @api.model
+    def _payhere_apply_feedback_batch(self, entries):
+        """ Apply the state transitions of validated notifications, grouped
+        per target state, like ``_payhere_form_validate`` does for one.
+
+            :param list entries: (report item, transaction, status, payload)
+        """
+        targets = {'done': self.browse(), 'pending': self.browse(), 'cancel': self.browse()}
+        entries_by_tx = {}
+        to_invite = self.env['payment.acquirer']
+        locked = self.browse([entry[1].id for entry in entries])._payhere_lock()
+        for item, tx, status, payload in entries:
+            if tx not in locked:
+                item.update(result='locked', message=_('The transaction is being updated by another handler'))
+                continue
+            target = 'done' if status == 2 else 'pending' if status == 0 else 'cancel'
+            item['result'] = target
+            targets[target] |= tx
+            entries_by_tx[tx.id] = (tx.state, item, status, payload)
+            if status in [0, 1] and not tx.acquirer_id.payhere_pdt_token and not tx.acquirer_id.payhere_seller_account:
+                to_invite |= tx.acquirer_id
+        for acquirer in to_invite:
+            acquirer._payhere_queue_invite_mail()
+
+        targets['done']._set_transaction_done()
+        targets['pending']._set_transaction_pending()
+        targets['cancel']._set_transaction_cancel()
+
+        payment_values = {}
+        messages = {}
+        for target, txs in targets.items():
+            for tx in txs:
+                former_state, item, status, payload = entries_by_tx[tx.id]
+                if tx.state != target or tx.state == former_state:
+                    item['result'] = 'unchanged'
+                    continue
+                payment_values[tx.id] = (
+                    payload.get('payment_id'), 'inbound' if float(payload.get('payhere_amount', 0)) > 0 else 'outbound')
+                if status == 0:
+                    message = payload.get('pending_reason', '')
+                elif status != 2:
+                    message = 'Received unrecognized status for Payhere payment %s: %s, set as error' % (tx.reference, status)
+                else:
+                    continue
+                messages.setdefault(message, self.browse())
+                messages[message] |= tx
+        self._payhere_write_payment_ids(payment_values)
+        for message, txs in messages.items():
+            txs.write({'state_message': message})
+        self.browse(list(payment_values))._payhere_notify_state()
 
     # --------------------------------------------------
     # FORM RELATED METHODS
@@ -137,7 +1260,10 @@ class TxPayhere(models.Model):
             _logger.info(error_msg)
             raise ValidationError(error_msg)
 
-        # find tx -> @TDENOTE use payment_id ?
+        # the transaction was already resolved by _payhere_validate_data
+        if len(self) == 1 and self.reference == reference:
+            return self
+
         txs = self.env['payment.transaction'].search([('reference', '=', reference)])
         if not txs or len(txs) > 1:
             error_msg = 'Payhere: received data for reference %s' % (reference)
@@ -151,7 +1277,7 @@ class TxPayhere(models.Model):
 
     def _payhere_form_get_invalid_parameters(self, data):
         invalid_parameters = []
-        _logger.info('Received a notification from Payhere with IPN version %s', data.get('notify_version'))
+        _logger.debug('Received a notification from Payhere with IPN version %s', data.get('notify_version'))
         if data.get('test_ipn'):
             _logger.warning(
                 'Received a notification from Payhere using sandbox'
@@ -161,38 +1287,71 @@ class TxPayhere(models.Model):
         if self.acquirer_reference and data.get('payment_id') != self.acquirer_reference:
             invalid_parameters.append(('payment_id', data.get('payment_id'), self.acquirer_reference))
         # check what is buyed
-        if float_compare(float(data.get('payhere_amount', '0.0')), (self.amount + self.fees), 2) != 0:
-            invalid_parameters.append(('payhere_amount', data.get('payhere_amount'), '%.2f' % (self.amount + self.fees)))  # payhere_amount is amount + fees
-        if data.get('payhere_currency') != self.currency_id.name:
-            invalid_parameters.append(('payhere_currency', data.get('payhere_currency'), self.currency_id.name))
+        invalid_parameters += [
+            ('payhere_%s' % name, received, expected)
+            for name, received, expected in self._payhere_get_amount_mismatches(
+                data.get('payhere_amount', '0.0'), data.get('payhere_currency'))
+        ]
         if 'handling_amount' in data and float_compare(float(data.get('handling_amount')), self.fees, 2) != 0:
             invalid_parameters.append(('handling_amount', data.get('handling_amount'), self.fees))
         # check buyer
         if self.payment_token_id and data.get('payer_id') != self.payment_token_id.acquirer_ref:
             invalid_parameters.append(('payer_id', data.get('payer_id'), self.payment_token_id.acquirer_ref))
         # check seller
-        if data.get('receiver_id') and self.acquirer_id.payhere_seller_account and data['receiver_id'] != self.acquirer_id.payhere_seller_account:
-            invalid_parameters.append(('receiver_id', data.get('receiver_id'), self.acquirer_id.payhere_seller_account))
-        if not data.get('receiver_id') or not self.acquirer_id.payhere_seller_account:
+        seller_account, email_account = self.acquirer_id._payhere_get_accounts()
+        if data.get('receiver_id') and seller_account and data['receiver_id'] != seller_account:
+            invalid_parameters.append(('receiver_id', data.get('receiver_id'), seller_account))
+        if not data.get('receiver_id') or not seller_account:
             # Check receiver_email only if receiver_id was not checked.
             # In Payhere, this is possible to configure as receiver_email a different email than the business email (the login email)
             # In Odoo, there is only one field for the Payhere email: the business email. This isn't possible to set a receiver_email
             # different than the business email. Therefore, if you want such a configuration in your Payhere, you are then obliged to fill
             # the Merchant ID in the Payhere payment acquirer in Odoo, so the check is performed on this variable instead of the receiver_email.
             # At least one of the two checks must be done, to avoid fraudsters.
-            if data.get('receiver_email') and data.get('receiver_email') != self.acquirer_id.payhere_email_account:
-                invalid_parameters.append(('receiver_email', data.get('receiver_email'), self.acquirer_id.payhere_email_account))
-            if data.get('business') and data.get('business') != self.acquirer_id.payhere_email_account:
-                invalid_parameters.append(('business', data.get('business'), self.acquirer_id.payhere_email_account))
+            if data.get('receiver_email') and data.get('receiver_email') != email_account:
+                invalid_parameters.append(('receiver_email', data.get('receiver_email'), email_account))
+            if data.get('business') and data.get('business') != email_account:
+                invalid_parameters.append(('business', data.get('business'), email_account))
 
         return invalid_parameters
 
+    def _payhere_get_amount_mismatches(self, amount, currency):
+        """ Compare the amount and currency paid on Payhere, which include the
+        fees, with the ones of the transaction. The amount of the checkout is
+        posted by the browser of the customer: it must be checked before any
+        confirmation.
+
+            :return list: (parameter, received, expected) tuples
+        """
+        self.ensure_one()
+        expected = self.amount + self.fees
+        try:
+            valid_amount = float_compare(float(amount), expected, 2) == 0
+        except (TypeError, ValueError):
+            valid_amount = False
+        mismatches = []
+        if not valid_amount:
+            mismatches.append(('amount', amount, '%.2f' % expected))
+        if currency != self.currency_id.name:
+            mismatches.append(('currency', currency, self.currency_id.name))
+        return mismatches
+
+    def _payhere_create_token(self, data):
+        """ Store the customer token sent by Payhere with a preapproval, to
+        charge the customer later with ``payhere_s2s_do_transaction``. """
+        return self.env['payment.token'].create({
+            'name': data.get('card_no') or _('Payhere - %s') % self.partner_id.name,
+            'acquirer_ref': data['customer_token'],
+            'acquirer_id': self.acquirer_id.id,
+            'partner_id': self.partner_id.id,
+            'verified': True,
+        })
+
     def _payhere_form_validate(self, data):
         status = int(data.get('status_code'))
         former_tx_state = self.state
 
-        _logger.info('former_tx_state %s:' % (former_tx_state))
-        _logger.info('current state %s:' % pprint.pformat(self.state))
+        _logger.debug('Payhere: transaction %s in state %s', self.reference, former_tx_state)
 
         if float(data.get('payhere_amount')) > 0:
             payment_type = 'inbound'
@@ -203,49 +1362,46 @@ class TxPayhere(models.Model):
             'payhere_txn_type': payment_type,
         }
 
-        if not self.acquirer_id.payhere_pdt_token and not self.acquirer_id.payhere_seller_account and status in [0, 1]:
-            template = self.env.ref('payment_payhere.mail_template_payhere_invite_user_to_configure', False)
-            if template:
-                render_template = template.render({
-                    'acquirer': self.acquirer_id,
-                }, engine='ir.qweb')
-                mail_body = self.env['mail.thread']._replace_local_links(render_template)
-                mail_values = {
-                    'body_html': mail_body,
-                    'subject': _('Add your Payhere account to Odoo'),
-                    'email_to': self.acquirer_id.payhere_email_account,
-                    'email_from': self.acquirer_id.create_uid.email
-                }
-                self.env['mail.mail'].sudo().create(mail_values).send()
-
-        if status in [2]:
-            try:
-                # dateutil and pytz don't recognize abbreviations PDT/PST
-                tzinfos = {
-                    'PST': -8 * 3600,
-                    'PDT': -7 * 3600,
-                }
-                date = dateutil.parser.parse(datetime.date(datetime.now()), tzinfos=tzinfos).astimezone(pytz.utc).replace(tzinfo=None)
-            except:
-                date = fields.Datetime.now()
-            res.update(date=date)
-            self._set_transaction_done()
-            if self.state == 'done' and self.state != former_tx_state:
-                _logger.info('Validated Payhere payment for tx %s: set as done' % (self.reference))
-                return self.write(res)
-            return True
-        elif status in [0]:
-            res.update(state_message=data.get('pending_reason', ''))
-            self._set_transaction_pending()
-            if self.state == 'pending' and self.state != former_tx_state:
-                _logger.info('Received notification for Payhere payment %s: set as pending' % (self.reference))
-                return self.write(res)
-            return True
-        else:
-            error = 'Received unrecognized status for Payhere payment %s: %s, set as error' % (self.reference, status)
-            res.update(state_message=error)
-            self._set_transaction_cancel()
-            if self.state == 'cancel' and self.state != former_tx_state:
-                _logger.info(error)
-                return self.write(res)
-            return True
+        if status == 2 and data.get('customer_token') and not self.payment_token_id \
+                and self.acquirer_id._payhere_is_preapproval(self.type):
+            res['payment_token_id'] = self._payhere_create_token(data).id
+
+        with trace_stage('mail'):
+            if not self.acquirer_id.payhere_pdt_token and not self.acquirer_id.payhere_seller_account and status in [0, 1]:
+                self.acquirer_id._payhere_queue_invite_mail()
+
+        with trace_stage('transition'):
+            if status in [2]:
+                try:
+                    # dateutil and pytz don't recognize abbreviations PDT/PST
+                    tzinfos = {
+                        'PST': -8 * 3600,
+                        'PDT': -7 * 3600,
+                    }
+                    date = dateutil.parser.parse(datetime.date(datetime.now()), tzinfos=tzinfos).astimezone(pytz.utc).replace(tzinfo=None)
+                except:
+                    date = fields.Datetime.now()
+                res.update(date=date)
+                self._set_transaction_done()
+                if self.state == 'done' and self.state != former_tx_state:
+                    _logger.info('Validated Payhere payment for tx %s: set as done' % (self.reference))
+                    self._payhere_notify_state()
+                    return self.write(res)
+                return True
+            elif status in [0]:
+                res.update(state_message=data.get('pending_reason', ''))
+                self._set_transaction_pending()
+                if self.state == 'pending' and self.state != former_tx_state:
+                    _logger.info('Received notification for Payhere payment %s: set as pending' % (self.reference))
+                    self._payhere_notify_state()
+                    return self.write(res)
+                return True
+            else:
+                error = 'Received unrecognized status for Payhere payment %s: %s, set as error' % (self.reference, status)
+                res.update(state_message=error)
+                self._set_transaction_cancel()
+                if self.state == 'cancel' and self.state != former_tx_state:
+                    _logger.info(error)
+                    self._payhere_notify_state()
+                    return self.write(res)
+                return True
@@ -0,0 +1,81 @@
+odoo.define('payment_payhere.payhere_onsite', function (require) {
+"use strict";
+
+var ajax = require('web.ajax');
+var core = require('web.core');
+var PaymentForm = require('payment.payment_form');
+
+var _t = core._t;
+
+var PAYHERE_SDK_URL = 'https://www.payhere.lk/lib/payhere.js';
+
+PaymentForm.include({
+
+    //--------------------------------------------------------------------------
+    // Handlers
+    //--------------------------------------------------------------------------
+
+    /**
+     * The transaction route renders the Payhere form without action url when
+     * the acquirer uses the onsite checkout: instead of posting it, fetch the
+     * signed payload and open the popup of the Payhere SDK.
+     *
+     * @override
+     */
+    payEvent: function (ev) {
+        var self = this;
+        var button = ev.type === 'submit' ? $(ev.target).find('*[type="submit"]')[0] : ev.target;
+        var result = this._super.apply(this, arguments);
+        if (!result || !result.then) {
+            return result;
+        }
+        return result.then(function () {
+            var $onsite = $('form[provider="payhere"] input[name="payhere_onsite"]').last();
+            if (!$onsite.length) {
+                return;
+            }
+            var reference = $onsite.val();
+            $onsite.closest('form').remove();
+            return self._payhereStartPayment(reference, button);
+        });
+    },
+
+    //--------------------------------------------------------------------------
+    // Private
+    //--------------------------------------------------------------------------
+
+    /**
+     * @private
+     * @param {string} reference
+     * @param {DOMElement} button
+     * @returns {Promise}
+     */
+    _payhereStartPayment: function (reference, button) {
+        var self = this;
+        return Promise.all([
+            this._rpc({route: '/payment/payhere/onsite', params: {reference: reference}}),
+            ajax.loadJS(PAYHERE_SDK_URL),
+        ]).then(function (results) {
+            var payment = results[0];
+            payhere.onCompleted = function () {
+                window.location = '/payment/process';
+            };
+            payhere.onDismissed = function () {
+                self.enableButton(button);
+            };
+            payhere.onError = function (error) {
+                self.displayError(_t('Payment error'), error);
+                self.enableButton(button);
+            };
+            payhere.startPayment(payment);
+        }).guardedCatch(function () {
+            self.displayError(
+                _t('Server Error'),
+                _t("We are not able to redirect you to the payment form.")
+            );
+            self.enableButton(button);
+        });
+    },
+});
+
+});
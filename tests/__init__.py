@@ -1,2 +1,4 @@
 # -*- coding: utf-8 -*-
-from . import test_payhere
\ No newline at end of file
+from . import test_payhere
+from . import test_payhere_benchmark
+from . import test_payhere_emulator
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+from werkzeug import urls
+
+from odoo.addons.payment_payhere.controllers.main import PayhereController
+from odoo.addons.payment_payhere.models.payhere_request import payhere_client
+
+EMULATED_HOSTS = ('www.payhere.lk', 'sandbox.payhere.lk', 'api.payhere.lk', 'api.sandbox.payhere.lk')
+
+
+class Faults(object):
+    """ Faults injected by the emulator, drawn from a seeded random generator
+    so that a run is reproducible.
+
+        :param float latency: seconds added to every call
+        :param float timeout_rate: share of the calls timing out
+        :param float error_rate: share of the calls answered with a 503
+        :param float duplicate_rate: share of the notifications delivered twice
+        :param bool reorder: deliver the notifications of a payment from the
+                             last status to the first one
+    """
+
+    def __init__(self, latency=0.0, timeout_rate=0.0, error_rate=0.0, duplicate_rate=0.0, reorder=False, seed=42):
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.error_rate = error_rate
+        self.duplicate_rate = duplicate_rate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+
+class PayhereEmulator(BaseAdapter):
+    """ In-process stand-in for Payhere, mounted as the transport of the
+    shared ``payhere_client`` session: the client keeps its timeouts, retries
+    and circuit breakers, only the network is emulated.
+
+        It serves the checkout form, the OAuth token, Retrieval, Charging and
+        Refund APIs of ``_get_payhere_urls``, and signs the notifications of
+        the payments it receives with the secret of the merchant before
+        handing them to ``deliver``. By default, they are posted to
+        ``PayhereController._notify_url`` with ``case.url_open``, ``case``
+        being the running ``HttpCase``::
+
+            with PayhereEmulator('dummy', 'dummy_secret', faults=Faults(error_rate=0.2), case=self) as emulator:
+                emulator.pay('SO042', 10.0, 'LKR')
+
+        Without ``deliver`` nor ``case``, the notifications are lost.
+    """
+
+    def __init__(self, merchant_id, merchant_secret, deliver=None, faults=None, case=None):
+        super(PayhereEmulator, self).__init__()
+        self.merchant_id = merchant_id
+        self.hashed_secret = hashlib.md5(merchant_secret.encode('utf-8')).hexdigest().upper()
+        self.case = case
+        self.deliver = deliver or (case and self._post_notification)
+        self.deliveries = []
+        self.faults = faults or Faults()
+        self.payments = {}
+        self.declined_tokens = set()
+        self.calls = []
+        self._payment_ids = itertools.count(320000000001)
+        self._lock = threading.Lock()
+        self._breakers = None
+
+    # --------------------------------------------------
+    # INSTALLATION
+    # --------------------------------------------------
+
+    def __enter__(self):
+        session = payhere_client.session
+        for host in EMULATED_HOSTS:
+            session.mount('https://%s/' % host, self)
+        # start from closed circuits, and leave them as they were
+        self._breakers, payhere_client._breakers = payhere_client._breakers, {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        session = payhere_client.session
+        for host in EMULATED_HOSTS:
+            session.adapters.pop('https://%s/' % host, None)
+        payhere_client._breakers = self._breakers
+
+    @contextlib.contextmanager
+    def faulty(self, **faults):
+        """ Inject other faults for the duration of the block. """
+        previous = self.faults
+        self.faults = Faults(**faults)
+        try:
+            yield
+        finally:
+            self.faults = previous
+
+    # --------------------------------------------------
+    # TRANSPORT
+    # --------------------------------------------------
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urls.url_parse(request.url)
+        self.calls.append((request.method, url.path))
+        faults = self.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        with self._lock:
+            draw = faults.random.random()
+        if draw < faults.timeout_rate:
+            raise requests.exceptions.ReadTimeout('Payhere emulator: timeout on %s' % request.url, request=request)
+        if draw < faults.timeout_rate + faults.error_rate:
+            return self._response(request, 503, {'status': -1, 'msg': 'Service Unavailable'})
+
+        if url.path.endswith('/oauth2/token'):
+            return self._response(request, 200, {'access_token': 'emulated_token', 'expires_in': 599})
+        if request.headers.get('Authorization') != 'Bearer emulated_token' and '/merchant/' in url.path:
+            return self._response(request, 401, {'status': -1, 'msg': 'Unauthorized'})
+        if url.path.endswith('/payment/search'):
+            return self._search(request, url.decode_query().get('order_id'))
+        if url.path.endswith('/payment/charge'):
+            return self._charge(request, json.loads(request.body))
+        if url.path.endswith('/payment/refund'):
+            return self._refund(request, json.loads(request.body))
+        if url.path.endswith('/pay/checkout'):
+            return self._checkout(request, urls.url_decode(request.body))
+        return self._response(request, 404, {'status': -1, 'msg': 'Not Found'})
+
+    def close(self):
+        pass
+
+    def _response(self, request, status_code, payload, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = request.url
+        response.request = request
+        response.headers['Content-Type'] = 'application/json'
+        response.headers.update(headers or {})
+        response.raw = io.BytesIO(json.dumps(payload).encode('utf-8'))
+        response.encoding = 'utf-8'
+        return response
+
+    # --------------------------------------------------
+    # ENDPOINTS
+    # --------------------------------------------------
+
+    def _search(self, request, order_id):
+        payments = self.payments.get(order_id)
+        if not payments:
+            return self._response(request, 200, {'status': -1, 'msg': 'No payments found'})
+        return self._response(request, 200, {'status': 1, 'data': [dict(payment) for payment in payments]})
+
+    def _charge(self, request, payload):
+        if payload.get('customer_token') in self.declined_tokens:
+            return self._response(request, 200, {'status': -1, 'msg': 'Card declined'})
+        payment = self._record(payload['order_id'], payload['amount'], payload['currency'], 'RECEIVED')
+        return self._response(request, 200, {'status': 1, 'msg': 'Automatic payment charged successfully', 'data': {
+            'order_id': payment['order_id'],
+            'payment_id': payment['payment_id'],
+            'status_code': 2,
+            'status_message': 'Successfully completed the payment.',
+        }})
+
+    def _refund(self, request, payload):
+        for payments in self.payments.values():
+            for payment in payments:
+                if str(payment['payment_id']) == str(payload.get('payment_id')):
+                    if payment['status'] == 'REFUNDED':
+                        return self._response(request, 200, {'status': -1, 'msg': 'Payment already refunded'})
+                    payment['status'] = 'REFUNDED'
+                    return self._response(request, 200, {'status': 1, 'msg': 'Successfully processed', 'data': next(self._payment_ids)})
+        return self._response(request, 200, {'status': -1, 'msg': 'Payment not found'})
+
+    def _checkout(self, request, form):
+        self.pay(form['order_id'], float(form['amount']), form['currency'])
+        return self._response(request, 302, {}, headers={'Location': form.get('return_url', '/')})
+
+    # --------------------------------------------------
+    # PAYMENTS AND NOTIFICATIONS
+    # --------------------------------------------------
+
+    def _record(self, order_id, amount, currency, status):
+        with self._lock:
+            payment = {
+                'payment_id': next(self._payment_ids),
+                'order_id': order_id,
+                'amount': amount,
+                'currency': currency,
+                'status': status,
+            }
+            self.payments.setdefault(order_id, []).append(payment)
+        return payment
+
+    def sign(self, data):
+        payload = ''.join(str(data.get(key, '')) for key in (
+            'merchant_id', 'order_id', 'payhere_amount', 'payhere_currency', 'status_code'))
+        return hashlib.md5((payload + self.hashed_secret).encode('utf-8')).hexdigest().upper()
+
+    def notification(self, payment, status_code):
+        data = {
+            'merchant_id': self.merchant_id,
+            'order_id': payment['order_id'],
+            'payment_id': str(payment['payment_id']),
+            'payhere_amount': '%.2f' % payment['amount'],
+            'payhere_currency': payment['currency'],
+            'status_code': str(status_code),
+        }
+        data['md5sig'] = self.sign(data)
+        return data
+
+    def pay(self, order_id, amount, currency, statuses=(0, 2)):
+        """ Receive a payment, going through ``statuses``, and deliver its
+        notifications, with the duplicates and reordering of the faults.
+
+            :return dict: the payment
+        """
+        payment = self._record(order_id, amount, currency, 'RECEIVED' if statuses[-1] == 2 else 'PENDING')
+        notifications = [self.notification(payment, status_code) for status_code in statuses]
+        if self.faults.reorder:
+            notifications.reverse()
+        for data in notifications:
+            self._deliver(data)
+            if self.faults.random.random() < self.faults.duplicate_rate:
+                self._deliver(dict(data))
+        return payment
+
+    def _deliver(self, data):
+        if self.deliver:
+            self.deliver(data)
+
+    def _post_notification(self, data):
+        """ Post a notification to the IPN route, as Payhere does; the status
+        code of each answer is kept in ``deliveries``. """
+        response = self.case.url_open(PayhereController._notify_url, data=data)
+        self.deliveries.append(response.status_code)
@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from unittest.mock import Mock, patch
+
 from odoo import fields
 from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.exceptions import UserError
 from odoo.addons.payment.tests.common import PaymentAcquirerCommon
 from odoo.addons.payment_payhere.controllers.main import PayhereController
+from odoo.addons.payment_payhere.models import payhere_metrics
+from odoo.addons.payment_payhere.models.payhere_dispatch import StateDispatcher
+from odoo.addons.payment_payhere.models.payhere_logging import NotificationTrace, SampledLogger, redact, redacted, trace_stage
+from odoo.addons.payment_payhere.models.payment import PAYHERE_LOCK_NAMESPACE, PayhereTransactionLocked
+from odoo.addons.payment_payhere.models.payhere_request import CircuitBreaker, PayhereClient, PayhereUnavailable, payhere_client
 from werkzeug import urls
 
 from odoo.tools import mute_logger
-from odoo.tests import tagged
+from odoo.tests import HttpCase, tagged
+from odoo.tests.common import BaseCase
 
 from lxml import objectify
+import requests
+from requests.adapters import BaseAdapter
 
 
 class PayhereCommon(PaymentAcquirerCommon):
@@ -35,6 +54,16 @@ class PayhereCommon(PaymentAcquirerCommon):
         self.dankord_pbs = (('76009244561', '123'), ('5019717010103742', '123'))
         self.switch_polo = (('6331101999990016', '123'))
 
+    def _create_tx(self, reference, amount=1.95, **values):
+        return self.env['payment.transaction'].create(dict({
+            'amount': amount,
+            'acquirer_id': self.payhere.id,
+            'currency_id': self.currency_euro.id,
+            'reference': reference,
+            'partner_name': 'Norbert Buyer',
+            'partner_country_id': self.country_france.id,
+        }, **values))
+
 
 @tagged('post_install', '-at_install', 'external', '-standard')
 class PayhereForm(PayhereCommon):
@@ -122,6 +151,19 @@ class PayhereForm(PayhereCommon):
                 self.assertEqual(form_input.get('value'), '1.57', 'payhere: wrong computed fees')
         self.assertTrue(handling_found, 'payhere: fees_active did not add handling input in rendered form')
 
+    def test_12_payhere_form_preapproval(self):
+        # saving the card: the form is posted to the preapproval endpoint
+        res = self.payhere.render(
+            'test_ref0', 12.50, self.currency_euro.id,
+            values=dict(self.buyer_values, type='form_save'))
+        data_set = objectify.fromstring(res).xpath("//input[@name='data_set']")
+        self.assertEqual(data_set[0].get('data-action-url'), 'https://sandbox.payhere.lk/pay/preapprove', 'payhere: wrong form POST url')
+
+        self.payhere.write({'save_token': 'always'})
+        res = self.payhere.render('test_ref0', 12.50, self.currency_euro.id, values=self.buyer_values)
+        data_set = objectify.fromstring(res).xpath("//input[@name='data_set']")
+        self.assertEqual(data_set[0].get('data-action-url'), 'https://sandbox.payhere.lk/pay/preapprove', 'payhere: wrong form POST url')
+
     @mute_logger('odoo.addons.payment_payhere.models.payment', 'ValidationError')
     def test_20_payhere_form_management(self):
         # be sure not to do stupid things
@@ -204,3 +246,921 @@ class PayhereForm(PayhereCommon):
         self.assertEqual(tx.state, 'done', 'payhere: wrong state after receiving a valid pending notification')
         self.assertEqual(tx.acquirer_reference, '08D73520KX778924N', 'payhere: wrong txn_id after receiving a valid pending notification')
         self.assertEqual(fields.Datetime.to_string(tx.date), '2013-11-18 11:21:19', 'payhere: wrong validation date')
+
+
+@tagged('post_install', '-at_install')
+class PayhereNotification(PayhereCommon):
+
+    def setUp(self):
+        super(PayhereNotification, self).setUp()
+        self.payhere.write({'payhere_merchant_secret': 'dummy_secret'})
+        self.tx = self._create_tx('test_ref_md5sig')
+
+    def _get_notification_data(self, status_code='2', **values):
+        data = {
+            'merchant_id': 'dummy',
+            'order_id': 'test_ref_md5sig',
+            'payment_id': '320025071278',
+            'payhere_amount': '1.95',
+            'payhere_currency': 'EUR',
+            'status_code': status_code,
+        }
+        data.update(values)
+        data['md5sig'] = self.payhere._payhere_compute_md5sig(data)
+        return data
+
+    def test_10_payhere_md5sig(self):
+        data = self._get_notification_data()
+        expected = hashlib.md5(
+            ('dummytest_ref_md5sig1.95EUR2' + hashlib.md5(b'dummy_secret').hexdigest().upper()).encode()
+        ).hexdigest().upper()
+        self.assertEqual(data['md5sig'], expected, 'payhere: wrong md5sig computation')
+        self.assertTrue(self.payhere._payhere_check_md5sig(data))
+        self.assertTrue(self.payhere._payhere_check_md5sig(dict(data, md5sig=expected.lower())))
+        self.assertFalse(self.payhere._payhere_check_md5sig(dict(data, payhere_amount='195.00')))
+
+        # changing the secret invalidates the cached hash
+        self.payhere.write({'payhere_merchant_secret': 'other_secret'})
+        self.assertFalse(self.payhere._payhere_check_md5sig(data))
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_20_payhere_validate_data(self):
+        # forged notification: ignored, the transaction is left untouched
+        forged = dict(self._get_notification_data(), md5sig='0' * 32)
+        self.assertFalse(self.env['payment.transaction']._payhere_validate_data(forged))
+        self.assertEqual(self.tx.state, 'draft', 'payhere: forged notification altered the transaction')
+
+        self.env['payment.transaction']._payhere_validate_data(self._get_notification_data())
+        self.assertEqual(self.tx.state, 'done', 'payhere: wrong state after receiving a valid notification')
+        self.assertEqual(self.tx.acquirer_reference, '320025071278', 'payhere: wrong payment_id after receiving a valid notification')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_22_payhere_preapproval_token(self):
+        tx = self._create_tx('test_ref_preapproval', partner_id=self.buyer_id, type='form_save')
+        self.assertTrue(tx._payhere_get_onsite_payload(self.payhere.get_base_url())['preapprove'])
+        data = self._get_notification_data(order_id='test_ref_preapproval', customer_token='customer_token',
+                                           card_no='************1292')
+        self.env['payment.transaction']._payhere_validate_data(data)
+        self.assertEqual(tx.state, 'done')
+        token = tx.payment_token_id
+        self.assertEqual((token.acquirer_ref, token.acquirer_id, token.partner_id.id, token.name),
+                         ('customer_token', self.payhere, self.buyer_id, '************1292'),
+                         'payhere: customer token of the preapproval not stored')
+
+        # a plain checkout does not save the card
+        data = self._get_notification_data(customer_token='customer_token')
+        self.env['payment.transaction']._payhere_validate_data(data)
+        self.assertEqual(self.tx.state, 'done')
+        self.assertFalse(self.tx.payment_token_id, 'payhere: customer token stored for a plain checkout')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_notification')
+    def test_30_payhere_duplicate_notifications(self):
+        Notification = self.env['payment.payhere.notification']
+        data = self._get_notification_data()
+        notification_id = Notification._enqueue(data)
+        self.assertTrue(notification_id)
+        self.assertIsNone(Notification._enqueue(data), 'payhere: duplicate notification was queued')
+        self.assertTrue(Notification._enqueue(self._get_notification_data(status_code='0')), 'payhere: new status was discarded')
+
+        # an unsigned notification does not claim the fingerprint of the
+        # genuine one
+        genuine = self._get_notification_data(payment_id='320025071279')
+        self.assertTrue(Notification._enqueue(dict(genuine, md5sig='forged')))
+        self.assertTrue(Notification._enqueue(genuine), 'payhere: a forged notification discarded the genuine one')
+
+        Notification.browse(notification_id).write({'state': 'error'})
+        self.assertEqual(Notification._enqueue(data), notification_id, 'payhere: failed notification was not queued again')
+        Notification.invalidate_cache()
+        self.assertEqual(Notification.browse(notification_id).state, 'queued')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_notification')
+    def test_32_payhere_queue_processing(self):
+        Notification = self.env['payment.payhere.notification'].sudo()
+        notification = Notification.browse(Notification._enqueue(self._get_notification_data()))
+        self.assertEqual(Notification._cron_process_queue(), 1)
+        self.assertEqual(notification.state, 'done')
+        self.assertEqual(self.tx.state, 'done')
+
+        # the garbage collector only removes the old processed notifications
+        old = Notification.browse(Notification._enqueue(self._get_notification_data(payment_id='320025071279')))
+        old._process()
+        old.write({'date_processed': fields.Datetime.now() - timedelta(days=31)})
+        Notification._cron_garbage_collect()
+        self.assertFalse(old.exists(), 'payhere: old notification was not garbage collected')
+        self.assertTrue(notification.exists(), 'payhere: recent notification was garbage collected')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_notification')
+    def test_34_payhere_queue_attempts(self):
+        Notification = self.env['payment.payhere.notification'].sudo()
+        self.env['ir.config_parameter'].sudo().set_param('payment_payhere.queue_max_attempts', 2)
+        notification = Notification.browse(Notification._enqueue(self._get_notification_data()))
+        Transaction = type(self.env['payment.transaction'])
+        with patch.object(Transaction, '_payhere_validate_data', side_effect=ValueError('boom'), autospec=True):
+            notification._process()
+            self.assertEqual((notification.state, notification.attempts), ('queued', 1))
+            self.assertGreater(notification.date_next_attempt, fields.Datetime.now(), 'payhere: failed notification was not backed off')
+            self.assertEqual(Notification._process_batch(10), 0, 'payhere: backed off notification was processed')
+            notification._process()
+        self.assertEqual((notification.state, notification.attempts), ('error', 2))
+        self.assertEqual(notification.state_message, 'boom')
+
+    def test_36_payhere_inbox_full(self):
+        Notification = self.env['payment.payhere.notification'].sudo()
+        ICP = self.env['ir.config_parameter'].sudo()
+        ICP.set_param('payment_payhere.queue_max_size', 1)
+        self.assertFalse(Notification._is_inbox_full())
+        Notification._enqueue(self._get_notification_data())
+        self.assertTrue(Notification._is_inbox_full())
+        ICP.set_param('payment_payhere.queue_max_size', 0)
+        self.assertFalse(Notification._is_inbox_full(), 'payhere: a size of 0 should disable the backpressure')
+
+    def test_38_payhere_find_tx(self):
+        Transaction = self.env['payment.transaction']
+        data = self._get_notification_data()
+        Transaction.flush()
+        with self.assertQueryCount(1):
+            self.assertEqual(Transaction._payhere_find_tx(data, self.payhere), self.tx)
+        self.tx.acquirer_reference = '320025071278'
+        Transaction.flush()
+        with self.assertQueryCount(1):
+            self.assertEqual(Transaction._payhere_find_tx(data, self.payhere), self.tx)
+        # the payment_id of a transaction does not resolve another reference
+        self.assertFalse(Transaction._payhere_find_tx(dict(data, order_id='test_ref_other')))
+        self.assertFalse(Transaction._payhere_find_tx(data, self.payhere.copy()))
+        # without order_id, the payment_id is looked up on its own
+        with self.assertQueryCount(1):
+            self.assertEqual(Transaction._payhere_find_tx({'payment_id': '320025071278'}, self.payhere), self.tx)
+
+    def test_40_payhere_invite_mail_deduplicated(self):
+        self.payhere.write({'payhere_seller_account': False, 'payhere_pdt_token': False})
+        mails = self.env['mail.mail'].sudo().search([('subject', '=', 'Add your Payhere account to Odoo')])
+        self.tx.form_feedback(self._get_notification_data(status_code='0'), 'payhere')
+        self.assertEqual(self.tx.state, 'pending')
+        self.assertTrue(self.payhere._payhere_queue_invite_mail() is False, 'payhere: invite mail sent during the cooldown')
+        new_mails = self.env['mail.mail'].sudo().search([('subject', '=', 'Add your Payhere account to Odoo')]) - mails
+        self.assertEqual(len(new_mails), 1, 'payhere: invite mail was not queued exactly once')
+        self.assertEqual(new_mails.state, 'outgoing', 'payhere: invite mail was sent synchronously')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_50_payhere_form_feedback_batch(self):
+        tx_pending = self._create_tx('test_ref_batch', 2.50)
+        payloads = [
+            self._get_notification_data(),
+            self._get_notification_data(
+                status_code='0', order_id='test_ref_batch', payment_id='320025071279', payhere_amount='2.50'),
+            self._get_notification_data(order_id='test_ref_batch', payment_id='320025071279', payhere_amount='9.99'),
+            self._get_notification_data(order_id='unknown_ref'),
+            # unsigned or from another merchant: never applied
+            dict(self._get_notification_data(order_id='test_ref_batch', payment_id='320025071279',
+                                              payhere_amount='2.50'), md5sig='forged'),
+            self._get_notification_data(merchant_id='intruder', order_id='test_ref_batch'),
+        ]
+        report = self.env['payment.transaction']._payhere_form_feedback_batch(payloads)
+        self.assertEqual(
+            [item['result'] for item in report], ['done', 'pending', 'invalid', 'not_found', 'invalid', 'invalid'],
+            'payhere: wrong batch feedback report')
+        self.assertEqual(self.tx.state, 'done')
+        self.assertEqual(self.tx.acquirer_reference, '320025071278')
+        self.assertEqual(tx_pending.state, 'pending')
+        self.assertEqual(tx_pending.acquirer_reference, '320025071279')
+        self.assertEqual(tx_pending.payhere_txn_type, 'inbound')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_60_payhere_concurrent_handlers(self):
+        Notification = self.env['payment.payhere.notification'].sudo()
+        notification = Notification.browse(Notification._enqueue(self._get_notification_data()))
+        # another handler is updating the transaction
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT pg_advisory_xact_lock(%s, %s)", (PAYHERE_LOCK_NAMESPACE, self.tx.id))
+            with self.assertRaises(PayhereTransactionLocked):
+                self.env['payment.transaction']._payhere_validate_data(self._get_notification_data())
+            notification._process()
+            self.assertEqual(notification.state, 'queued', 'payhere: locked notification was not deferred')
+            self.assertEqual(notification.attempts, 0, 'payhere: locked notification consumed an attempt')
+            self.assertEqual(self.tx.state, 'draft')
+            report = self.env['payment.transaction']._payhere_form_feedback_batch([self._get_notification_data()])
+            self.assertEqual(report[0]['result'], 'locked')
+            cr.rollback()
+
+        notification._process()
+        self.assertEqual(notification.state, 'done')
+        self.assertEqual(self.tx.state, 'done')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_70_payhere_status_etag(self):
+        Transaction = self.env['payment.transaction']
+        status, etag = Transaction._payhere_get_status(self.tx.ids)
+        self.assertEqual(status, [{'id': self.tx.id, 'reference': 'test_ref_md5sig', 'state': 'draft'}])
+        self.assertEqual(Transaction._payhere_get_status(self.tx.ids)[1], etag, 'payhere: unstable ETag')
+
+        dispatcher = StateDispatcher(ready_timeout=0)
+        with patch.object(StateDispatcher, '_loop'), dispatcher.subscribe(self.env.cr.dbname, self.tx.ids) as event:
+            self.tx.form_feedback(self._get_notification_data(), 'payhere')
+            dispatcher._wake(self.env.cr.dbname, [self.tx.id + 1])
+            self.assertFalse(event.is_set(), 'payhere: waiter woken by another transaction')
+            dispatcher._wake(self.env.cr.dbname, self.tx.ids)
+            self.assertTrue(event.is_set())
+        self.assertFalse(dispatcher._waiters, 'payhere: waiter left registered')
+        self.tx.flush()
+        status, new_etag = Transaction._payhere_get_status(self.tx.ids)
+        self.assertEqual(status[0]['state'], 'done')
+        self.assertNotEqual(new_etag, etag, 'payhere: ETag unchanged after a state change')
+
+        # failed payments wake the waiters too
+        failed = self._create_tx('test_ref_failed')
+        with patch.object(type(failed), '_payhere_notify_state', autospec=True) as notify_state:
+            Transaction._payhere_validate_data(self._get_notification_data(status_code='-2', order_id='test_ref_failed'))
+        self.assertEqual(failed.state, 'error')
+        self.assertEqual([call[0][0] for call in notify_state.call_args_list], [failed],
+                         'payhere: waiters not notified of the failed payment')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_80_payhere_merchant_routing(self):
+        Acquirer = self.env['payment.acquirer']
+        company = self.env['res.company'].create({'name': 'Payhere Second Company'})
+        other = self.payhere.copy({
+            'name': 'Payhere Second Company',
+            'payhere_email_account': 'other',
+            'payhere_merchant_secret': 'other_secret',
+            'company_id': company.id,
+        })
+        self.assertEqual(Acquirer._payhere_get_merchant('dummy'), self.payhere)
+        routed = Acquirer._payhere_get_merchant('other')
+        self.assertEqual(routed, other, 'payhere: new acquirer missing from the merchant index')
+        self.assertEqual(routed.env.context.get('allowed_company_ids'), [company.id],
+                         'payhere: notification not dispatched in the merchant company')
+        self.assertFalse(Acquirer._payhere_get_merchant('unknown'))
+
+        # unknown merchants are rejected before any transaction search
+        with patch.object(type(self.env['payment.transaction']), '_payhere_find_tx') as find_tx:
+            self.assertFalse(self.env['payment.transaction']._payhere_validate_data(
+                dict(self._get_notification_data(), merchant_id='unknown')))
+            find_tx.assert_not_called()
+
+        # a merchant cannot settle the transactions of another merchant
+        data = dict(self._get_notification_data(), merchant_id='other')
+        data['md5sig'] = other._payhere_compute_md5sig(data)
+        self.env['payment.transaction']._payhere_validate_data(data)
+        self.assertEqual(self.tx.state, 'draft')
+
+        other.write({'payhere_email_account': 'renamed'})
+        self.assertFalse(Acquirer._payhere_get_merchant('other'), 'payhere: merchant index not invalidated')
+        self.assertEqual(Acquirer._payhere_get_merchant('renamed'), other)
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_journal')
+    def test_90_payhere_journal(self):
+        Journal = self.env['payment.payhere.journal'].sudo()
+        data = dict(self._get_notification_data(), email=' norbert@example.com ', custom_1='')
+        forged = dict(data, payment_id='320025071279', md5sig='forged')
+        Journal._append([('ipn', data, None, 'queued'), ('ipn', forged, None, 'queued')])
+        entries = Journal.search([('reference', '=', 'test_ref_md5sig')])
+        self.assertEqual(len(entries), 2)
+        entry = entries.filtered(lambda entry: entry.payment_id == '320025071278')
+        self.assertEqual((entry.status_code, entry.source, entry.outcome), ('2', 'ipn', 'queued'))
+        payload = json.loads(entry.payload_text)
+        self.assertEqual(payload['email'], 'norbert@example.com', 'payhere: payload not normalized')
+        self.assertNotIn('custom_1', payload)
+
+        # the replay goes through the checks of the notifications, and is not
+        # journaled again
+        self.assertEqual((entries - entry).action_replay(), 0)
+        self.assertEqual(self.tx.state, 'draft', 'payhere: a forged journal entry was applied')
+        self.assertEqual(entry.action_replay(), 1)
+        self.assertEqual(self.tx.state, 'done')
+        self.assertEqual(Journal.search_count([('reference', '=', 'test_ref_md5sig')]), 2)
+
+        # retention drops the whole partitions past the retention period
+        self.env.cr.execute("""
+            CREATE TABLE payment_payhere_journal_y2000m01 PARTITION OF payment_payhere_journal
+            FOR VALUES FROM ('2000-01-01') TO ('2000-02-01')
+        """)
+        Journal._cron_retention()
+        self.assertNotIn('payment_payhere_journal_y2000m01', [name for name, _month in Journal._get_partitions()])
+        self.assertTrue(Journal.search([('reference', '=', 'test_ref_md5sig')]), 'payhere: recent entries were dropped')
+
+    def test_95_payhere_onsite_payload(self):
+        base_url = self.payhere.get_base_url()
+        payload = self.tx._payhere_get_onsite_payload(base_url)
+        hashed_secret = hashlib.md5(b'dummy_secret').hexdigest().upper()
+        expected = hashlib.md5(('dummytest_ref_md5sig1.95EUR' + hashed_secret).encode('utf-8')).hexdigest().upper()
+        self.assertEqual(payload['hash'], expected, 'payhere: wrong onsite checkout hash')
+        self.assertEqual((payload['order_id'], payload['amount'], payload['currency'], payload['first_name']),
+                         ('test_ref_md5sig', '1.95', 'EUR', 'Norbert'))
+        self.assertTrue(payload['sandbox'])
+        self.assertIs(self.tx._payhere_get_onsite_payload(base_url), payload, 'payhere: onsite payload not cached')
+
+        # the payload is signed with the amount the notification will carry
+        self.payhere.write({'fees_active': True})
+        tx = self._create_tx('test_ref_onsite_fees', 10.0)
+        self.assertTrue(tx.fees, 'payhere: fees not computed')
+        payload = tx._payhere_get_onsite_payload(base_url)
+        self.assertEqual(payload['amount'], '%.2f' % (tx.amount + tx.fees))
+        self.assertEqual(payload['hash'], self.payhere._payhere_compute_checkout_hash(
+            'test_ref_onsite_fees', tx.amount + tx.fees, 'EUR'))
+
+
+@tagged('post_install', '-at_install')
+class PayhereIpnRoute(HttpCase):
+
+    def setUp(self):
+        super(PayhereIpnRoute, self).setUp()
+        self.payhere = self.env.ref('payment.payment_acquirer_payhere')
+        self.payhere.write({
+            'payhere_email_account': 'dummy',
+            'payhere_merchant_secret': 'dummy_secret',
+            'state': 'test',
+        })
+        self.Notification = self.env['payment.payhere.notification'].sudo()
+        self.data = {
+            'merchant_id': 'dummy',
+            'order_id': 'test_ref_ipn',
+            'payment_id': '320025071278',
+            'payhere_amount': '1.95',
+            'payhere_currency': 'EUR',
+            'status_code': '2',
+        }
+        self.data['md5sig'] = self.payhere._payhere_compute_md5sig(self.data)
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_notification', 'odoo.addons.payment_payhere.controllers.main')
+    def test_10_payhere_ipn_enqueue(self):
+        tx = self.env['payment.transaction'].create({
+            'amount': 1.95,
+            'acquirer_id': self.payhere.id,
+            'currency_id': self.env.ref('base.EUR').id,
+            'reference': 'test_ref_ipn',
+            'partner_name': 'Norbert Buyer',
+            'partner_country_id': self.env.ref('base.fr').id,
+        })
+        response = self.url_open(PayhereController._notify_url, data=self.data)
+        self.assertEqual(response.status_code, 200)
+        notification = self.Notification.search([('reference', '=', 'test_ref_ipn')])
+        self.assertEqual(len(notification), 1, 'payhere: notification was not queued')
+        self.assertEqual(notification.state, 'queued', 'payhere: notification was processed by the route')
+        self.assertEqual(json.loads(notification.payload), self.data)
+
+        # a retry of Payhere is acknowledged without being queued again
+        self.assertEqual(self.url_open(PayhereController._notify_url, data=self.data).status_code, 200)
+        self.assertEqual(self.Notification.search_count([('reference', '=', 'test_ref_ipn')]), 1)
+
+        # forged notifications are acknowledged without being stored, and do
+        # not prevent the genuine one from being queued
+        forged = dict(self.data, payment_id='320025071279', md5sig='forged')
+        self.assertEqual(self.url_open(PayhereController._notify_url, data=forged).status_code, 200)
+        self.assertEqual(self.Notification.search_count([('reference', '=', 'test_ref_ipn')]), 1, 'payhere: forged notification was queued')
+        self.url_open(PayhereController._notify_url, data=dict(self.data, payment_id='320025071279'))
+        self.assertEqual(self.Notification.search_count([('reference', '=', 'test_ref_ipn')]), 2)
+
+        # unknown merchants are acknowledged and dropped
+        response = self.url_open(PayhereController._notify_url, data=dict(self.data, merchant_id='intruder', order_id='test_ref_intruder'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.Notification.search([('reference', '=', 'test_ref_intruder')]))
+
+        # every notification received is journaled, as posted
+        entries = self.env['payment.payhere.journal'].sudo().search(
+            [('reference', 'in', ('test_ref_ipn', 'test_ref_intruder'))], order='id')
+        self.assertEqual(entries.mapped('outcome'), ['queued', 'duplicate', 'queued', 'unknown_merchant'])
+        self.assertEqual(entries.mapped(lambda entry: entry.transaction_id.id), [tx.id, tx.id, tx.id, False],
+                         'payhere: journal entries not linked to their transaction')
+        self.assertEqual(json.loads(entries[0].payload_text), self.data)
+
+    @mute_logger('odoo.addons.payment_payhere.controllers.main')
+    def test_20_payhere_ipn_backpressure(self):
+        self.env['ir.config_parameter'].sudo().set_param('payment_payhere.queue_max_size', 1)
+        self.Notification._enqueue(dict(self.data, payment_id='320025071279'))
+        response = self.url_open(PayhereController._notify_url, data=self.data)
+        self.assertEqual(response.status_code, 503, 'payhere: full inbox did not answer 503')
+        self.assertEqual(response.headers.get('Retry-After'), '60')
+        self.assertFalse(self.Notification.search([('fingerprint', 'like', '320025071278:%')]))
+        entry = self.env['payment.payhere.journal'].sudo().search([('payment_id', '=', '320025071278')])
+        self.assertEqual(entry.outcome, 'deferred', 'payhere: deferred notification not journaled')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_30_payhere_queue_workers(self):
+        tx = self.env['payment.transaction'].create({
+            'amount': 1.95,
+            'acquirer_id': self.payhere.id,
+            'currency_id': self.env.ref('base.EUR').id,
+            'reference': 'test_ref_ipn',
+            'partner_name': 'Norbert Buyer'})
+        notifications = self.Notification.browse([
+            self.Notification._enqueue(self.data),
+            self.Notification._enqueue(dict(self.data, order_id='test_ref_unknown', payment_id='320025071279')),
+        ])
+        self.env['ir.config_parameter'].sudo().set_param('payment_payhere.queue_workers', 2)
+        # outside of the test thread, batches run concurrently in their own
+        # cursors (test cursors here)
+        with patch.object(threading.currentThread(), 'testing', False):
+            self.assertEqual(self.Notification._cron_process_queue(), 2)
+        notifications.invalidate_cache()
+        self.assertEqual(notifications.mapped('state'), ['done', 'done'])
+        tx.invalidate_cache()
+        self.assertEqual(tx.state, 'done')
+
+
+@tagged('post_install', '-at_install')
+class PayhereApi(PayhereCommon):
+
+    def setUp(self):
+        super(PayhereApi, self).setUp()
+        self.payhere.write({'payhere_app_id': 'dummy_app', 'payhere_app_secret': 'dummy_app_secret'})
+
+    def _mock_response(self, status_code, payload):
+        response = Mock(status_code=status_code)
+        response.json.return_value = payload
+        return response
+
+    def test_10_payhere_access_token_cache(self):
+        calls = []
+
+        def request(method, url, **kwargs):
+            calls.append(url)
+            if url.endswith('/token'):
+                return self._mock_response(200, {'access_token': 'token_%s' % len(calls), 'expires_in': 599})
+            return self._mock_response(200, {'status': 1, 'data': [{'order_id': 'test_ref', 'status': 'RECEIVED'}]})
+
+        with patch.object(payhere_client, 'request', side_effect=request):
+            payments = self.payhere.payhere_retrieve_payments('test_ref')
+            self.payhere.payhere_retrieve_payments('test_ref')
+        self.assertEqual(payments, [{'order_id': 'test_ref', 'status': 'RECEIVED'}])
+        self.assertEqual(len([url for url in calls if url.endswith('/token')]), 1, 'payhere: access token was not cached')
+        self.assertEqual(self.payhere.payhere_access_token, 'token_1', 'payhere: access token was not shared')
+
+        # changing the credentials discards the token
+        self.payhere.write({'payhere_app_secret': 'other_secret'})
+        self.assertFalse(self.payhere.payhere_access_token)
+
+    def test_20_payhere_reconcile(self):
+        txs = self.env['payment.transaction']
+        for reference in ('test_ref_done', 'test_ref_cancel', 'test_ref_unknown', 'test_ref_tampered'):
+            txs |= self._create_tx(reference)
+        self.env.cr.execute(
+            "UPDATE payment_transaction SET create_date = now() at time zone 'UTC' - interval '1 hour' WHERE id IN %s",
+            (tuple(txs.ids),))
+        txs.invalidate_cache()
+        retrieved = {
+            'test_ref_done': [{'payment_id': 320025071278, 'order_id': 'test_ref_done', 'status': 'RECEIVED',
+                               'amount': 1.95, 'currency': 'EUR'}],
+            'test_ref_cancel': [{'payment_id': 320025071279, 'order_id': 'test_ref_cancel', 'status': 'CHARGEBACKED'}],
+            # the customer tampered with the amount of the checkout
+            'test_ref_tampered': [{'payment_id': 320025071280, 'order_id': 'test_ref_tampered', 'status': 'RECEIVED',
+                                   'amount': 0.01, 'currency': 'EUR'}],
+        }
+
+        def request(method, url, **kwargs):
+            if url.endswith('/token'):
+                return self._mock_response(200, {'access_token': 'token', 'expires_in': 599})
+            data = retrieved.get(kwargs['params']['order_id'])
+            return self._mock_response(200, {'status': 1, 'data': data} if data else {'status': -1})
+
+        with patch.object(payhere_client, 'request', side_effect=request):
+            report = self.env['payment.transaction']._cron_payhere_reconcile()
+        self.assertEqual(report['processed'], 4)
+        self.assertEqual(report['updated'], 2)
+        self.assertEqual(txs.mapped('state'), ['done', 'cancel', 'draft', 'draft'], 'payhere: wrong states after reconciliation')
+        self.assertEqual(txs[0].acquirer_reference, '320025071278')
+        self.assertFalse(txs[3].acquirer_reference, 'payhere: a tampered payment was applied')
+
+    def test_30_payhere_return_status_check(self):
+        tx = self._create_tx('test_ref_return')
+        Notification = self.env['payment.payhere.notification'].sudo()
+        Transaction = self.env['payment.transaction']
+
+        # the return route never reaches Payhere, it queues a single check
+        with patch.object(payhere_client, 'request', side_effect=AssertionError('payhere: called during the return')):
+            self.assertTrue(Transaction._payhere_handle_return('test_ref_return'))
+            self.assertFalse(Transaction._payhere_handle_return('test_ref_return'), 'payhere: status check queued twice')
+            self.assertFalse(Transaction._payhere_handle_return('unknown_ref'))
+        check = Notification.search([('fingerprint', '=', 'check:test_ref_return')])
+        self.assertEqual(len(check), 1)
+        self.assertTrue(check.date_next_attempt, 'payhere: status check was not delayed')
+
+        def request(method, url, **kwargs):
+            if url.endswith('/token'):
+                return self._mock_response(200, {'access_token': 'token', 'expires_in': 599})
+            return self._mock_response(200, {'status': 1, 'data': [
+                {'payment_id': 320025071280, 'order_id': 'test_ref_return', 'status': 'RECEIVED',
+                 'amount': 1.95, 'currency': 'EUR'}]})
+
+        with patch.object(payhere_client, 'request', side_effect=request):
+            check._process()
+        self.assertEqual(check.state, 'done')
+        self.assertEqual(tx.state, 'done', 'payhere: status check did not settle the transaction')
+        self.assertEqual(tx.acquirer_reference, '320025071280')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_40_payhere_scheduled_charges(self):
+        token = self.env['payment.token'].create({
+            'name': '************1292',
+            'acquirer_ref': 'customer_token',
+            'acquirer_id': self.payhere.id,
+            'partner_id': self.buyer_id,
+        })
+        Charge = self.env['payment.payhere.charge']
+        values = {'name': 'Monthly plan', 'token_id': token.id, 'amount': 9.99, 'currency_id': self.currency_euro.id}
+        charge_ok = Charge.create(dict(values, idempotency_key='test_charge_ok'))
+        charge_declined = Charge.create(dict(values, idempotency_key='test_charge_declined'))
+        charge_later = Charge.create(dict(values, idempotency_key='test_charge_later', date_due='2999-01-01'))
+
+        # interrupted after the call: checked on Payhere, never charged again
+        interrupted = Charge.create(dict(values, idempotency_key='test_charge_interrupted'))
+        interrupted.write({'state': 'processing', 'transaction_id': self._create_tx(
+            'test_charge_interrupted', 9.99, partner_id=self.buyer_id, payment_token_id=token.id,
+            type='server2server').id})
+        self.env.cr.execute(
+            "UPDATE payment_payhere_charge SET write_date = now() at time zone 'UTC' - interval '1 hour' WHERE id = %s",
+            (interrupted.id,))
+        interrupted.invalidate_cache()
+
+        charged = []
+
+        def request(method, url, **kwargs):
+            if url.endswith('/token'):
+                return self._mock_response(200, {'access_token': 'token', 'expires_in': 599})
+            if url.endswith('/search'):
+                return self._mock_response(200, {'status': 1, 'data': [
+                    {'payment_id': 320025071281, 'order_id': kwargs['params']['order_id'], 'status': 'RECEIVED',
+                     'amount': 9.99, 'currency': 'EUR'}]})
+            self.assertFalse(kwargs.get('retry', True), 'payhere: a charge was retried')
+            charged.append(kwargs['json']['order_id'])
+            if kwargs['json']['order_id'] == 'test_charge_declined':
+                return self._mock_response(200, {'status': -1, 'msg': 'Card declined'})
+            return self._mock_response(200, {'status': 1, 'data': {
+                'order_id': kwargs['json']['order_id'], 'payment_id': 320025071282, 'status_code': 2}})
+
+        with patch.object(payhere_client, 'request', side_effect=request):
+            self.assertEqual(Charge._cron_process_charges(), 3)
+        self.assertEqual(sorted(charged), ['test_charge_declined', 'test_charge_ok'])
+        self.assertEqual(charge_ok.state, 'done')
+        self.assertEqual(charge_ok.transaction_id.acquirer_reference, '320025071282')
+        self.assertEqual(charge_declined.state, 'failed')
+        self.assertEqual(charge_declined.state_message, 'Card declined')
+        self.assertEqual(charge_later.state, 'scheduled')
+        self.assertEqual(interrupted.state, 'done')
+        self.assertEqual(interrupted.transaction_id.acquirer_reference, '320025071281')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment')
+    def test_50_payhere_batch_refunds(self):
+        txs = self.env['payment.transaction']
+        for index in range(5):
+            txs |= self._create_tx('test_ref_refund_%s' % index, 10.0, acquirer_reference='32002507130%s' % index)
+        with self.assertRaises(UserError):
+            txs.payhere_refund('Event cancelled')
+        txs._set_transaction_done()
+        refunds = txs[:2].payhere_refund('Event cancelled')
+
+        # two partial refunds of one payment are sent and recorded separately
+        partial = txs[3].payhere_refund('Late delivery', amount=3.0) | txs[3].payhere_refund('Damaged item', amount=2.0)
+
+        # interrupted after the call: checked on Payhere, never refunded twice
+        interrupted = txs[2].payhere_refund('Event cancelled')
+        txs[4].payhere_refund('Late delivery', amount=3.0).write({'state': 'done'})
+        ambiguous = txs[4].payhere_refund('Damaged item', amount=2.0)
+        self.env.cr.execute(
+            "UPDATE payment_payhere_refund SET state = 'processing', write_date = now() at time zone 'UTC' - interval '1 hour' WHERE id IN %s",
+            (tuple((interrupted | ambiguous).ids),))
+        (interrupted | ambiguous).invalidate_cache()
+
+        refunded = []
+
+        def request(method, url, **kwargs):
+            if url.endswith('/token'):
+                return self._mock_response(200, {'access_token': 'token', 'expires_in': 599})
+            if url.endswith('/search'):
+                return self._mock_response(200, {'status': 1, 'data': [
+                    {'order_id': kwargs['params']['order_id'], 'status': 'REFUNDED'}]})
+            refunded.append(kwargs['json']['payment_id'])
+            if kwargs['json']['payment_id'] == '320025071301':
+                return self._mock_response(200, {'status': -1, 'msg': 'Payment already refunded'})
+            refund_id = int(kwargs['json'].get('amount', 0) * 1000) or 4321
+            return self._mock_response(200, {'status': 1, 'msg': 'Successfully processed', 'data': refund_id})
+
+        with patch.object(payhere_client, 'request', side_effect=request):
+            self.assertEqual(self.env['payment.payhere.refund']._cron_process_refunds(), 6)
+        self.assertEqual(sorted(refunded), ['320025071300', '320025071301', '320025071303', '320025071303'])
+        self.assertEqual(refunds.mapped('state'), ['done', 'failed'])
+        self.assertEqual(refunds[0].payhere_refund_id, '4321')
+        self.assertEqual(refunds[1].state_message, 'Payment already refunded')
+        self.assertEqual(partial.mapped('state'), ['done', 'done'])
+        self.assertEqual(partial.mapped('payhere_refund_id'), ['3000', '2000'])
+        self.assertEqual(interrupted.state, 'done')
+        # Payhere does not tell which refund of the payment went through
+        self.assertEqual(ambiguous.state, 'failed', 'payhere: an ambiguous interrupted refund was marked done')
+        self.assertEqual(txs[0].payhere_refund_ids, refunds[0])
+
+
+@tagged('post_install', '-at_install')
+class PayhereCheckout(PayhereCommon):
+
+    def test_10_payhere_checkout_config(self):
+        base_url = self.env['ir.config_parameter'].get_param('web.base.url')
+        config = self.payhere._payhere_get_checkout_config(base_url)
+        self.assertEqual(config['merchant_id'], 'dummy')
+        self.assertEqual(config['form_url'], 'https://sandbox.payhere.lk/pay/checkout')
+        self.assertEqual(config['notify_url'], urls.url_join(base_url, PayhereController._notify_url))
+
+        # the snapshot is dropped when the acquirer is written
+        self.payhere.write({'payhere_email_account': 'other_merchant'})
+        self.assertEqual(self.payhere._payhere_get_checkout_config(base_url)['merchant_id'], 'other_merchant')
+
+    def test_20_payhere_compute_fees_batch(self):
+        self.payhere.write({
+            'fees_active': True,
+            'fees_dom_fixed': 1.0,
+            'fees_dom_var': 0.35,
+            'fees_int_fixed': 1.5,
+            'fees_int_var': 0.50,
+        })
+        company_country = self.payhere.company_id.country_id
+        items = [
+            (12.50, self.currency_euro.id, self.country_france.id),
+            (12.50, self.currency_euro.id, company_country.id),
+            (1999.99, self.currency_euro.id, None),
+            (0.0, self.currency_euro.id, False),
+        ]
+        self.assertEqual(
+            self.payhere.payhere_compute_fees_batch(items),
+            [self.payhere.payhere_compute_fees(*item) for item in items],
+            'payhere: batch fees differ from the fees computed one by one')
+
+        self.payhere.write({'fees_active': False})
+        self.assertEqual(self.payhere.payhere_compute_fees_batch(items), [0.0] * len(items))
+
+
+@tagged('post_install', '-at_install')
+class PayhereSettlementImport(PayhereCommon):
+
+    def test_10_payhere_settlement_import(self):
+        token = self.env['payment.token'].create({
+            'name': '************1292',
+            'acquirer_ref': 'customer_token',
+            'acquirer_id': self.payhere.id,
+            'partner_id': self.buyer_id,
+        })
+        txs = self.env['payment.transaction']
+        for reference, amount in (('test_ref_settled', 1.95), ('test_ref_mismatch', 3.00), ('test_ref_status', 4.00),
+                                  ('test_ref_chargeback', 6.00)):
+            txs |= self._create_tx(reference, amount)
+        txs[3]._set_transaction_done()
+        # charged with a token: the rows have no payer_id to check
+        txs |= self._create_tx('test_ref_token', 7.00, payment_token_id=token.id, type='server2server')
+        csv_data = '\n'.join([
+            'Order ID,Payment ID,Amount,Currency,Status',
+            'test_ref_settled,320025071278,1.95,EUR,RECEIVED',
+            'test_ref_mismatch,320025071279,2.00,EUR,RECEIVED',
+            'test_ref_unknown,320025071280,5.00,EUR,RECEIVED',
+            'test_ref_status,320025071281,4.00,EUR,SETTLED',
+            'test_ref_chargeback,320025071282,6.00,EUR,CHARGEBACKED',
+            'test_ref_token,320025071283,7.00,EUR,RECEIVED',
+        ])
+        settlement = self.env['payment.payhere.settlement'].create({
+            'acquirer_id': self.payhere.id,
+            'settlement_file': base64.b64encode(csv_data.encode('utf-8')),
+            'apply_corrections': True,
+        })
+        settlement.action_queue()
+        # chunks of two rows: the import goes through the chunked lookups
+        self.assertTrue(settlement._process(time.monotonic() + 60, chunk_size=2))
+        self.assertEqual(settlement.state, 'done')
+        self.assertEqual(settlement.rows_processed, 6)
+        self.assertEqual(settlement.rows_matched, 5)
+        self.assertEqual(
+            sorted(settlement.line_ids.mapped(lambda line: (line.reference, line.kind))),
+            [('test_ref_chargeback', 'state'), ('test_ref_mismatch', 'payhere_amount'), ('test_ref_mismatch', 'state'),
+             ('test_ref_settled', 'state'), ('test_ref_status', 'status'), ('test_ref_token', 'state'),
+             ('test_ref_unknown', 'missing')])
+        self.assertEqual(txs.mapped('state'), ['done', 'draft', 'draft', 'done', 'done'], 'payhere: wrong settlement corrections')
+        self.assertEqual(txs[0].acquirer_reference, '320025071278')
+
+
+class ReplayAdapter(BaseAdapter):
+    """ Transport answering the calls with ``outcomes`` in turn: an HTTP
+    status code, or an exception to raise. """
+
+    def __init__(self, outcomes):
+        super(ReplayAdapter, self).__init__()
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+@tagged('post_install', '-at_install')
+class PayhereHttpClient(BaseCase):
+
+    def _client(self, outcomes, **kwargs):
+        client = PayhereClient(backoff=0, **kwargs)
+        adapter = ReplayAdapter(outcomes)
+        client.session.mount('https://payhere.test/', adapter)
+        return client, adapter
+
+    def test_10_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow(), 'payhere: circuit opened before the threshold')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        # after the reset timeout, a single probe is let through
+        breaker.opened_at -= 30
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow(), 'payhere: more than one probe let through')
+        # a failed probe opens the circuit again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        breaker.opened_at -= 30
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+        self.assertTrue(breaker.allow())
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_request')
+    def test_20_client_retries(self):
+        client, adapter = self._client([503, requests.exceptions.ConnectionError('reset'), 200], failure_threshold=5)
+        self.assertEqual(client.request('GET', 'https://payhere.test/search').status_code, 200)
+        stats = client.get_stats()
+        self.assertEqual((adapter.calls, stats['requests'], stats['retries'], stats['failures']), (3, 3, 2, 2))
+        self.assertEqual(stats['breakers']['payhere.test']['state'], 'closed')
+
+        # exhausted retries answer the last response, or raise without one
+        client, adapter = self._client([503, 503, 503])
+        self.assertEqual(client.request('GET', 'https://payhere.test/search').status_code, 503)
+        self.assertEqual(adapter.calls, 3)
+        client, adapter = self._client([requests.exceptions.ReadTimeout('slow')] * 3)
+        with self.assertRaises(PayhereUnavailable):
+            client.request('GET', 'https://payhere.test/search')
+        self.assertEqual(adapter.calls, 3)
+
+        # calls that are not idempotent are never retried
+        client, adapter = self._client([requests.exceptions.ReadTimeout('slow')])
+        with self.assertRaises(PayhereUnavailable):
+            client.request('POST', 'https://payhere.test/charge', retry=False)
+        self.assertEqual((adapter.calls, client.get_stats()['retries']), (1, 0))
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_request')
+    def test_30_client_short_circuits(self):
+        client, adapter = self._client([requests.exceptions.ConnectionError('down')] * 2, failure_threshold=2)
+        with self.assertRaises(PayhereUnavailable):
+            client.request('GET', 'https://payhere.test/search')
+        self.assertEqual(adapter.calls, 2, 'payhere: the open circuit let a call through')
+        with self.assertRaises(PayhereUnavailable):
+            client.request('GET', 'https://payhere.test/search')
+        stats = client.get_stats()
+        self.assertEqual(stats['short_circuits'], 2)
+        self.assertEqual(stats['breakers']['payhere.test']['state'], 'open')
+        # the stats skip the transports without connection pool
+        self.assertEqual(stats['pools'], {})
+
+
+@tagged('post_install', '-at_install')
+class PayhereLogging(BaseCase):
+
+    def setUp(self):
+        super(PayhereLogging, self).setUp()
+        self.logger = logging.getLogger('odoo.addons.payment_payhere.tests.logging')
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+    def test_10_redact(self):
+        data = {'order_id': 'SO042', 'email': 'norbert@example.com', 'phone': '', 'md5sig': 'ABC'}
+        self.assertEqual(redact(data), {'order_id': 'SO042', 'email': '***', 'phone': '', 'md5sig': '***'})
+        self.assertEqual(data['email'], 'norbert@example.com', 'payhere: redact altered the payload')
+        self.assertNotIn('norbert', str(redacted(data)))
+
+        # nothing is redacted nor formatted for the records that are not emitted
+        with patch('odoo.addons.payment_payhere.models.payhere_logging.redact') as redact_mock:
+            self.logger.debug('Payhere data %s', redacted(data))
+        redact_mock.assert_not_called()
+
+    def test_20_sampled_logger(self):
+        sampled = SampledLogger(self.logger, burst=2, interval=60)
+        with self.assertLogs(self.logger, level='INFO') as logs:
+            for index in range(5):
+                sampled.warning('key', 'Payhere message %s', index)
+            sampled.info('other', 'Payhere other message')
+            # next interval: the suppressed records are reported
+            start, count, dropped = sampled._windows['key']
+            sampled._windows['key'] = (start - 60, count, dropped)
+            sampled.warning('key', 'Payhere message %s', 5)
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            'Payhere message 0',
+            'Payhere message 1',
+            'Payhere other message',
+            'Payhere message 5 (3 similar messages suppressed)',
+        ])
+
+    def test_30_notification_trace(self):
+        trace = NotificationTrace({'order_id': 'SO042', 'payment_id': '320025071278', 'status_code': '2'})
+        self.assertIsNone(NotificationTrace.current())
+        with trace:
+            self.assertIs(NotificationTrace.current(), trace)
+            with trace_stage('verify'):
+                pass
+        self.assertIsNone(NotificationTrace.current(), 'payhere: trace left current')
+        with trace_stage('feedback'):
+            pass
+        self.assertEqual(list(trace.timings), ['verify'], 'payhere: stage timed outside of the trace')
+
+        with self.assertLogs(self.logger, level='INFO') as logs:
+            trace.emit(self.logger, 'done')
+        self.assertEqual(len(logs.records), 1, 'payhere: a notification was not logged as one record')
+        message = logs.records[0].getMessage()
+        self.assertIn('cid=320025071278 reference=SO042 status=2 outcome=done', message)
+        self.assertIn('verify=', message)
+        trace.emit(self.logger, 'rejected', level=logging.DEBUG)
+        self.assertEqual(trace.outcome, 'rejected')
+
+
+@tagged('post_install', '-at_install')
+class PayhereMetrics(BaseCase):
+
+    def test_10_histogram_buckets(self):
+        histogram = payhere_metrics.Histogram('test_seconds', 'Test.', ('status',), buckets=(1.0, 0.1))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value, status='2')
+        histogram.observe(0.01, status='0')
+        samples = {
+            (name, dict(labels)['status'], dict(labels).get('le')): value
+            for name, labels, value in histogram.samples()
+        }
+        # cumulative buckets, bounds included
+        self.assertEqual(samples[('test_seconds_bucket', '2', '0.1')], 2)
+        self.assertEqual(samples[('test_seconds_bucket', '2', '1.0')], 3)
+        self.assertEqual(samples[('test_seconds_bucket', '2', '+Inf')], 4)
+        self.assertEqual(samples[('test_seconds_count', '2', None)], 4)
+        self.assertAlmostEqual(samples[('test_seconds_sum', '2', None)], 5.65)
+        self.assertEqual(samples[('test_seconds_count', '0', None)], 1, 'payhere: label values were mixed')
+
+    def test_20_render(self):
+        registry = payhere_metrics.Registry()
+        counter = registry.register(payhere_metrics.Counter('test_total', 'Test counter.', ('result',)))
+        counter.inc(result='queued')
+        counter.inc(2, result='quoted "value"\n')
+        body = registry.render([
+            ('test_gauge', 'gauge', 'Test gauge.', [('host', 'a')], 1),
+            ('test_gauge', 'gauge', 'Test gauge.', [('host', 'b')], 0),
+        ])
+        pid = os.getpid()
+        self.assertEqual(body.splitlines(), [
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total{pid="%s",result="queued"} 1' % pid,
+            'test_total{pid="%s",result="quoted \\"value\\"\\n"} 2' % pid,
+            '# HELP test_gauge Test gauge.',
+            '# TYPE test_gauge gauge',
+            'test_gauge{pid="%s",host="a"} 1' % pid,
+            'test_gauge{pid="%s",host="b"} 0' % pid,
+        ])
+        self.assertTrue(body.endswith('\n'))
+
+    def test_30_observe_notification(self):
+        trace = NotificationTrace({'order_id': 'SO042', 'payment_id': '320025071278', 'status_code': '2'})
+        trace.acquirer_id = 42
+        with trace.stage('verify'):
+            pass
+        trace.emit(logging.getLogger(__name__), 'done', level=logging.DEBUG)
+        payhere_metrics.observe_notification(trace)
+        labels = [dict(labels) for name, labels, value in payhere_metrics.notification_duration.samples()
+                  if name.endswith('_count')]
+        self.assertIn({'acquirer': '42', 'status': '2', 'outcome': 'done'}, labels, 'payhere: duration not labelled by status')
+        stages = [dict(labels) for name, labels, value in payhere_metrics.stage_duration.samples()
+                  if name.endswith('_count')]
+        self.assertIn({'acquirer': '42', 'stage': 'verify'}, stages)
+
+
+@tagged('post_install', '-at_install')
+class PayhereMetricsRoute(HttpCase):
+
+    def test_10_payhere_metrics_authentication(self):
+        url = '/payment/payhere/metrics'
+        self.assertEqual(self.url_open(url).status_code, 403, 'payhere: metrics readable anonymously')
+        self.authenticate('demo', 'demo')
+        self.assertEqual(self.url_open(url).status_code, 403, 'payhere: metrics readable by a non administrator')
+        self.authenticate('admin', 'admin')
+        response = self.url_open(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE payhere_notification_duration_seconds histogram', response.text)
+        self.assertIn('payhere_client_requests_total', response.text)
+
+        # with a token, scrapers must present it, administrators included
+        self.env['ir.config_parameter'].sudo().set_param('payment_payhere.metrics_token', 'scraper_token')
+        self.assertEqual(self.url_open(url).status_code, 403)
+        self.authenticate(None, None)
+        self.assertEqual(self.url_open(url, headers={'Authorization': 'Bearer other_token'}).status_code, 403)
+        response = self.url_open(url, headers={'Authorization': 'Bearer scraper_token'})
+        self.assertEqual(response.status_code, 200, 'payhere: the scraper token was refused')
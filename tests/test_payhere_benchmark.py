@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import random
+import time
+from unittest.mock import patch
+
+from odoo.addons.payment_payhere.controllers.main import PayhereController
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable, payhere_client
+from odoo.tests import HttpCase, tagged
+from odoo.tools import mute_logger
+
+from .test_payhere import PayhereCommon
+
+_logger = logging.getLogger(__name__)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class PayhereBenchmarkMixin(object):
+    """ Replay a realistic mix of Payhere notifications and check the figures
+    against ``benchmark_baseline.json``.
+
+        The suite never reaches Payhere: every outbound call goes to a local
+        stub. Latency budgets depend on the machine: set
+        ``PAYHERE_BENCH_UPDATE=1`` to record the figures of the current machine
+        as the new baseline, and ``PAYHERE_BENCH_TOLERANCE`` (default 0.5) to
+        change the allowed latency regression. Query counts are compared
+        strictly.
+    """
+    bench_size = 200
+    # share of each kind of notification in the replayed mix
+    bench_mix = (
+        ('success', 0.6),
+        ('pending', 0.1),
+        ('failed', 0.1),
+        ('duplicate', 0.15),
+        ('unknown', 0.05),
+    )
+
+    def _bench_setup(self, acquirer, currency):
+        acquirer.write({
+            'payhere_email_account': 'dummy',
+            'payhere_merchant_secret': 'dummy_secret',
+            'state': 'test',
+        })
+        self.bench_acquirer = acquirer
+        self.env['payment.transaction'].create([{
+            'amount': 10.0 + index,
+            'acquirer_id': acquirer.id,
+            'currency_id': currency.id,
+            'reference': 'bench_ref_%s' % index,
+            'partner_name': 'Norbert Buyer',
+        } for index in range(self.bench_size)])
+        self.bench_currency = currency
+
+    def _bench_payload(self, index, status_code, reference=None):
+        data = {
+            'merchant_id': 'dummy',
+            'order_id': reference or 'bench_ref_%s' % index,
+            'payment_id': '3200%08d' % index,
+            'payhere_amount': '%.2f' % (10.0 + index),
+            'payhere_currency': self.bench_currency.name,
+            'status_code': status_code,
+        }
+        data['md5sig'] = self.bench_acquirer._payhere_compute_md5sig(data)
+        return data
+
+    def _bench_notifications(self):
+        """ Build the notification mix, in a reproducible random order. """
+        rnd = random.Random(42)
+        kinds = []
+        for kind, share in self.bench_mix:
+            kinds += [kind] * int(self.bench_size * share)
+        rnd.shuffle(kinds)
+        sent = []
+        for index, kind in enumerate(kinds):
+            if kind == 'duplicate' and sent:
+                yield kind, dict(rnd.choice(sent))
+                continue
+            if kind == 'unknown':
+                # signed, so that it goes through the lookup of the reference
+                yield kind, self._bench_payload(index, '2', reference='unknown_ref_%s' % index)
+                continue
+            payload = self._bench_payload(index, {'success': '2', 'pending': '0', 'failed': '-2'}.get(kind, '2'))
+            sent.append(payload)
+            yield kind, payload
+
+    def _bench_stub(self, method, url, **kwargs):
+        raise PayhereUnavailable('the benchmark must not reach Payhere (%s %s)' % (method, url))
+
+    def _bench_run(self, name, process):
+        """ Replay the notification mix through ``process`` and report the
+        throughput, latency percentiles and queries per notification. """
+        latencies, queries = [], []
+        start = time.perf_counter()
+        with patch.object(payhere_client, 'request', side_effect=self._bench_stub):
+            for kind, payload in self._bench_notifications():
+                count = self.cr.sql_log_count
+                begin = time.perf_counter()
+                process(payload)
+                latencies.append(time.perf_counter() - begin)
+                queries.append(self.cr.sql_log_count - count)
+        elapsed = time.perf_counter() - start
+        figures = {
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p95_ms': _percentile(latencies, 95) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'queries_per_notification': max(queries) if queries else 0,
+        }
+        _logger.info(
+            'Payhere benchmark %s: %d notifications, %.0f/s, p50 %.2fms, p95 %.2fms, p99 %.2fms, %d queries max',
+            name, len(latencies), figures['throughput'], figures['p50_ms'], figures['p95_ms'],
+            figures['p99_ms'], figures['queries_per_notification'])
+        self._bench_check(name, figures)
+        return figures
+
+    def _bench_check(self, name, figures):
+        with open(BASELINE_PATH) as baseline_file:
+            baselines = json.load(baseline_file)
+        if os.environ.get('PAYHERE_BENCH_UPDATE'):
+            baselines[name] = {key: round(value, 2) for key, value in figures.items() if key != 'throughput'}
+            with open(BASELINE_PATH, 'w') as baseline_file:
+                json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+                baseline_file.write('\n')
+            return
+        baseline = baselines[name]
+        tolerance = 1 + float(os.environ.get('PAYHERE_BENCH_TOLERANCE', 0.5))
+        self.assertLessEqual(
+            figures['queries_per_notification'], baseline['queries_per_notification'],
+            'payhere: %s issues more queries per notification than the baseline' % name)
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            self.assertLessEqual(
+                figures[key], baseline[key] * tolerance,
+                'payhere: %s %s regressed: %.2fms instead of %.2fms' % (name, key, figures[key], baseline[key]))
+
+
+@tagged('post_install', '-at_install', 'payhere_benchmark', '-standard')
+class PayhereProcessingBenchmark(PayhereBenchmarkMixin, PayhereCommon):
+
+    def setUp(self):
+        super(PayhereProcessingBenchmark, self).setUp()
+        self._bench_setup(self.payhere, self.currency_euro)
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_10_notification_pipeline(self):
+        """ Inbox insertion, then validation and state transition of each
+        notification. """
+        Notification = self.env['payment.payhere.notification'].sudo()
+
+        def process(payload):
+            notification_id = Notification._enqueue(payload)
+            if notification_id:
+                Notification.browse(notification_id)._process()
+
+        self._bench_run('pipeline', process)
+
+
+@tagged('post_install', '-at_install', 'payhere_benchmark', '-standard')
+class PayhereRouteBenchmark(PayhereBenchmarkMixin, HttpCase):
+
+    def setUp(self):
+        super(PayhereRouteBenchmark, self).setUp()
+        self._bench_setup(self.env.ref('payment.payment_acquirer_payhere'), self.env.ref('base.EUR'))
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_notification')
+    def test_10_ipn_route(self):
+        """ What Payhere waits for: the IPN route storing the notification. """
+        def process(payload):
+            response = self.url_open(PayhereController._notify_url, data=payload)
+            self.assertEqual(response.status_code, 200)
+
+        self._bench_run('ipn_route', process)
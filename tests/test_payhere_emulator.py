@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.addons.payment_payhere.models.payhere_request import PayhereUnavailable, payhere_client
+from odoo.tests import HttpCase, tagged
+from odoo.tools import mute_logger
+
+from .payhere_emulator import Faults, PayhereEmulator
+from .test_payhere import PayhereCommon
+
+
+@tagged('post_install', '-at_install')
+class PayhereEmulated(PayhereCommon):
+    """ Failure modes of the integration, against the offline emulator. """
+
+    def setUp(self):
+        super(PayhereEmulated, self).setUp()
+        self.payhere.write({
+            'payhere_merchant_secret': 'dummy_secret',
+            'payhere_app_id': 'dummy_app',
+            'payhere_app_secret': 'dummy_app_secret',
+        })
+        self.Notification = self.env['payment.payhere.notification'].sudo()
+        self.txs = self.env['payment.transaction'].create([{
+            'amount': 10.0 + index,
+            'acquirer_id': self.payhere.id,
+            'currency_id': self.currency_euro.id,
+            'reference': 'emulated_ref_%s' % index,
+            'partner_name': 'Norbert Buyer',
+            'partner_country_id': self.country_france.id,
+        } for index in range(10)])
+        # fast retries, and a breaker opening after a few failures
+        patcher = patch.multiple(payhere_client, backoff=0.001, failure_threshold=3, reset_timeout=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _emulator(self, **faults):
+        return PayhereEmulator('dummy', 'dummy_secret', deliver=self.Notification._enqueue, faults=Faults(**faults))
+
+    def _drain(self):
+        self.Notification.search([('state', '=', 'queued')])._process()
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_10_duplicated_and_reordered_notifications(self):
+        with self._emulator(duplicate_rate=0.5, reorder=True) as emulator:
+            for tx in self.txs:
+                emulator.pay(tx.reference, tx.amount, 'EUR')
+            self._drain()
+        self.assertEqual(set(self.txs.mapped('state')), {'done'}, 'payhere: late pending notification reverted a payment')
+        self.assertEqual(self.Notification.search_count([('reference', 'like', 'emulated_ref_'), ('state', '=', 'error')]), 0)
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_request', 'odoo.addons.payment_payhere.models.payment')
+    def test_20_retrieval_retries_transient_errors(self):
+        with self._emulator() as emulator:
+            emulator.pay('emulated_ref_0', 10.0, 'EUR', statuses=(2,))
+            with emulator.faulty(error_rate=0.5, seed=1):
+                payments = self.payhere.payhere_retrieve_payments('emulated_ref_0')
+        self.assertEqual([payment['status'] for payment in payments], ['RECEIVED'])
+        self.assertGreater(len(emulator.calls), 2, 'payhere: transient errors were not retried')
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_request', 'odoo.addons.payment_payhere.models.payment')
+    def test_30_outage_and_recovery(self):
+        self.env.cr.execute(
+            "UPDATE payment_transaction SET create_date = now() at time zone 'UTC' - interval '1 hour' WHERE id IN %s",
+            (tuple(self.txs.ids),))
+        self.txs.invalidate_cache()
+        Transaction = self.env['payment.transaction']
+        with self._emulator() as emulator:
+            for tx in self.txs:
+                # the notifications are lost, only the reconciliation can settle them
+                emulator.payments[tx.reference] = [{
+                    'payment_id': 320000000100 + tx.id, 'order_id': tx.reference, 'status': 'RECEIVED',
+                    'amount': tx.amount, 'currency': 'EUR'}]
+
+            # outage: the breaker opens and the reconciliation gives up without
+            # changing anything
+            with emulator.faulty(timeout_rate=1.0):
+                with self.assertRaises(PayhereUnavailable):
+                    self.payhere.payhere_retrieve_payments('emulated_ref_0')
+                report = Transaction._cron_payhere_reconcile()
+            self.assertEqual(report['updated'], 0)
+            self.assertEqual(set(self.txs.mapped('state')), {'draft'})
+
+            # recovery: the half-open probe succeeds and the backlog is settled
+            report = Transaction._cron_payhere_reconcile()
+        self.assertEqual(report['updated'], len(self.txs), 'payhere: the integration did not recover after the outage')
+        self.assertEqual(set(self.txs.mapped('state')), {'done'})
+
+    @mute_logger('odoo.addons.payment_payhere.models.payhere_request', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_40_latency_does_not_reach_the_notifications(self):
+        with self._emulator(latency=0.05) as emulator:
+            emulator.pay('emulated_ref_1', 11.0, 'EUR', statuses=(2,))
+            calls = len(emulator.calls)
+            self._drain()
+            self.assertEqual(len(emulator.calls), calls, 'payhere: processing a notification called Payhere')
+        self.assertEqual(self.txs[1].state, 'done')
+
+
+@tagged('post_install', '-at_install')
+class PayhereEmulatedRoute(HttpCase):
+    """ The emulator posting its notifications to the IPN route. """
+
+    def setUp(self):
+        super(PayhereEmulatedRoute, self).setUp()
+        self.payhere = self.env.ref('payment.payment_acquirer_payhere')
+        self.payhere.write({
+            'payhere_email_account': 'dummy',
+            'payhere_merchant_secret': 'dummy_secret',
+            'state': 'test',
+        })
+        self.Notification = self.env['payment.payhere.notification'].sudo()
+        self.tx = self.env['payment.transaction'].create({
+            'amount': 10.0,
+            'acquirer_id': self.payhere.id,
+            'currency_id': self.env.ref('base.EUR').id,
+            'reference': 'emulated_ref_ipn',
+            'partner_name': 'Norbert Buyer'})
+
+    @mute_logger('odoo.addons.payment_payhere.models.payment', 'odoo.addons.payment_payhere.models.payhere_notification')
+    def test_10_notifications_through_the_ipn_route(self):
+        with PayhereEmulator('dummy', 'dummy_secret', faults=Faults(duplicate_rate=1.0), case=self) as emulator:
+            emulator.pay('emulated_ref_ipn', 10.0, 'EUR')
+        self.assertEqual(emulator.deliveries, [200] * 4, 'payhere: the IPN route did not acknowledge the notifications')
+        notifications = self.Notification.search([('reference', '=', 'emulated_ref_ipn')])
+        self.assertEqual(len(notifications), 2, 'payhere: duplicates posted to the IPN route were queued')
+        notifications._process()
+        self.assertEqual(set(notifications.mapped('state')), {'done'})
+        self.assertEqual(self.tx.state, 'done')